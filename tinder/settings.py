@@ -1,3 +1,4 @@
+import json
 import os
 from datetime import timedelta
 from pathlib import Path
@@ -46,6 +47,14 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Opt-in per-view timing and SQL profiling, exposed at /api/internal/profile/.
+PROFILING = int(os.environ.get("PROFILING", 0))
+PROFILING_SAMPLE_RATE = float(os.environ.get("PROFILING_SAMPLE_RATE", 0.05))
+PROFILING_SLOW_QUERIES = int(os.environ.get("PROFILING_SLOW_QUERIES", 5))
+
+if PROFILING:
+    MIDDLEWARE.insert(0, 'tinder_app.profiling.ProfilingMiddleware')
+
 ROOT_URLCONF = 'tinder.urls'
 
 TEMPLATES = [
@@ -80,6 +89,38 @@ DATABASES = {
     }
 }
 
+# Optional region read databases, e.g.
+# GEO_REGIONS='[{"name": "eu", "database": "eu", "host": "db-eu", "bbox": [-25, 35, 45, 72]}]'.
+# Each alias mirrors the default database and serves proposal queries of
+# users whose geocell falls in its bbox (lng_min, lat_min, lng_max, lat_max).
+GEO_REGIONS = json.loads(os.environ.get("GEO_REGIONS", "[]"))
+for region in GEO_REGIONS:
+    DATABASES.setdefault(region["database"], dict(
+        DATABASES["default"],
+        HOST=region.get("host", DATABASES["default"]["HOST"]),
+        TEST={"MIRROR": "default"},
+    ))
+DATABASE_ROUTERS = ['tinder_app.routers.RegionRouter']
+GEOCELL_SIZE = float(os.environ.get("GEOCELL_SIZE", 0.25))
+GEOCELL_MAX_CELLS = int(os.environ.get("GEOCELL_MAX_CELLS", 1024))
+
+# Location updates are accepted once per LOCATION_UPDATE_INTERVAL seconds.
+# With LOCATION_WRITE_BEHIND they are coalesced per user in memory and
+# written in bulk by a background thread every LOCATION_FLUSH_INTERVAL
+# seconds or LOCATION_FLUSH_SIZE pending users; otherwise they are written
+# during the request.
+LOCATION_UPDATE_INTERVAL = int(os.environ.get("LOCATION_UPDATE_INTERVAL", 7200))
+LOCATION_WRITE_BEHIND = int(os.environ.get("LOCATION_WRITE_BEHIND", 0))
+LOCATION_FLUSH_INTERVAL = float(os.environ.get("LOCATION_FLUSH_INTERVAL", 1.0))
+LOCATION_FLUSH_SIZE = int(os.environ.get("LOCATION_FLUSH_SIZE", 500))
+
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get("CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": os.environ.get("CACHE_LOCATION", ""),
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -103,7 +144,11 @@ AUTH_USER_MODEL = 'tinder_app.User'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'tinder_app.authentication.CachedJWTAuthentication',
+    ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'tinder_app.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
     'PAGE_SIZE': 20
@@ -112,8 +157,90 @@ REST_FRAMEWORK = {
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(days=1),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=7),
+    # last_login is the activity time used by proposal ranking; swipes
+    # refresh it as well (see tinder_app.swipes).
+    'UPDATE_LAST_LOGIN': True,
+}
+
+# Render proposal, match and message pages from .values() rows with field
+# plans and encode responses with orjson. The output is byte for byte the
+# same as the DRF serializers and JSONRenderer; 0 switches back to them.
+FAST_SERIALIZATION = int(os.environ.get("FAST_SERIALIZATION", 1))
+
+# request.user is built from a cached subset of the user and location rows.
+# Saves drop the entry; with a per-process cache other workers may serve
+# the old values for up to AUTH_PRINCIPAL_TIMEOUT seconds.
+AUTH_PRINCIPAL_CACHE = os.environ.get("AUTH_PRINCIPAL_CACHE", "default")
+AUTH_PRINCIPAL_TIMEOUT = int(os.environ.get("AUTH_PRINCIPAL_TIMEOUT", 60))
+
+# Proposal engine: 'orm' runs the distance query on every request,
+# 'index' answers it from an in-process grid index of user locations.
+PROPOSAL_ENGINE = os.environ.get("PROPOSAL_ENGINE", "orm")
+PROPOSAL_INDEX_CELL_SIZE = float(os.environ.get("PROPOSAL_INDEX_CELL_SIZE", 0.1))
+# Premium search radius is unbounded; proposals never look further than
+# this many km (0 disables the cap and allows whole-world scans).
+PROPOSAL_MAX_RADIUS_KM = int(os.environ.get("PROPOSAL_MAX_RADIUS_KM", 500))
+
+# Per-user sets of already swiped ids kept in memory and persisted
+# every SEEN_PERSIST_EVERY new swipes.
+SEEN_CACHE_SIZE = int(os.environ.get("SEEN_CACHE_SIZE", 10000))
+SEEN_PERSIST_EVERY = int(os.environ.get("SEEN_PERSIST_EVERY", 50))
+# Relation ids below the newest one read that are read again on every
+# catch-up, to pick up transactions that committed out of id order.
+SEEN_RESCAN_WINDOW = int(os.environ.get("SEEN_RESCAN_WINDOW", 10000))
+# Relations written by other workers are read at most once per
+# SEEN_CATCH_UP_INTERVAL seconds; this process' own swipes show at once.
+SEEN_CATCH_UP_INTERVAL = float(os.environ.get("SEEN_CATCH_UP_INTERVAL", 5))
+
+SWIPE_BATCH_MAX_SIZE = int(os.environ.get("SWIPE_BATCH_MAX_SIZE", 100))
+
+# Serve proposals from per-user decks built by `manage.py refill_decks`.
+PROPOSAL_DECKS = int(os.environ.get("PROPOSAL_DECKS", 0))
+DECK_SIZE = int(os.environ.get("DECK_SIZE", 500))
+DECK_LOW_WATERMARK = int(os.environ.get("DECK_LOW_WATERMARK", 50))
+
+# Order proposals by a weighted score instead of distance alone. The pool of
+# nearest candidates (or the deck, with PROPOSAL_DECKS) is scored with numpy.
+PROPOSAL_RANKING = int(os.environ.get("PROPOSAL_RANKING", 0))
+PROPOSAL_RANKING_POOL = int(os.environ.get("PROPOSAL_RANKING_POOL", 2000))
+PROPOSAL_RANKING_WEIGHTS = {
+    'distance': float(os.environ.get("PROPOSAL_WEIGHT_DISTANCE", 1.0)),
+    'age': float(os.environ.get("PROPOSAL_WEIGHT_AGE", 0.3)),
+    'tier': float(os.environ.get("PROPOSAL_WEIGHT_TIER", 0.2)),
+    'activity': float(os.environ.get("PROPOSAL_WEIGHT_ACTIVITY", 0.5)),
+    'popularity': float(os.environ.get("PROPOSAL_WEIGHT_POPULARITY", 0.3)),
 }
 
+# Static profile payloads for the user detail view are kept in a per-worker
+# LRU. Setting PROFILE_CACHE to a cache alias adds a shared layer behind it;
+# other workers then see changes after PROFILE_CACHE_LOCAL_TIMEOUT seconds.
+PROFILE_CACHE = os.environ.get("PROFILE_CACHE", "")
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", 10000))
+PROFILE_CACHE_LOCAL_TIMEOUT = float(os.environ.get("PROFILE_CACHE_LOCAL_TIMEOUT", 30))
+PROFILE_CACHE_TIMEOUT = int(os.environ.get("PROFILE_CACHE_TIMEOUT", 3600))
+
+# New messages are announced on a pub/sub broker to clients parked on the
+# chat poll endpoint. The local broker only reaches clients of the same
+# process; serve the poll endpoint through tinder.asgi so that waiting
+# requests do not hold a worker thread.
+CHAT_BROKER = os.environ.get("CHAT_BROKER", "tinder_app.broker.LocalBroker")
+CHAT_POLL_TIMEOUT = float(os.environ.get("CHAT_POLL_TIMEOUT", 25))
+
+# Message search uses a GIN full-text index on PostgreSQL ('postgres') and a
+# token table maintained on message creation elsewhere ('terms'). Switching
+# to 'terms' on an existing database needs `manage.py rebuild_search_index`.
+MESSAGE_SEARCH_BACKEND = os.environ.get("MESSAGE_SEARCH_BACKEND", "auto")
+MESSAGE_SEARCH_CONFIG = os.environ.get("MESSAGE_SEARCH_CONFIG", "simple")
+
+# `manage.py archive_messages` moves the messages of chats without a new
+# message for MESSAGE_ARCHIVE_IDLE_DAYS into compressed segments of at most
+# MESSAGE_ARCHIVE_SEGMENT_SIZE messages. The last message of a chat stays hot.
+MESSAGE_ARCHIVE_IDLE_DAYS = int(os.environ.get("MESSAGE_ARCHIVE_IDLE_DAYS", 30))
+MESSAGE_ARCHIVE_SEGMENT_SIZE = int(os.environ.get("MESSAGE_ARCHIVE_SEGMENT_SIZE", 1000))
+
+# Rows fetched per round trip of the server-side cursor behind chat exports.
+CHAT_EXPORT_CHUNK_SIZE = int(os.environ.get("CHAT_EXPORT_CHUNK_SIZE", 2000))
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.1/topics/i18n/
 
@@ -134,3 +261,8 @@ USE_TZ = True
 STATIC_URL = '/static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
+
+# Uploaded profile pictures are resized into fixed variants by a pool of
+# IMAGE_WORKERS threads (0 resizes during the request). Variant names are
+# content hashed, so they can be served with far-future cache headers.
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", 2))
@@ -0,0 +1 @@
+default_app_config = 'tinder_app.apps.TinderAPPConfig'
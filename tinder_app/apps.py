@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class TinderAPPConfig(AppConfig):
     name = 'tinder_app'
+
+    def ready(self):
+        from tinder_app import authentication, broker, profiles, proposals, quota, search, seen  # noqa: F401
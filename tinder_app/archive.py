@@ -0,0 +1,232 @@
+import heapq
+import json
+import zlib
+
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils.dateparse import parse_datetime
+
+from tinder_app.models import User, Chat, ChatArchive, Message
+from tinder_app.search import index_archived_messages, index_messages, search_archived_messages, search_messages
+
+SENDER_FIELDS = ('id', 'first_name', 'last_name', 'profile_pic', 'profile_pic_hash')
+
+
+def message_key(message):
+    if isinstance(message, dict):
+        return message['timestamp'], message['id']
+    return message.timestamp, message.id
+
+
+def after_key(timestamp, pk, timestamp_field='timestamp', id_field='id'):
+    return Q(**{'%s__gt' % timestamp_field: timestamp}) | Q(**{timestamp_field: timestamp, '%s__gt' % id_field: pk})
+
+
+def encode_segment(messages):
+    rows = [
+        [message.id, message.sender_id, message.text, message.timestamp.isoformat()]
+        for message in messages
+    ]
+    return zlib.compress(json.dumps(rows, separators=(',', ':')).encode(), 9)
+
+
+def decode_segment(data, chat_id):
+    return [
+        Message(id=message_id, chat_id=chat_id, sender_id=sender_id, text=text, timestamp=parse_datetime(timestamp))
+        for message_id, sender_id, text, timestamp in json.loads(zlib.decompress(bytes(data)))
+    ]
+
+
+def idle_chats(cutoff):
+    # Chats idle since cutoff that still have hot messages besides the last one.
+    return Chat.objects.filter(last_message_at__lt=cutoff).filter(Exists(
+        Message.objects.filter(chat_id=OuterRef('id'), timestamp__lt=OuterRef('last_message_at'))
+    ))
+
+
+def archive_chat(chat_id, segment_size=1000):
+    archived = 0
+    while True:
+        with transaction.atomic():
+            chat = Chat.objects.select_for_update().filter(id=chat_id).values(
+                'last_message_id', 'last_message_at'
+            ).first()
+            if chat is None or chat['last_message_id'] is None:
+                return archived
+            # The last message stays hot so that the chat list keeps it.
+            messages = list(Message.objects.filter(
+                Q(timestamp__lt=chat['last_message_at']) |
+                Q(timestamp=chat['last_message_at'], id__lt=chat['last_message_id']),
+                chat_id=chat_id,
+            ).order_by('timestamp', 'id')[:segment_size])
+            if not messages:
+                return archived
+            segment = ChatArchive.objects.create(
+                chat_id=chat_id,
+                first_timestamp=messages[0].timestamp,
+                first_message_id=messages[0].id,
+                last_timestamp=messages[-1].timestamp,
+                last_message_id=messages[-1].id,
+                message_count=len(messages),
+                data=encode_segment(messages),
+            )
+            index_archived_messages(segment.id, chat_id, messages)
+            Message.objects.filter(id__in=[message.id for message in messages]).delete()
+            Chat.objects.filter(id=chat_id).update(archived_count=F('archived_count') + len(messages))
+        archived += len(messages)
+
+
+def restore_chat(chat_id):
+    restored = 0
+    for segment_id in ChatArchive.objects.filter(chat_id=chat_id).order_by('id').values_list('id', flat=True):
+        with transaction.atomic():
+            segment = ChatArchive.objects.select_for_update().filter(id=segment_id).first()
+            if segment is None:
+                continue
+            messages = decode_segment(segment.data, chat_id)
+            senders = set(User.objects.filter(
+                id__in={message.sender_id for message in messages}
+            ).values_list('id', flat=True))
+            for message in messages:
+                if message.sender_id not in senders:
+                    message.sender_id = None
+            Message.objects.bulk_create(messages)
+            index_messages(messages)
+            segment.delete()
+            Chat.objects.filter(id=chat_id).update(archived_count=F('archived_count') - len(messages))
+        restored += len(messages)
+    return restored
+
+
+class ChatHistory:
+    # Messages of a chat from the hot table and its archive segments, merged
+    # in (timestamp, id) order. Supports what KeysetPagination needs: after()
+    # and [:n] slices, plus values() for field plans.
+
+    def __init__(self, chat_id, queryset, position=None, fields=None):
+        self.chat_id = chat_id
+        self.queryset = queryset
+        self.position = position
+        self.fields = fields
+
+    def after(self, position):
+        return ChatHistory(self.chat_id, self.queryset, tuple(position), self.fields)
+
+    def values(self, *fields):
+        return ChatHistory(self.chat_id, self.queryset, self.position, fields)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.start or key.step or key.stop is None:
+            raise TypeError('ChatHistory only supports [:n] slices')
+        limit = key.stop
+        hot = self.queryset
+        if self.position is not None:
+            hot = hot.filter(after_key(*self.position))
+        if self.fields is not None:
+            hot = hot.values(*self.fields)
+        page = list(heapq.merge(self.archived(limit), list(hot[:limit]), key=message_key))[:limit]
+        attach_senders(page, self.fields)
+        return page
+
+    def archived(self, limit):
+        segments = ChatArchive.objects.filter(chat_id=self.chat_id)
+        if self.position is not None:
+            segments = segments.filter(after_key(*self.position, 'last_timestamp', 'last_message_id'))
+        messages = []
+        for segment_id, first_timestamp, first_message_id in segments.order_by(
+            'first_timestamp', 'first_message_id'
+        ).values_list('id', 'first_timestamp', 'first_message_id'):
+            if len(messages) >= limit and message_key(messages[-1]) < (first_timestamp, first_message_id):
+                break
+            data = ChatArchive.objects.filter(id=segment_id).values_list('data', flat=True).get()
+            messages.extend(
+                message for message in decode_segment(data, self.chat_id)
+                if self.position is None or message_key(message) > self.position
+            )
+            messages.sort(key=message_key)
+            del messages[limit:]
+        return messages
+
+
+def attach_senders(page, fields=None):
+    archived = [(index, message) for index, message in enumerate(page) if isinstance(message, Message)]
+    if not archived:
+        return
+    sender_ids = list({message.sender_id for _, message in archived if message.sender_id is not None})
+    # Like the hot table, messages of deleted users have no sender.
+    if fields is None:
+        senders = User.objects.only(*SENDER_FIELDS).in_bulk(sender_ids)
+        for _, message in archived:
+            message.sender = senders.get(message.sender_id)
+        return
+    senders = {row['id']: row for row in User.objects.filter(id__in=sender_ids).values(*SENDER_FIELDS)}
+    for index, message in archived:
+        page[index] = message_row(message, senders.get(message.sender_id), fields)
+
+
+def message_row(message, sender, fields):
+    row = {
+        'id': message.id,
+        'chat_id': message.chat_id,
+        'sender_id': sender['id'] if sender else None,
+        'text': message.text,
+        'timestamp': message.timestamp,
+    }
+    for field in fields:
+        if field.startswith('sender__'):
+            row[field] = sender[field[len('sender__'):]] if sender else None
+    return {field: row[field] for field in fields}
+
+
+def chat_messages(chat_id, archived=True):
+    messages = Message.objects.filter(chat_id=chat_id).select_related('sender').order_by('timestamp', 'id')
+    return ChatHistory(chat_id, messages) if archived else messages
+
+
+def search_key(message):
+    return message.rank, message.id
+
+
+class SearchHits:
+    # Search hits from the hot table merged with archived ones in (rank, id)
+    # order for RankPagination. Archived hits come from their own index, so
+    # a page only decodes the segments holding its hits.
+
+    def __init__(self, user, query, queryset, position=None):
+        self.user = user
+        self.query = query
+        self.queryset = queryset
+        self.position = position
+
+    def after(self, position):
+        return SearchHits(self.user, self.query, self.queryset, tuple(position))
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.start or key.step or key.stop is None:
+            raise TypeError('SearchHits only supports [:n] slices')
+        limit = key.stop
+        hot = self.queryset
+        if self.position is not None:
+            hot = hot.filter(after_key(*self.position, 'rank', 'id'))
+        page = list(heapq.merge(self.archived(limit), list(hot[:limit]), key=search_key))[:limit]
+        attach_senders(page)
+        return page
+
+    def archived(self, limit):
+        hits = search_archived_messages(self.user, self.query, self.position, limit)
+        messages = {}
+        for chat_id, data in ChatArchive.objects.filter(
+            id__in={archive_id for _, _, archive_id in hits}
+        ).values_list('chat_id', 'data'):
+            messages.update((message.id, message) for message in decode_segment(data, chat_id))
+        page = []
+        for rank, message_id, _ in hits:
+            message = messages.get(message_id)
+            if message is not None:
+                message.rank = rank
+                page.append(message)
+        return page
+
+
+def search_history(user, query):
+    return SearchHits(user, query, search_messages(user, query).select_related('sender'))
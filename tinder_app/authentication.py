@@ -0,0 +1,91 @@
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from tinder_app.models import User, Location
+from tinder_app.profiling import profiled
+
+# Everything the hot views read from request.user. Other fields stay
+# deferred and are loaded on first access.
+PRINCIPAL_FIELDS = (
+    'id', 'username', 'is_active', 'is_staff', 'is_superuser',
+    'sex', 'preferred_sex', 'age', 'preferred_age_min', 'preferred_age_max',
+    'subscription', 'search_radius', 'location_id', 'last_login',
+)
+LOCATION_FIELDS = ('id', 'last_location', 'last_modified')
+
+
+def principal_key(user_id):
+    return 'principal:%s' % user_id
+
+
+def load_principal(user_id):
+    row = User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).values_list(
+        *PRINCIPAL_FIELDS, 'location__last_location', 'location__last_modified'
+    ).first()
+    if row is None:
+        return None
+    *values, point, last_modified = row
+    return tuple(values), (point.x, point.y, last_modified) if point is not None else None
+
+
+def build_principal(values, location):
+    user = User.from_db(DEFAULT_DB_ALIAS, PRINCIPAL_FIELDS, values)
+    user.is_principal = True
+    if location is not None:
+        longitude, latitude, last_modified = location
+        user.location = Location.from_db(DEFAULT_DB_ALIAS, LOCATION_FIELDS, (
+            user.location_id, Point(longitude, latitude, srid=4326), last_modified
+        ))
+    return user
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        cache = caches[settings.AUTH_PRINCIPAL_CACHE]
+        principal = cache.get(principal_key(user_id))
+        if principal is None:
+            principal = load_principal(user_id)
+            if principal is None:
+                raise AuthenticationFailed(_('User not found'), code='user_not_found')
+            cache.set(principal_key(user_id), principal, settings.AUTH_PRINCIPAL_TIMEOUT)
+
+        user = build_principal(*principal)
+        if not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        return user
+
+
+def invalidate_principal(user_id):
+    cache = caches[settings.AUTH_PRINCIPAL_CACHE]
+    cache.delete(principal_key(user_id))
+    transaction.on_commit(lambda: cache.delete(principal_key(user_id)))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@profiled('invalidate_user_principal')
+def invalidate_user_principal(sender, instance, **kwargs):
+    invalidate_principal(getattr(instance, api_settings.USER_ID_FIELD))
+
+
+@receiver(post_save, sender=Location)
+@profiled('invalidate_location_principal')
+def invalidate_location_principal(sender, instance, created, **kwargs):
+    if created:
+        return
+    for user_id in User.objects.filter(location_id=instance.id).values_list(api_settings.USER_ID_FIELD, flat=True):
+        invalidate_principal(user_id)
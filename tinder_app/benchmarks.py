@@ -0,0 +1,213 @@
+import json
+import platform
+import subprocess
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+
+from tinder_app.models import User, ChatParticipant
+from tinder_app.proposals import build_candidates, proposal_queryset
+from tinder_app.ranking import load_features, score_candidates, top_k
+
+Subject = namedtuple('Subject', ('user', 'other_id', 'chat_id'))
+Call = namedtuple('Call', ('method', 'path', 'data', 'rollback'))
+
+ENDPOINTS = {
+    'proposals': lambda subject: Call('get', '/api/proposals/', None, False),
+    'matched': lambda subject: Call('get', '/api/matched/', None, False),
+    'user_detail': lambda subject: Call('get', '/api/user/%d/' % subject.other_id, None, False),
+    'swipe': lambda subject: Call('post', '/api/swipe/%d/' % subject.other_id, {'is_liked': 1}, True),
+    'chat_list': lambda subject: Call('get', '/api/chat/', None, False),
+    'chat_retrieve': lambda subject: subject.chat_id and Call(
+        'get', '/api/chat/%d/' % subject.chat_id, None, False
+    ),
+    'chat_create': lambda subject: subject.chat_id and Call(
+        'post', '/api/chat/', {'chat': subject.chat_id, 'text': 'benchmark'}, True
+    ),
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(latencies, queries):
+    return {
+        'samples': len(latencies),
+        'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else None,
+        'p50_ms': percentile(latencies, 0.5) * 1000 if latencies else None,
+        'p90_ms': percentile(latencies, 0.9) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+        'max_ms': max(latencies) * 1000 if latencies else None,
+        'queries_mean': sum(queries) / len(queries) if queries else None,
+        'queries_max': max(queries) if queries else None,
+    }
+
+
+def sample_subjects(count, rng):
+    bounds = User.objects.filter(location__isnull=False).aggregate(Min('id'), Max('id'))
+    if bounds['id__min'] is None:
+        return []
+    ids = [rng.randint(bounds['id__min'], bounds['id__max']) for _ in range(count * 2)]
+    users = list(User.objects.filter(id__in=ids, location__isnull=False).select_related('location')[:count])
+    chats = dict(ChatParticipant.objects.filter(user__in=users).values_list('user_id', 'chat_id'))
+    return [
+        Subject(user, rng.randint(bounds['id__min'], bounds['id__max']), chats.get(user.id))
+        for user in users
+    ]
+
+
+def timed_call(client, call):
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        if call.rollback:
+            with transaction.atomic():
+                response = getattr(client, call.method)(call.path, call.data)
+                transaction.set_rollback(True)
+        else:
+            response = getattr(client, call.method)(call.path, call.data)
+        elapsed = time.perf_counter() - started
+    return response, elapsed, len(queries.captured_queries)
+
+
+def run_benchmarks(subjects, endpoints=None, iterations=1, warmup=1):
+    client = APIClient()
+    results = {}
+    for name in endpoints or ENDPOINTS:
+        latencies, queries, errors = [], [], 0
+        for subject in subjects:
+            call = ENDPOINTS[name](subject)
+            if not call:
+                continue
+            client.force_authenticate(subject.user)
+            for iteration in range(warmup + iterations):
+                response, elapsed, query_count = timed_call(client, call)
+                if iteration < warmup:
+                    continue
+                if response.status_code >= 500:
+                    errors += 1
+                latencies.append(elapsed)
+                queries.append(query_count)
+        results[name] = dict(summarize(latencies, queries), errors=errors)
+    return results
+
+
+def run_serialization_benchmark(subjects, endpoints=('proposals', 'matched', 'chat_retrieve'),
+                                iterations=1, warmup=1):
+    # CPU time of this process per page, with the DRF serializers and with
+    # field plans. Database time is not included.
+    client = APIClient()
+    results = {}
+    for mode, suffix in ((0, 'serializers'), (1, 'plans')):
+        with override_settings(FAST_SERIALIZATION=mode):
+            for name in endpoints:
+                cpu, queries, errors = [], [], 0
+                for subject in subjects:
+                    call = ENDPOINTS[name](subject)
+                    if not call:
+                        continue
+                    client.force_authenticate(subject.user)
+                    for iteration in range(warmup + iterations):
+                        started = time.process_time()
+                        response, _, query_count = timed_call(client, call)
+                        elapsed = time.process_time() - started
+                        if iteration < warmup:
+                            continue
+                        if response.status_code >= 500:
+                            errors += 1
+                        cpu.append(elapsed)
+                        queries.append(query_count)
+                results['%s_cpu_%s' % (name, suffix)] = dict(summarize(cpu, queries), errors=errors)
+    return results
+
+
+def run_ranking_benchmark(subjects, k=20, iterations=1):
+    timings = {
+        'ranking_orm_order_by': ([], []),
+        'ranking_numpy_load': ([], []),
+        'ranking_numpy_score': ([], []),
+    }
+    scored = []
+    for subject in subjects:
+        user = subject.user
+        candidates = build_candidates(user, settings.PROPOSAL_RANKING_POOL)
+        scored.append(len(candidates))
+        for _ in range(iterations):
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                list(proposal_queryset(user).values_list('id', flat=True)[:k])
+                elapsed = time.perf_counter() - started
+            timings['ranking_orm_order_by'][0].append(elapsed)
+            timings['ranking_orm_order_by'][1].append(len(queries.captured_queries))
+
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                ids, _, features = load_features(user, candidates)
+                elapsed = time.perf_counter() - started
+            timings['ranking_numpy_load'][0].append(elapsed)
+            timings['ranking_numpy_load'][1].append(len(queries.captured_queries))
+
+            started = time.perf_counter()
+            top_k(-score_candidates(user, features, settings.PROPOSAL_RANKING_WEIGHTS, time.time()), ids, k)
+            timings['ranking_numpy_score'][0].append(time.perf_counter() - started)
+            timings['ranking_numpy_score'][1].append(0)
+    return {
+        # Mean number of rows actually loaded and scored per subject.
+        name: dict(summarize(latencies, queries), errors=0, candidates=sum(scored) / len(scored) if scored else 0)
+        for name, (latencies, queries) in timings.items()
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_report(results, **meta):
+    return {
+        'meta': dict(
+            meta,
+            revision=git_revision(),
+            timestamp=time.time(),
+            python=platform.python_version(),
+            database=connection.vendor,
+            users=User.objects.count(),
+            proposal_engine=settings.PROPOSAL_ENGINE,
+            proposal_decks=settings.PROPOSAL_DECKS,
+            proposal_ranking=settings.PROPOSAL_RANKING,
+            fast_serialization=settings.FAST_SERIALIZATION,
+        ),
+        'results': results,
+    }
+
+
+def compare_reports(baseline, current):
+    rows = []
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name, {})
+        row = {'endpoint': name}
+        for key in ('p50_ms', 'p99_ms', 'queries_mean'):
+            old, new = before.get(key), result.get(key)
+            row[key] = (old, new, new / old if old and new is not None else None)
+        rows.append(row)
+    return rows
+
+
+def load_report(path):
+    with open(path) as report:
+        return json.load(report)
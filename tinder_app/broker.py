@@ -0,0 +1,101 @@
+import asyncio
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from tinder_app.models import Message
+from tinder_app.profiling import profiled
+
+
+class Subscription:
+
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.loop = None
+        self.queue = None
+
+    async def __aenter__(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.broker.add(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        self.broker.remove(self)
+
+    def deliver(self, payload):
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, payload)
+        except RuntimeError:
+            self.broker.remove(self)
+
+    async def wait(self, timeout):
+        try:
+            payloads = [await asyncio.wait_for(self.queue.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        while not self.queue.empty():
+            payloads.append(self.queue.get_nowait())
+        return payloads
+
+
+class LocalBroker:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+    def subscribe(self, channel):
+        return Subscription(self, channel)
+
+    def add(self, subscription):
+        with self._lock:
+            self._subscriptions[subscription.channel].add(subscription)
+
+    def remove(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.channel]
+
+    def publish(self, channel, payload):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.deliver(payload)
+
+    def subscribers(self, channel):
+        with self._lock:
+            return len(self._subscriptions.get(channel, ()))
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(settings.CHAT_BROKER)()
+    return _broker
+
+
+def chat_channel(chat_id):
+    return 'chat:%d' % chat_id
+
+
+@receiver(post_save, sender=Message)
+@profiled('publish_message')
+def publish_message(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(lambda: get_broker().publish(chat_channel(instance.chat_id), instance.id))
@@ -0,0 +1,89 @@
+from array import array
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from tinder_app.models import User, ProposalDeck
+from tinder_app.proposals import CandidateList, build_candidates, get_excluded_ids, get_proposals
+
+
+def encode_deck(candidates):
+    distances = array('d', (distance for distance, _ in candidates))
+    ids = array('I', (user_id for _, user_id in candidates))
+    return ids.tobytes(), distances.tobytes()
+
+
+def decode_deck(candidates, distances):
+    ids = array('I')
+    ids.frombytes(bytes(candidates))
+    meters = array('d')
+    meters.frombytes(bytes(distances))
+    return list(zip(meters, ids))
+
+
+def invalidate_deck(user_id):
+    invalidate_decks([user_id])
+
+
+def invalidate_decks(user_ids):
+    ProposalDeck.objects.filter(user_id__in=user_ids).update(
+        candidates=b'',
+        distances=b'',
+        needs_refill=True,
+        generation=F('generation') + 1,
+    )
+
+
+def get_deck_candidates(user):
+    deck = ProposalDeck.objects.filter(user_id=user.id).values_list(
+        'candidates', 'distances', 'needs_refill'
+    ).first()
+    if deck is None:
+        ProposalDeck.objects.get_or_create(user_id=user.id)
+        return None
+    candidates, distances, needs_refill = deck
+    if not candidates:
+        # A deck built when there were no candidates around is retried by
+        # the refill job; proposals are served live meanwhile.
+        if not needs_refill:
+            ProposalDeck.objects.filter(user_id=user.id).update(needs_refill=True)
+        return None
+
+    ids_to_exclude = get_excluded_ids(user)
+    candidates = [
+        candidate for candidate in decode_deck(candidates, distances)
+        if candidate[1] not in ids_to_exclude
+    ]
+    if len(candidates) < settings.DECK_LOW_WATERMARK and not needs_refill:
+        ProposalDeck.objects.filter(user_id=user.id).update(needs_refill=True)
+    return candidates
+
+
+def get_deck_proposals(user):
+    candidates = get_deck_candidates(user)
+    if candidates is None:
+        return get_proposals(user)
+    return CandidateList(candidates)
+
+
+def refill_deck(user_id, generation):
+    user = User.objects.select_related('location').filter(id=user_id).first()
+    if user is None or user.location is None:
+        candidates = []
+    else:
+        candidates = build_candidates(user, settings.DECK_SIZE)
+    ids, distances = encode_deck(candidates)
+    return ProposalDeck.objects.filter(user_id=user_id, generation=generation).update(
+        candidates=ids,
+        distances=distances,
+        needs_refill=False,
+        built_at=timezone.now(),
+    )
+
+
+def refill_decks(batch_size=100):
+    pending = ProposalDeck.objects.filter(
+        needs_refill=True
+    ).values_list('user_id', 'generation')[:batch_size]
+    return sum(refill_deck(user_id, generation) for user_id, generation in pending)
@@ -3,3 +3,7 @@ from django.core.exceptions import PermissionDenied
 
 class ParticipantsLimitException(PermissionDenied):
     pass
+
+
+class PrincipalSaveError(Exception):
+    pass
@@ -0,0 +1,80 @@
+import math
+from itertools import chain
+
+from django.conf import settings
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+class Grid:
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.columns = int(math.ceil(360 / cell_size))
+
+    def cell(self, longitude, latitude):
+        row = int(math.floor((latitude + 90) / self.cell_size))
+        column = int(math.floor((longitude + 180) / self.cell_size)) % self.columns
+        return row, column
+
+    def covering(self, longitude, latitude, radius_km):
+        delta_lat = radius_km / KM_PER_DEGREE
+        row_min, _ = self.cell(longitude, max(-90.0, latitude - delta_lat))
+        row_max, _ = self.cell(longitude, min(90.0, latitude + delta_lat))
+        cos_lat = math.cos(math.radians(min(89.9, abs(latitude) + delta_lat)))
+        delta_lng = delta_lat / cos_lat if cos_lat > 0 else 360
+        if delta_lng >= 180 or latitude + delta_lat >= 90 or latitude - delta_lat <= -90:
+            columns = range(self.columns)
+        else:
+            _, column_min = self.cell(longitude - delta_lng, latitude)
+            _, column_max = self.cell(longitude + delta_lng, latitude)
+            if column_max >= column_min:
+                columns = range(column_min, column_max + 1)
+            else:
+                columns = chain(range(column_min, self.columns), range(column_max + 1))
+        columns = list(columns)
+        return [(row, column) for row in range(row_min, row_max + 1) for column in columns]
+
+    def key(self, cell):
+        row, column = cell
+        return row * self.columns + column
+
+    def center(self, key):
+        row, column = divmod(key, self.columns)
+        return (
+            (column + 0.5) * self.cell_size - 180,
+            (row + 0.5) * self.cell_size - 90,
+        )
+
+
+geocell_grid = Grid(settings.GEOCELL_SIZE)
+
+
+def geocell(point):
+    if point is None:
+        return None
+    return geocell_grid.key(geocell_grid.cell(point.x, point.y))
+
+
+def covering_geocells(point, radius_km):
+    cells = geocell_grid.covering(point.x, point.y, radius_km)
+    if len(cells) > settings.GEOCELL_MAX_CELLS:
+        return None
+    return [geocell_grid.key(cell) for cell in cells]
+
+
+def region_for(cell):
+    if cell is None:
+        return None
+    longitude, latitude = geocell_grid.center(cell)
+    for region in settings.GEO_REGIONS:
+        lng_min, lat_min, lng_max, lat_max = region['bbox']
+        if lng_min <= longitude < lng_max and lat_min <= latitude < lat_max:
+            return region
+    return None
+
+
+def region_database(cell):
+    region = region_for(cell)
+    return region['database'] if region is not None else 'default'
@@ -0,0 +1,84 @@
+import json
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import F, Q
+from rest_framework.utils.encoders import JSONEncoder
+
+from tinder_app.archive import chat_messages, message_key
+from tinder_app.broker import chat_channel, get_broker
+from tinder_app.models import Chat, ChatParticipant, Message
+from tinder_app.search import index_messages
+from tinder_app.serializers import MessageSerializer
+from tinder_app.utils import chunks
+
+
+def export_messages(chat_id, chunk_size=2000):
+    if Chat.objects.filter(id=chat_id, archived_count__gt=0).exists():
+        yield from export_archived_messages(chat_id, chunk_size)
+        return
+    messages = Message.objects.filter(
+        chat_id=chat_id
+    ).select_related('sender').order_by('timestamp', 'id')
+    lines = []
+    for message in messages.iterator(chunk_size=chunk_size):
+        lines.append(json.dumps(MessageSerializer(message).data, cls=JSONEncoder))
+        if len(lines) >= chunk_size:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def export_archived_messages(chat_id, chunk_size=2000):
+    # Archived chats are read in keyset pages that merge both tiers.
+    messages = chat_messages(chat_id)
+    while True:
+        page = messages[:chunk_size]
+        if not page:
+            return
+        yield '\n'.join(json.dumps(MessageSerializer(message).data, cls=JSONEncoder) for message in page) + '\n'
+        messages = messages.after(message_key(page[-1]))
+
+
+def ingest_messages(messages, batch_size=1000):
+    created = 0
+    for batch in chunks(messages, batch_size):
+        with transaction.atomic():
+            Message.objects.bulk_create(batch)
+            index_messages(batch)
+            update_chat_summaries(batch)
+        created += len(batch)
+    return created
+
+
+def update_chat_summaries(messages):
+    latest = {}
+    sent = defaultdict(Counter)
+    for message in messages:
+        key = (message.timestamp, message.id)
+        if message.chat_id not in latest or key > latest[message.chat_id]:
+            latest[message.chat_id] = key
+        sent[message.chat_id][message.sender_id] += 1
+
+    for chat_id, (timestamp, message_id) in latest.items():
+        Chat.objects.filter(
+            Q(last_message_at__isnull=True) | Q(last_message_at__lte=timestamp),
+            id=chat_id,
+        ).update(last_message_id=message_id, last_message_at=timestamp)
+
+    increments = defaultdict(list)
+    for participant_id, chat_id, user_id in ChatParticipant.objects.filter(
+        chat_id__in=latest
+    ).values_list('id', 'chat_id', 'user_id'):
+        unread = sum(sent[chat_id].values()) - sent[chat_id][user_id]
+        if unread:
+            increments[unread].append(participant_id)
+    for unread, participant_ids in increments.items():
+        ChatParticipant.objects.filter(id__in=participant_ids).update(unread_count=F('unread_count') + unread)
+
+    def publish():
+        for chat_id, (_, message_id) in latest.items():
+            get_broker().publish(chat_channel(chat_id), message_id)
+
+    transaction.on_commit(publish)
@@ -0,0 +1,104 @@
+import hashlib
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections
+from PIL import Image, ImageOps
+
+from tinder_app.models import User
+
+logger = logging.getLogger(__name__)
+
+# name: (bounding box, crop to fill the box)
+IMAGE_SIZES = {
+    'card': ((720, 960), False),
+    'avatar': ((256, 256), True),
+    'thumbnail': ((96, 96), True),
+}
+JPEG_OPTIONS = {'quality': 82, 'optimize': True, 'progressive': True}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def profile_pic_storage():
+    return User._meta.get_field('profile_pic').storage
+
+
+def variant_name(digest, size):
+    return 'avatars/%s/%s/%s.jpg' % (size, digest[:2], digest)
+
+
+def profile_pic_url(name, digest, size):
+    if not name:
+        return None
+    return profile_pic_storage().url(variant_name(digest, size) if digest else name)
+
+
+def render_variants(data, storage=None):
+    storage = storage or profile_pic_storage()
+    digest = hashlib.sha256(data).hexdigest()
+    names = {size: variant_name(digest, size) for size in IMAGE_SIZES}
+    if all(storage.exists(name) for name in names.values()):
+        return digest
+
+    with Image.open(io.BytesIO(data)) as source:
+        # Let the JPEG decoder downscale while decoding; it only ever picks
+        # a scale that keeps the image larger than the requested size.
+        source.draft('RGB', IMAGE_SIZES['card'][0])
+        image = ImageOps.exif_transpose(source).convert('RGB')
+
+    for size, (box, crop) in IMAGE_SIZES.items():
+        if storage.exists(names[size]):
+            continue
+        if crop:
+            variant = ImageOps.fit(image, box, Image.LANCZOS)
+        else:
+            variant = image.copy()
+            variant.thumbnail(box, Image.LANCZOS)
+        output = io.BytesIO()
+        variant.save(output, 'JPEG', **JPEG_OPTIONS)
+        storage.save(names[size], ContentFile(output.getvalue()))
+    return digest
+
+
+def process_profile_pic(user_id, name):
+    with profile_pic_storage().open(name, 'rb') as source:
+        digest = render_variants(source.read())
+    user = User.objects.only('id', 'profile_pic', 'profile_pic_hash').filter(id=user_id, profile_pic=name).first()
+    if user is None:
+        return None
+    user.profile_pic_hash = digest
+    user.save(update_fields=['profile_pic_hash'])
+    return digest
+
+
+def _process_in_worker(user_id, name):
+    close_old_connections()
+    try:
+        return process_profile_pic(user_id, name)
+    except Exception:
+        logger.exception('Failed to process profile picture %s of user %s', name, user_id)
+    finally:
+        close_old_connections()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(settings.IMAGE_WORKERS, thread_name_prefix='images')
+    return _executor
+
+
+def schedule_profile_pic(user_id, name):
+    if not name:
+        return None
+    if not settings.IMAGE_WORKERS:
+        return process_profile_pic(user_id, name)
+    return get_executor().submit(_process_in_worker, user_id, name)
@@ -0,0 +1,178 @@
+import atexit
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.db import close_old_connections, transaction
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from tinder_app.decks import invalidate_decks
+from tinder_app.geocells import geocell
+from tinder_app.models import User, Location
+
+logger = logging.getLogger(__name__)
+
+LOCATION_UPDATE_FIELDS = ('last_location', 'last_modified', 'cell')
+
+
+def write_locations(pending, batch_size=1000):
+    updated, created = [], []
+    for user_id, (location_id, longitude, latitude, at) in pending.items():
+        point = Point(longitude, latitude, srid=4326)
+        location = Location(id=location_id, last_location=point, last_modified=at, cell=geocell(point))
+        if location_id is None:
+            created.append((user_id, location))
+        else:
+            updated.append(location)
+
+    linked, orphaned = [], []
+    with transaction.atomic():
+        Location.objects.bulk_update(updated, LOCATION_UPDATE_FIELDS, batch_size=batch_size)
+        Location.objects.bulk_create([location for _, location in created], batch_size=batch_size)
+        for user_id, location in created:
+            if User.objects.filter(id=user_id, location__isnull=True).update(location=location):
+                linked.append(user_id)
+            else:
+                orphaned.append((user_id, location))
+        if orphaned:
+            # Another worker linked a location first; the update goes to
+            # that one instead of being dropped with the spare row.
+            Location.objects.filter(id__in=[location.id for _, location in orphaned]).delete()
+            existing = dict(User.objects.filter(
+                id__in=[user_id for user_id, _ in orphaned], location__isnull=False,
+            ).values_list('id', 'location_id'))
+            moved = []
+            for user_id, location in orphaned:
+                if user_id in existing:
+                    location.id = existing[user_id]
+                    moved.append(location)
+            Location.objects.bulk_update(moved, LOCATION_UPDATE_FIELDS, batch_size=batch_size)
+            updated.extend(moved)
+        invalidate_decks(list(pending))
+
+    # bulk writes skip model signals; send them so that caches and the
+    # proposal index see the new locations.
+    for location in updated:
+        post_save.send(
+            sender=Location, instance=location, created=False,
+            update_fields=frozenset(LOCATION_UPDATE_FIELDS), raw=False, using='default',
+        )
+    for user in User.objects.only('id', 'location').filter(id__in=linked):
+        post_save.send(
+            sender=User, instance=user, created=False,
+            update_fields=frozenset(['location']), raw=False, using='default',
+        )
+    return len(pending)
+
+
+class LocationBuffer:
+
+    def __init__(self, write_behind=False, flush_size=500, flush_interval=1.0,
+                 update_interval=7200):
+        self.write_behind = write_behind
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.update_interval = timedelta(seconds=update_interval)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._accepted = {}
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def submit(self, user, longitude, latitude):
+        now = timezone.now()
+        with self._lock:
+            last = self._accepted.get(user.id)
+        if last is not None and now - last < self.update_interval:
+            return False
+        # request.user may be a cached principal, so the location and its
+        # last update are read from the database.
+        location_id, modified = User.objects.filter(id=user.id).values_list(
+            'location_id', 'location__last_modified'
+        ).first() or (None, None)
+        with self._lock:
+            last = max((at for at in (self._accepted.get(user.id), modified) if at is not None), default=None)
+            if last is not None and now - last < self.update_interval:
+                return False
+            self._accepted[user.id] = now
+            self._pending[user.id] = (location_id, longitude, latitude, now)
+            pending = len(self._pending)
+
+        if not self.write_behind or self._stopped or not self._ensure_thread():
+            self.flush()
+        elif pending >= self.flush_size * 4:
+            # The writer fell behind; apply back pressure on the request.
+            self.flush()
+        elif pending >= self.flush_size:
+            self._wakeup.set()
+        return True
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                horizon = timezone.now() - self.update_interval
+                self._accepted = {
+                    user_id: at for user_id, at in self._accepted.items() if at > horizon
+                }
+            if not pending:
+                return 0
+            try:
+                return write_locations(pending)
+            except Exception:
+                with self._lock:
+                    for user_id, update in pending.items():
+                        self._pending.setdefault(user_id, update)
+                raise
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return True
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                try:
+                    self._thread = threading.Thread(target=self._run, name='location-writer', daemon=True)
+                    self._thread.start()
+                except RuntimeError:
+                    self._thread = None
+                    return False
+        return True
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to flush %d location updates', self.pending())
+            close_old_connections()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval * 2)
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Lost %d location updates on shutdown', self.pending())
+
+
+location_buffer = LocationBuffer(
+    write_behind=settings.LOCATION_WRITE_BEHIND,
+    flush_size=settings.LOCATION_FLUSH_SIZE,
+    flush_interval=settings.LOCATION_FLUSH_INTERVAL,
+    update_interval=settings.LOCATION_UPDATE_INTERVAL,
+)
+atexit.register(location_buffer.stop)
@@ -0,0 +1,36 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from tinder_app.archive import archive_chat, idle_chats, restore_chat
+
+
+class Command(BaseCommand):
+    help = 'Move messages of idle chats into compressed archive segments, or restore them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--idle-days', type=int, default=settings.MESSAGE_ARCHIVE_IDLE_DAYS)
+        parser.add_argument('--segment-size', type=int, default=settings.MESSAGE_ARCHIVE_SEGMENT_SIZE)
+        parser.add_argument('--batch-size', type=int, default=500, help='Chats selected per query')
+        parser.add_argument(
+            '--restore', type=int, nargs='+', metavar='CHAT', help='Move these chats back to the hot table'
+        )
+
+    def handle(self, *args, **options):
+        if options['restore']:
+            for chat_id in options['restore']:
+                self.stdout.write('Chat %d: restored %d messages' % (chat_id, restore_chat(chat_id)))
+            return
+
+        chats = idle_chats(timezone.now() - timedelta(days=options['idle_days'])).order_by('id')
+        archived, last_id = 0, 0
+        while True:
+            batch = list(chats.filter(id__gt=last_id).values_list('id', flat=True)[:options['batch_size']])
+            if not batch:
+                break
+            for chat_id in batch:
+                archived += archive_chat(chat_id, options['segment_size'])
+            last_id = batch[-1]
+            self.stdout.write('Archived %d messages' % archived)
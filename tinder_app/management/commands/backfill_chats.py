@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import OuterRef, Subquery
+
+from tinder_app.models import Chat, ChatParticipant, Message
+
+# Table of the participants many-to-many field before ChatParticipant.
+LEGACY_PARTICIPANTS_TABLE = 'tinder_app_chat_participants'
+
+
+def copy_legacy_participants():
+    if LEGACY_PARTICIPANTS_TABLE not in connection.introspection.table_names():
+        return 0
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO {participant} (chat_id, user_id, unread_count) '
+            'SELECT legacy.chat_id, legacy.user_id, 0 FROM {legacy} legacy '
+            'WHERE NOT EXISTS (SELECT 1 FROM {participant} p '
+            'WHERE p.chat_id = legacy.chat_id AND p.user_id = legacy.user_id)'.format(
+                participant=quote(ChatParticipant._meta.db_table), legacy=quote(LEGACY_PARTICIPANTS_TABLE),
+            )
+        )
+        return cursor.rowcount
+
+
+def backfill_summaries(chat_ids):
+    latest = Message.objects.filter(chat_id=OuterRef('id')).order_by('-timestamp', '-id')
+    Chat.objects.filter(id__in=chat_ids).update(
+        last_message_id=Subquery(latest.values('id')[:1]),
+        last_message_at=Subquery(latest.values('timestamp')[:1]),
+    )
+    # There are no read receipts to go by: messages from the other side
+    # after a participant's own last message count as unread.
+    last_sent = Message.objects.filter(
+        chat_id=OuterRef('chat_id'), sender_id=OuterRef('user_id')
+    ).order_by('-timestamp').values('timestamp')[:1]
+    participants = list(ChatParticipant.objects.filter(chat_id__in=chat_ids).annotate(last_sent=Subquery(last_sent)))
+    for participant in participants:
+        unread = Message.objects.filter(chat_id=participant.chat_id).exclude(sender_id=participant.user_id)
+        if participant.last_sent is not None:
+            unread = unread.filter(timestamp__gt=participant.last_sent)
+        participant.unread_count = unread.count()
+    ChatParticipant.objects.bulk_update(participants, ['unread_count'])
+
+
+class Command(BaseCommand):
+    help = 'Copy participants from the old chat m2m table and fill in chat summaries and unread counters.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            copied = copy_legacy_participants()
+        self.stdout.write('Copied %d participants' % copied)
+
+        chats = Chat.objects.filter(last_message__isnull=True, message__isnull=False).distinct().order_by('id')
+        updated, last_id = 0, 0
+        while True:
+            batch = list(chats.filter(id__gt=last_id).values_list('id', flat=True)[:options['batch_size']])
+            if not batch:
+                break
+            with transaction.atomic():
+                backfill_summaries(batch)
+            updated += len(batch)
+            last_id = batch[-1]
+            self.stdout.write('Updated %d chats' % updated)
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from tinder_app.geocells import geocell
+from tinder_app.models import Location
+
+
+class Command(BaseCommand):
+    help = 'Compute Location.cell for rows written before it existed or after a GEOCELL_SIZE change.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--all', action='store_true', help='Recompute every row, not only missing cells')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        locations = Location.objects.order_by('id')
+        if not options['all']:
+            locations = locations.filter(cell__isnull=True)
+
+        updated, last_id = 0, 0
+        while True:
+            batch = list(locations.filter(id__gt=last_id).only('id', 'last_location', 'cell')[:batch_size])
+            if not batch:
+                break
+            for location in batch:
+                location.cell = geocell(location.last_location)
+            Location.objects.bulk_update(batch, ['cell'])
+            updated += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write('Updated %d locations' % updated)
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from tinder_app.models import User, Relationship, ChatParticipant
+from tinder_app.swipes import create_chats
+from tinder_app.utils import chunks
+
+
+def missing_chat_pairs(pairs):
+    first_ids = {first for first, _ in pairs}
+    second_ids = {second for _, second in pairs}
+    existing = set(ChatParticipant.objects.filter(
+        user_id__in=first_ids,
+        chat__chatparticipant__user_id__in=second_ids,
+    ).values_list('user_id', 'chat__chatparticipant__user_id'))
+    return [pair for pair in pairs if pair not in existing]
+
+
+class Command(BaseCommand):
+    help = 'Create the chat (match record) for every mutual like that does not have one.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        matches = Relationship.objects.filter(
+            status=Relationship.LIKED,
+            from_user_id__lt=F('to_user_id'),
+            to_user__from_users__to_user=F('from_user'),
+            to_user__from_users__status=Relationship.LIKED,
+        ).values_list('from_user_id', 'to_user_id').order_by('from_user_id', 'to_user_id')
+
+        checked = created = 0
+        for pairs in chunks(matches.iterator(chunk_size=options['batch_size']), options['batch_size']):
+            checked += len(pairs)
+            with transaction.atomic():
+                # Same lock order as swipes, so a like landing meanwhile
+                # cannot create a second chat for the pair.
+                list(User.objects.select_for_update().filter(
+                    id__in={user_id for pair in pairs for user_id in pair}
+                ).order_by('id').values_list('id', flat=True))
+                missing = missing_chat_pairs(pairs)
+                if missing and not options['dry_run']:
+                    create_chats(missing)
+            created += len(missing)
+            self.stdout.write('Checked %d matches, %s %d chats' % (
+                checked, 'missing' if options['dry_run'] else 'created', created
+            ))
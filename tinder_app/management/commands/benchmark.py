@@ -0,0 +1,84 @@
+import json
+import random
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from tinder_app.benchmarks import (
+    ENDPOINTS,
+    build_report,
+    compare_reports,
+    load_report,
+    run_benchmarks,
+    run_ranking_benchmark,
+    run_serialization_benchmark,
+    sample_subjects,
+)
+from tinder_app.models import User
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=0)
+        parser.add_argument('--seed', default='benchmark')
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--sample', type=int, default=50)
+        parser.add_argument('--iterations', type=int, default=3)
+        parser.add_argument('--warmup', type=int, default=1)
+        parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+        parser.add_argument('--output')
+        parser.add_argument('--compare')
+        parser.add_argument('--ranking', action='store_true')
+        parser.add_argument('--serialization', action='store_true')
+
+    def handle(self, *args, **options):
+        endpoints = options['endpoints'].split(',')
+        unknown = set(endpoints) - set(ENDPOINTS)
+        if unknown:
+            raise CommandError('Unknown endpoints: %s' % ', '.join(sorted(unknown)))
+
+        missing = options['users'] - User.objects.count()
+        if missing > 0:
+            call_command(
+                'generate_users', missing,
+                seed=options['seed'], workers=options['workers'], stdout=self.stderr
+            )
+
+        subjects = sample_subjects(options['sample'], random.Random(options['seed']))
+        if not subjects:
+            raise CommandError('No users with a location to benchmark.')
+        with override_settings(ALLOWED_HOSTS=['*']):
+            results = run_benchmarks(subjects, endpoints, options['iterations'], options['warmup'])
+            if options['serialization']:
+                results.update(run_serialization_benchmark(
+                    subjects, iterations=options['iterations'], warmup=options['warmup']
+                ))
+        if options['ranking']:
+            results.update(run_ranking_benchmark(subjects, iterations=options['iterations']))
+        report = build_report(
+            results,
+            sample=len(subjects),
+            iterations=options['iterations'],
+            seed=options['seed'],
+        )
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as report_file:
+                report_file.write(output)
+        else:
+            self.stdout.write(output)
+
+        if options['compare']:
+            for row in compare_reports(load_report(options['compare']), report):
+                parts = []
+                for key in ('p50_ms', 'p99_ms', 'queries_mean'):
+                    old, new, ratio = (format_value(value) for value in row[key])
+                    parts.append('%s %s -> %s (x%s)' % (key, old, new, ratio))
+                self.stderr.write('%-14s %s' % (row['endpoint'], '  '.join(parts)))
+
+
+def format_value(value):
+    return '-' if value is None else '%.2f' % value
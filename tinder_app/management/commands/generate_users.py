@@ -1,58 +1,264 @@
 import random
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from multiprocessing import Pool
 
-from django.core.management.base import BaseCommand
 from django.contrib.gis.geos import Point
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
 from faker import Faker
 
-from tinder_app.models import User, Location
+from tinder_app.geocells import geocell
+from tinder_app.models import User, Location, Relationship, Chat, ChatParticipant, Message
+from tinder_app.search import index_messages
+from tinder_app.utils import chunks
+
+LAT_MIN, LAT_MAX = 53.85, 53.94
+LNG_MIN, LNG_MAX = 27.44, 27.64
+
+_partitions = {}
+
+
+def generate_user_chunk(seed, start, size):
+    rng = random.Random('%s-users-%d' % (seed, start))
+    fake = Faker()
+    fake.seed_instance('%s-names-%d' % (seed, start))
+
+    rows = []
+    for index in range(start, start + size):
+        age = rng.randrange(18, 55)
+        age_delta = rng.choice([2, 3, 5, 7, 10])
+        sex = rng.choice(('M', 'F'))
+        if rng.random() < 0.1:
+            preferred_sex = sex
+        else:
+            preferred_sex = 'F' if sex == 'M' else 'M'
+        if sex == 'M':
+            first_name, last_name = fake.first_name_male(), fake.last_name_male()
+        else:
+            first_name, last_name = fake.first_name_female(), fake.last_name_female()
+        rows.append((index, age, age_delta, sex, preferred_sex, first_name, last_name))
+
+    points = [
+        Point(rng.uniform(LNG_MIN, LNG_MAX), rng.uniform(LAT_MIN, LAT_MAX), srid=4326)
+        for _ in rows
+    ]
+    locations = [Location(last_location=point, cell=geocell(point)) for point in points]
+    with transaction.atomic():
+        Location.objects.bulk_create(locations)
+        users = []
+        for location, (index, age, age_delta, sex, preferred_sex, first_name, last_name) in zip(locations, rows):
+            subscription = rng.choice((User.BASE, User.VIP, User.PREMIUM))
+            # The index after the separator keeps usernames unique even
+            # when the faker part ends with digits.
+            username = '%s_%d' % (fake.user_name(), index)
+            users.append(User(
+                username=username,
+                email='%s@%s' % (username, fake.free_email_domain()),
+                first_name=first_name,
+                last_name=last_name,
+                subscription=subscription,
+                search_radius=User.SEARCH_RADIUS[subscription],
+                age=age,
+                sex=sex,
+                preferred_sex=preferred_sex,
+                preferred_age_min=age - age_delta,
+                preferred_age_max=age + age_delta,
+                location_id=location.id,
+            ))
+        User.objects.bulk_create(users)
+    return [(user.id, user.sex, user.preferred_sex) for user in users]
+
+
+def init_relations_worker(partitions):
+    global _partitions
+    _partitions = partitions
+
+
+def generate_relation_chunk(seed, index, users, options):
+    # Seeded by the chunk position: ids depend on which worker inserted first.
+    rng = random.Random('%s-relations-%d' % (seed, index))
+    relations = []
+    for user_id, sex, preferred_sex in users:
+        candidates = _partitions.get((preferred_sex, sex))
+        if not candidates:
+            continue
+        swipes = int(options['min_swipes'] * rng.paretovariate(options['swipe_alpha']))
+        for target in rng.sample(candidates, min(len(candidates), swipes, options['max_swipes'])):
+            if target == user_id:
+                continue
+            liked = rng.random() < options['like_rate']
+            relations.append(Relationship(
+                from_user_id=user_id,
+                to_user_id=target,
+                status=Relationship.LIKED if liked else Relationship.DISLIKED,
+            ))
+            if liked and rng.random() < options['match_rate']:
+                relations.append(Relationship(
+                    from_user_id=target,
+                    to_user_id=user_id,
+                    status=Relationship.LIKED,
+                ))
+    Relationship.objects.bulk_create(relations, batch_size=options['batch_size'], ignore_conflicts=True)
+    return len(relations)
+
+
+def run_user_chunk(args):
+    return generate_user_chunk(*args)
+
+
+def run_relation_chunk(args):
+    return generate_relation_chunk(*args)
 
 
 class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('count', type=int)
+        parser.add_argument('--seed', default=None)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--no-relations', action='store_true')
+        parser.add_argument('--min-swipes', type=int, default=5)
+        parser.add_argument('--max-swipes', type=int, default=1000)
+        parser.add_argument('--swipe-alpha', type=float, default=1.3)
+        parser.add_argument('--like-rate', type=float, default=0.4)
+        parser.add_argument('--match-rate', type=float, default=0.2)
+        parser.add_argument('--silent-chat-rate', type=float, default=0.3)
+        parser.add_argument('--messages-mu', type=float, default=2.5)
+        parser.add_argument('--messages-sigma', type=float, default=1.0)
+        parser.add_argument('--history-days', type=float, default=90)
 
     def handle(self, *args, **options):
         count = options['count']
+        seed = options['seed'] if options['seed'] is not None else random.randrange(2 ** 32)
+        batch_size = options['batch_size']
+        self.stdout.write('Seed: %s' % seed)
+
+        # Indexes start above every existing id, so reruns never reuse one
+        # even after users were deleted.
+        first_id = offset = (User.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+        tasks = [
+            (seed, start, min(batch_size, offset + count - start))
+            for start in range(offset, offset + count, batch_size)
+        ]
+        users = []
+        with self.timed('users and locations') as stats:
+            for chunk in self.map(run_user_chunk, tasks, options['workers']):
+                users.extend(chunk)
+            stats['rows'] = len(users) * 2
+
+        if options['no_relations'] or not users:
+            return
+
+        partitions = {}
+        for user_id, sex, preferred_sex in User.objects.filter(
+            sex__isnull=False, preferred_sex__isnull=False
+        ).values_list('id', 'sex', 'preferred_sex').order_by('id').iterator(chunk_size=batch_size):
+            partitions.setdefault((sex, preferred_sex), []).append(user_id)
+
+        relation_options = {
+            key: options[key] for key in
+            ('batch_size', 'min_swipes', 'max_swipes', 'swipe_alpha', 'like_rate', 'match_rate')
+        }
+        tasks = [
+            (seed, index, chunk, relation_options)
+            for index, chunk in enumerate(chunks(users, max(1, batch_size // 50)))
+        ]
+        with self.timed('relationships') as stats:
+            stats['rows'] = sum(self.map(run_relation_chunk, tasks, options['workers'], partitions))
+
+        with self.timed('chats and messages') as stats:
+            stats['rows'] = self.generate_chats(seed, first_id, options)
 
-        lat_min = 53.85
-        lat_max = 53.94
-        lng_min = 27.44
-        lng_max = 27.64
+    def map(self, function, tasks, workers, partitions=None):
+        if workers <= 1:
+            init_relations_worker(partitions)
+            return [function(task) for task in tasks]
+        connections.close_all()
+        with Pool(workers, initializer=init_relations_worker, initargs=(partitions,)) as pool:
+            return pool.map(function, tasks, chunksize=1)
 
+    @contextmanager
+    def timed(self, label):
+        stats = {'rows': 0}
+        started = time.monotonic()
+        yield stats
+        elapsed = time.monotonic() - started
+        self.stdout.write('%s: %d rows in %.1fs (%.0f rows/sec)' % (
+            label, stats['rows'], elapsed, stats['rows'] / elapsed if elapsed else 0
+        ))
+
+    def generate_chats(self, seed, first_id, options):
+        rng = random.Random('%s-chats' % seed)
         fake = Faker()
+        fake.seed_instance('%s-texts' % seed)
+        texts = [fake.sentence() for _ in range(1000)]
+        now = timezone.now()
+        history = timedelta(days=options['history_days']).total_seconds()
 
-        sexual_orientation_list = random.choices(
-            population=['hetero', 'homo'], weights=[0.9, 0.1], k=count)
-
-        for i in range(count):
-            longitude = random.uniform(lng_min, lng_max)
-            latitude = random.uniform(lat_min, lat_max)
-            age = random.randrange(18, 55)
-            age_delta = random.choice([2, 3, 5, 7, 10])
-            orientation = sexual_orientation_list[i]
-            sex = random.choice(('M', 'F'))
-            first_name, last_name = fake.unique.name_male().split() if sex == 'M' else \
-                fake.unique.name_female().split()
-
-            if orientation == 'homo':
-                user_preferred_sex = sex
-            else:
-                user_preferred_sex = 'F' if sex == 'M' else 'M'
-
-            location = Location.objects.create(last_location=Point(longitude, latitude, srid=4326))
-
-            User.objects.create(
-                username=fake.unique.user_name(),
-                email=fake.unique.email(),
-                first_name=first_name,
-                last_name=last_name,
-                subscription=random.choice((1, 2, 3)),
-                age=age,
-                sex=sex,
-                preferred_sex=user_preferred_sex,
-                preferred_age_min=(age - age_delta),
-                preferred_age_max=(age + age_delta),
-                location=location,
-                search_radius=random.choice((2, 5, 7, 10, 25))
-            )
+        matches = Relationship.objects.filter(
+            Q(from_user_id__gte=first_id) | Q(to_user_id__gte=first_id),
+            status=Relationship.LIKED,
+            from_user_id__lt=F('to_user_id'),
+            to_user__from_users__to_user=F('from_user'),
+            to_user__from_users__status=Relationship.LIKED,
+        ).values_list('from_user_id', 'to_user_id').order_by('from_user_id', 'to_user_id')
+
+        created = 0
+        for pairs in chunks(matches.iterator(chunk_size=options['batch_size']), options['batch_size']):
+            with transaction.atomic():
+                # Each match happens somewhere in the history window and its
+                # messages are spread between then and now, in order.
+                plans = []
+                for pair in pairs:
+                    started = rng.uniform(0, history)
+                    if rng.random() < options['silent_chat_rate']:
+                        length = 0
+                    else:
+                        length = max(1, int(rng.lognormvariate(options['messages_mu'], options['messages_sigma'])))
+                    plans.append((started, sorted((rng.uniform(0, started) for _ in range(length)), reverse=True)))
+                chats = Chat.objects.bulk_create([
+                    Chat(created_at=now - timedelta(seconds=started)) for started, _ in plans
+                ])
+                participants = {}
+                for chat, pair in zip(chats, pairs):
+                    for user_id in pair:
+                        participants[(chat.id, user_id)] = ChatParticipant(chat=chat, user_id=user_id)
+                ChatParticipant.objects.bulk_create(participants.values())
+
+                messages = []
+                for chat, pair, (_, ages) in zip(chats, pairs, plans):
+                    for ago in ages:
+                        messages.append(Message(
+                            chat=chat, sender_id=rng.choice(pair), text=rng.choice(texts),
+                            timestamp=now - timedelta(seconds=ago),
+                        ))
+                Message.objects.bulk_create(messages, batch_size=options['batch_size'])
+                index_messages(messages, batch_size=options['batch_size'])
+
+                last_messages = {}
+                for message in messages:
+                    sender_id, unread = last_messages.get(message.chat_id, (None, 0))
+                    unread = unread + 1 if sender_id == message.sender_id else 1
+                    last_messages[message.chat_id] = (message.sender_id, unread)
+                    message.chat.last_message = message
+                    message.chat.last_message_at = message.timestamp
+                for (chat_id, user_id), participant in participants.items():
+                    sender_id, unread = last_messages.get(chat_id, (user_id, 0))
+                    participant.unread_count = unread if sender_id != user_id else 0
+                Chat.objects.bulk_update(
+                    [chat for chat in chats if chat.id in last_messages],
+                    ['last_message', 'last_message_at'],
+                    batch_size=options['batch_size'],
+                )
+                ChatParticipant.objects.bulk_update(
+                    [participant for participant in participants.values() if participant.unread_count],
+                    ['unread_count'],
+                    batch_size=options['batch_size'],
+                )
+            created += len(chats) * 3 + len(messages)
+        return created
@@ -0,0 +1,51 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from tinder_app.history import ingest_messages
+from tinder_app.models import Message
+
+
+def parse_message(line, chat_id=None):
+    row = json.loads(line)
+    sender = row.get('sender')
+    timestamp = parse_datetime(row['timestamp']) if row.get('timestamp') else timezone.now()
+    if timestamp is None:
+        raise ValueError('Invalid timestamp: %r' % row['timestamp'])
+    return Message(
+        chat_id=chat_id or row['chat'],
+        sender_id=sender.get('id') if isinstance(sender, dict) else sender,
+        text=row['text'],
+        timestamp=timestamp,
+    )
+
+
+class Command(BaseCommand):
+    help = 'Bulk load messages from NDJSON, e.g. the output of the chat export endpoint.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="NDJSON file, or '-' for stdin")
+        parser.add_argument('--chat', type=int, default=None, help='Chat for lines without a "chat" key')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        source = sys.stdin if options['path'] == '-' else open(options['path'])
+        try:
+            messages = (
+                self.parse(number, line, options['chat'])
+                for number, line in enumerate(source, 1) if line.strip()
+            )
+            created = ingest_messages(messages, options['batch_size'])
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        self.stdout.write('Imported %d messages' % created)
+
+    def parse(self, number, line, chat_id):
+        try:
+            return parse_message(line, chat_id)
+        except (KeyError, TypeError, ValueError) as exc:
+            raise CommandError('Line %d: %s' % (number, exc))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from tinder_app.archive import decode_segment
+from tinder_app.models import ChatArchive, Message, MessageTerm
+from tinder_app.search import index_archived_messages, index_messages, search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the message token index used by the terms search backend and index unindexed archive segments.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        self.index_archives()
+        if search_backend() != 'terms':
+            self.stdout.write('The %s backend keeps its own index for hot messages.' % search_backend())
+            return
+        batch_size = options['batch_size']
+        indexed, last_id = 0, 0
+        while True:
+            batch = list(Message.objects.filter(id__gt=last_id).order_by('id').only('id', 'chat', 'text')[:batch_size])
+            if not batch:
+                break
+            with transaction.atomic():
+                MessageTerm.objects.filter(message__in=batch).delete()
+                index_messages(batch)
+            indexed += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write('Indexed %d messages' % indexed)
+
+    def index_archives(self):
+        # Segments archived before the index existed, or under the other backend.
+        unindexed = 'vectors' if search_backend() == 'postgres' else 'terms'
+        indexed = 0
+        for segment in ChatArchive.objects.filter(**{'%s__isnull' % unindexed: True}).only(
+            'id', 'chat_id', 'data'
+        ).iterator():
+            index_archived_messages(segment.id, segment.chat_id, decode_segment(segment.data, segment.chat_id))
+            indexed += 1
+        if indexed:
+            self.stdout.write('Indexed %d archive segments' % indexed)
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from tinder_app.decks import refill_decks
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--interval', type=float, default=1.0)
+        parser.add_argument('--once', action='store_true')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        while True:
+            refilled = refill_decks(batch_size)
+            if refilled:
+                self.stdout.write('Refilled %d decks' % refilled)
+            if options['once']:
+                break
+            if refilled < batch_size:
+                time.sleep(options['interval'])
@@ -1,11 +1,16 @@
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.search import SearchVectorField
 from django.contrib.gis.geos import Point
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.contrib.gis.db import models
+from django.db.models import F, Q
 from django.db.models.signals import m2m_changed, post_save, pre_save
 from django.dispatch import receiver
+from django.utils import timezone
 
-from tinder_app.exceptions import ParticipantsLimitException
+from tinder_app.exceptions import ParticipantsLimitException, PrincipalSaveError
+from tinder_app.geocells import geocell, region_for
+from tinder_app.profiling import profiled
 
 
 class User(AbstractUser):
@@ -15,6 +20,8 @@ class User(AbstractUser):
         (VIP, 'VIP subscription'),
         (PREMIUM, 'Premium subscription')
     )
+    SWIPES_PER_DAY = {BASE: 20, VIP: 100, PREMIUM: 2147483647}
+    SEARCH_RADIUS = {BASE: 10, VIP: 25, PREMIUM: 2147483647}
 
     SEX_CHOICES = (
         ('M', 'Male'),
@@ -28,12 +35,29 @@ class User(AbstractUser):
     preferred_age_max = models.PositiveSmallIntegerField(default=150)
     description = models.CharField(max_length=2000, null=True, blank=True)
     profile_pic = models.ImageField(upload_to='avatars', null=True)
+    # sha256 of the uploaded file once its resized variants are stored.
+    profile_pic_hash = models.CharField(max_length=64, null=True, blank=True)
     relations = models.ManyToManyField('self', through='Relationship', symmetrical=False)
     location = models.OneToOneField('Location', null=True, on_delete=models.CASCADE)
     subscription = models.PositiveSmallIntegerField(choices=SUB_TYPES, default=BASE)
+    # Legacy: the daily limit comes from SWIPES_PER_DAY by subscription.
     swipes_per_day = models.PositiveIntegerField(null=True)
     search_radius = models.PositiveIntegerField(null=True)
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            models.Index(fields=['sex', 'preferred_sex', 'age'], name='user_proposal_idx'),
+        ]
+
+    # Set on request.user by CachedJWTAuthentication. Its fields come from a
+    # per-process cache and may be stale, so only named columns may be saved.
+    is_principal = False
+
+    def save(self, *args, **kwargs):
+        if self.is_principal and kwargs.get('update_fields') is None:
+            raise PrincipalSaveError('Cached principals can only be saved with update_fields.')
+        super().save(*args, **kwargs)
+
     @property
     def homo(self):
         return self.preferred_sex == self.sex
@@ -75,14 +99,21 @@ class User(AbstractUser):
         return self._get_related(Relationship.DISLIKED)
 
     def get_matched_list(self):
-        return self.relations.filter(
-            to_users__from_user=self,
-            to_users__status=Relationship.LIKED,
-            from_users__to_user=self,
-            from_users__status=Relationship.LIKED,
-        )
+        return User.objects.filter(
+            chatparticipant__chat__chatparticipant__user=self,
+        ).exclude(
+            id=self.id
+        ).annotate(
+            matched_at=F('chatparticipant__chat__created_at')
+        ).order_by('-matched_at', '-id')
 
     def is_matched(self, other):
+        return ChatParticipant.objects.filter(
+            user=self,
+            chat__chatparticipant__user=other,
+        ).exists()
+
+    def has_mutual_like(self, other):
         return Relationship.objects.filter(
             from_user=self,
             to_user=other,
@@ -94,26 +125,34 @@ class User(AbstractUser):
             status=Relationship.LIKED
         ).exists()
 
-    def get_chat_id(self, other):
-        return Chat.objects.filter(
-            participants=self.id
-        ).intersection(Chat.objects.filter(
-            participants=other.id)
-        ).first()
+    def get_chat_ids(self, user_ids):
+        return dict(Chat.participants.through.objects.filter(
+            chat__participants=self.id,
+            user_id__in=user_ids,
+        ).exclude(user_id=self.id).values_list('user_id', 'chat_id'))
 
 
 @receiver(pre_save, sender=User)
 def set_subscription_parameters(sender, instance, **kwargs):
     if not instance.pk:
-        swipes = {sender.BASE: 20, sender.VIP: 100, sender.PREMIUM: 2147483647}
-        radius = {sender.BASE: 10, sender.VIP: 25, sender.PREMIUM: 2147483647}
-        instance.swipes_per_day = swipes.get(instance.subscription)
-        instance.search_radius = radius.get(instance.subscription)
+        instance.search_radius = sender.SEARCH_RADIUS.get(instance.subscription)
 
 
 class Location(models.Model):
-    last_location = models.PointField(default=Point(0, 0))
+    last_location = models.PointField(geography=True, default=Point(0, 0))
     last_modified = models.DateTimeField(auto_now=True)
+    # Key of the GEOCELL_SIZE grid cell holding last_location, kept in sync on
+    # save. Queryset updates and bulk writes have to set it themselves.
+    cell = models.BigIntegerField(null=True, db_index=True)
+
+    @property
+    def region(self):
+        return region_for(self.cell)
+
+
+@receiver(pre_save, sender=Location)
+def set_location_cell(sender, instance, **kwargs):
+    instance.cell = geocell(instance.last_location)
 
 
 class Relationship(models.Model):
@@ -126,27 +165,76 @@ class Relationship(models.Model):
     to_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='to_users')
     status = models.PositiveSmallIntegerField(choices=REL_STATUSES)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['from_user', 'to_user'], name='unique_relationship'),
+        ]
+        indexes = [
+            models.Index(fields=['from_user', 'status'], name='relationship_from_status_idx'),
+            models.Index(fields=['to_user', 'status'], name='relationship_to_status_idx'),
+        ]
+
+
+class SeenSet(models.Model):
+    user = models.OneToOneField(User, primary_key=True, on_delete=models.CASCADE, related_name='+')
+    data = models.BinaryField(default=bytes)
+    last_relation_id = models.PositiveIntegerField(default=0)
+
+
+class SwipeCounter(models.Model):
+    user = models.OneToOneField(User, primary_key=True, on_delete=models.CASCADE, related_name='+')
+    day = models.DateField()
+    used = models.PositiveIntegerField(default=0)
+
+
+class ProposalDeck(models.Model):
+    user = models.OneToOneField(User, primary_key=True, on_delete=models.CASCADE, related_name='+')
+    candidates = models.BinaryField(default=bytes)
+    distances = models.BinaryField(default=bytes)
+    needs_refill = models.BooleanField(default=True, db_index=True)
+    generation = models.PositiveIntegerField(default=0)
+    built_at = models.DateTimeField(null=True)
+
 
 @receiver(post_save, sender=Relationship)
+@profiled('create_chat_instance')
 def create_chat_instance(sender, instance, **kwargs):
     user1 = instance.from_user
     user2 = instance.to_user
-    if user1.is_matched(user2):
+    if user1.has_mutual_like(user2) and not user1.is_matched(user2):
         chat = Chat.objects.create()
         chat.participants.add(user1, user2)
 
 
+# A chat is created exactly once per mutual like and doubles as the match record.
 class Chat(models.Model):
-    participants = models.ManyToManyField(User)
+    participants = models.ManyToManyField(User, through='ChatParticipant')
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    last_message = models.ForeignKey(
+        'Message', null=True, on_delete=models.SET_NULL, related_name='+'
+    )
+    last_message_at = models.DateTimeField(null=True, db_index=True)
+    # Messages moved to ChatArchive segments; 0 means the chat is fully hot.
+    archived_count = models.PositiveIntegerField(default=0)
 
     def get_latest_message(self):
-        try:
-            return self.message_set.latest('timestamp')
-        except Message.DoesNotExist:
-            return None
+        return self.last_message
+
+
+class ChatParticipant(models.Model):
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('chat', 'user')
+        indexes = [
+            models.Index(fields=['user', 'chat'], name='chatparticipant_user_chat_idx'),
+        ]
 
 
 @receiver(m2m_changed, sender=Chat.participants.through)
+@profiled('check_chat_participants')
 def check_chat_participants(sender, instance, action='pre_add', **kwargs):
     if instance.participants.count() > 2:
         raise ParticipantsLimitException()
@@ -156,7 +244,81 @@ class Message(models.Model):
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
     sender = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='sender', null=True)
     text = models.CharField(max_length=1000)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)
 
     class Meta:
         ordering = ('timestamp',)
+        indexes = [
+            models.Index(fields=['chat', 'timestamp', 'id']),
+        ]
+
+
+# Messages of idle chats moved out of the message table by `manage.py
+# archive_messages`, as zlib-compressed JSON segments in (timestamp, id) order.
+class ChatArchive(models.Model):
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='archives')
+    first_timestamp = models.DateTimeField()
+    first_message_id = models.IntegerField()
+    last_timestamp = models.DateTimeField()
+    last_message_id = models.IntegerField()
+    message_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat', 'last_timestamp', 'last_message_id'], name='chatarchive_chat_last_idx'),
+        ]
+
+
+# Token index behind message search on databases without full-text search
+# (see tinder_app.search).
+class MessageTerm(models.Model):
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='terms')
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='+')
+    term = models.CharField(max_length=64)
+    count = models.PositiveSmallIntegerField(default=1)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['term', 'chat'], name='messageterm_term_chat_idx'),
+        ]
+
+
+# Search index of archived messages, whose text only lives in the compressed
+# segments: per-message terms for the terms backend and per-message tsvectors
+# for the postgres backend (see tinder_app.search).
+class ArchiveTerm(models.Model):
+    archive = models.ForeignKey(ChatArchive, on_delete=models.CASCADE, related_name='terms')
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='+')
+    message_id = models.IntegerField()
+    term = models.CharField(max_length=64)
+    count = models.PositiveSmallIntegerField(default=1)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['term', 'chat'], name='archiveterm_term_chat_idx'),
+        ]
+
+
+class ArchiveVector(models.Model):
+    archive = models.ForeignKey(ChatArchive, on_delete=models.CASCADE, related_name='vectors')
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='+')
+    message_id = models.IntegerField()
+    vector = SearchVectorField()
+
+
+@receiver(post_save, sender=Message)
+@profiled('update_chat_summary')
+def update_chat_summary(sender, instance, created, **kwargs):
+    if not created:
+        return
+    Chat.objects.filter(
+        Q(last_message_at__isnull=True) | Q(last_message_at__lte=instance.timestamp),
+        id=instance.chat_id,
+    ).update(last_message=instance, last_message_at=instance.timestamp)
+    ChatParticipant.objects.filter(
+        chat_id=instance.chat_id
+    ).exclude(
+        user_id=instance.sender_id
+    ).update(unread_count=F('unread_count') + 1)
@@ -0,0 +1,144 @@
+import base64
+import json
+from collections import OrderedDict
+
+from django.contrib.gis.measure import Distance
+from django.db.models import Q, QuerySet
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    ordering = ('id',)
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+    results_key = 'results'
+    invalid_cursor_message = 'Invalid cursor'
+    # Keep returning a cursor at the end of the list so that polling
+    # clients can ask for items added after it.
+    resumable = False
+    # The queryset is ordered by the ordering fields in descending order.
+    descending = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.position = self.decode_cursor(request)
+        if self.position is not None:
+            queryset = self.seek(queryset, self.position)
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.max_page_size
+            )
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def seek(self, queryset, position):
+        if not isinstance(queryset, QuerySet):
+            return queryset.after(position)
+        key, pk = self.ordering
+        value, pk_value = position
+        lookup = 'lt' if self.descending else 'gt'
+        return queryset.filter(
+            Q(**{'%s__%s' % (key, lookup): value}) | Q(**{key: value, '%s__%s' % (pk, lookup): pk_value})
+        )
+
+    def get_position(self, instance):
+        if isinstance(instance, dict):
+            return tuple(self.encode_value(instance[field]) for field in self.ordering)
+        return tuple(self.encode_value(getattr(instance, field)) for field in self.ordering)
+
+    def encode_value(self, value):
+        return value
+
+    def decode_value(self, value):
+        return value
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            value, pk = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')))
+            return self.decode_value(value), int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, position):
+        encoded = base64.urlsafe_b64encode(json.dumps(position).encode('ascii'))
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            encoded.decode('ascii')
+        )
+
+    def get_next_link(self):
+        if self.page and (self.has_next or self.resumable):
+            return self.encode_cursor(self.get_position(self.page[-1]))
+        if self.resumable:
+            return self.request.build_absolute_uri()
+        return None
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            (self.results_key, data),
+        ]))
+
+
+class DistancePagination(KeysetPagination):
+    ordering = ('distance', 'id')
+
+    def encode_value(self, value):
+        return value.m if isinstance(value, Distance) else value
+
+    def decode_value(self, value):
+        return float(value)
+
+
+class RankPagination(KeysetPagination):
+    ordering = ('rank', 'id')
+
+    def decode_value(self, value):
+        return float(value)
+
+
+class SearchPagination(RankPagination):
+    results_key = 'data'
+
+
+class TimestampPagination(KeysetPagination):
+
+    def encode_value(self, value):
+        return value.isoformat() if hasattr(value, 'isoformat') else value
+
+    def decode_value(self, value):
+        timestamp = parse_datetime(value)
+        if timestamp is None:
+            raise ValueError(value)
+        return timestamp
+
+
+class MessagePagination(TimestampPagination):
+    ordering = ('timestamp', 'id')
+    results_key = 'data'
+    resumable = True
+
+
+class MatchPagination(TimestampPagination):
+    ordering = ('matched_at', 'id')
+    descending = True
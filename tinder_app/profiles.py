@@ -0,0 +1,152 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from tinder_app.images import profile_pic_url
+from tinder_app.models import User, Location
+from tinder_app.profiling import profiled
+from tinder_app.proposals import haversine
+
+PROFILE_FIELDS = (
+    'id', 'username', 'first_name', 'last_name', 'description', 'profile_pic', 'age', 'sex',
+)
+
+
+def load_profile(user_id):
+    row = User.objects.filter(id=user_id).values(
+        *PROFILE_FIELDS, 'profile_pic_hash', 'location__last_location'
+    ).first()
+    if row is None:
+        return None
+    point = row.pop('location__last_location')
+    row['profile_pic'] = profile_pic_url(row['profile_pic'], row.pop('profile_pic_hash'), 'card')
+    return row, (point.x, point.y) if point is not None else None
+
+
+class ProfileCache:
+
+    def __init__(self, max_size=10000, local_timeout=30, shared_alias=None, shared_timeout=3600):
+        self.max_size = max_size
+        self.local_timeout = local_timeout
+        self.shared_alias = shared_alias
+        self.shared_timeout = shared_timeout
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = self.shared_hits = self.misses = self.evictions = 0
+
+    @property
+    def shared(self):
+        return caches[self.shared_alias] if self.shared_alias else None
+
+    def key(self, user_id):
+        return 'profile:%d' % user_id
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+
+        profile = self.shared.get(self.key(user_id)) if self.shared else None
+        if profile is not None:
+            with self._lock:
+                self.shared_hits += 1
+        else:
+            profile = load_profile(user_id)
+            with self._lock:
+                self.misses += 1
+            if profile is None:
+                return None
+            if self.shared:
+                self.shared.set(self.key(user_id), profile, self.shared_timeout)
+        self._store(user_id, profile, now)
+        return profile
+
+    def _store(self, user_id, profile, now):
+        with self._lock:
+            self._entries[user_id] = (now + self.local_timeout, profile)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+        if self.shared:
+            self.shared.delete(self.key(user_id))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.shared_hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+profile_cache = ProfileCache(
+    max_size=settings.PROFILE_CACHE_SIZE,
+    local_timeout=settings.PROFILE_CACHE_LOCAL_TIMEOUT,
+    shared_alias=settings.PROFILE_CACHE or None,
+    shared_timeout=settings.PROFILE_CACHE_TIMEOUT,
+)
+
+
+def render_profile(user_id, viewer, request=None):
+    cached = profile_cache.get(user_id)
+    if cached is None:
+        return None
+    profile, point = cached
+    data = dict(profile)
+    if data['profile_pic'] and request is not None:
+        data['profile_pic'] = request.build_absolute_uri(data['profile_pic'])
+
+    viewer_profile = profile_cache.get(viewer.id)
+    viewer_point = viewer_profile[1] if viewer_profile else None
+    if point is not None and viewer_point is not None:
+        data['distance'] = haversine(*viewer_point, *point)
+    else:
+        data['distance'] = None
+
+    chat_id = viewer.get_chat_ids([user_id]).get(user_id)
+    data['chat'] = {'id': chat_id} if chat_id is not None else {}
+    return data
+
+
+def invalidate_profile(user_id):
+    profile_cache.invalidate(user_id)
+    transaction.on_commit(lambda: profile_cache.invalidate(user_id))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@profiled('invalidate_user_profile')
+def invalidate_user_profile(sender, instance, **kwargs):
+    invalidate_profile(instance.id)
+
+
+@receiver(post_save, sender=Location)
+@profiled('invalidate_location_profile')
+def invalidate_location_profile(sender, instance, created, **kwargs):
+    if created:
+        return
+    for user_id in User.objects.filter(location_id=instance.id).values_list('id', flat=True):
+        invalidate_profile(user_id)
@@ -0,0 +1,227 @@
+import heapq
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+_current = ContextVar('tinder_profile', default=None)
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS_MS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        threshold = self.count * fraction
+        seen = 0
+        for bound, count in zip(BUCKETS_MS + (self.max,), self.counts):
+            seen += count
+            if seen >= threshold:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': self.total / self.count,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+class ViewStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.sampled = 0
+        self.wall_ms = Histogram()
+        self.db_ms = Histogram()
+        self.queries = Histogram()
+        self.serializer_ms = Histogram()
+        self.spans = {}
+        self.slowest = []
+
+    def add(self, profile, slow_queries):
+        self.sampled += 1
+        self.db_ms.observe(profile.db_ms)
+        self.queries.observe(profile.queries)
+        self.serializer_ms.observe(profile.spans.get('serializer', (0, 0, 0.0))[2])
+        for name, (calls, queries, elapsed_ms) in profile.spans.items():
+            total_calls, total_queries, total_ms = self.spans.get(name, (0, 0, 0.0))
+            self.spans[name] = (total_calls + calls, total_queries + queries, total_ms + elapsed_ms)
+        for statement in profile.slowest:
+            if len(self.slowest) < slow_queries:
+                heapq.heappush(self.slowest, statement)
+            else:
+                heapq.heappushpop(self.slowest, statement)
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'sampled': self.sampled,
+            'wall_ms': self.wall_ms.as_dict(),
+            'db_ms': self.db_ms.as_dict(),
+            'queries': self.queries.as_dict(),
+            'serializer_ms': self.serializer_ms.as_dict(),
+            'spans': {
+                name: {'calls': calls, 'queries': queries, 'ms': elapsed_ms}
+                for name, (calls, queries, elapsed_ms) in self.spans.items()
+            },
+            'slowest': [
+                {'ms': elapsed_ms, 'span': span_name, 'sql': sql}
+                for elapsed_ms, span_name, sql in sorted(self.slowest, reverse=True)
+            ],
+        }
+
+
+class RequestProfile:
+
+    def __init__(self, slow_queries):
+        self.slow_queries = slow_queries
+        self.queries = 0
+        self.db_ms = 0.0
+        self.spans = {}
+        self.stack = []
+        self.slowest = []
+
+    def execute(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.queries += 1
+            self.db_ms += elapsed_ms
+            for frame in self.stack:
+                frame[1] += 1
+            statement = (elapsed_ms, self.stack[-1][0] if self.stack else '', sql[:500])
+            if len(self.slowest) < self.slow_queries:
+                heapq.heappush(self.slowest, statement)
+            else:
+                heapq.heappushpop(self.slowest, statement)
+
+
+class Registry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = {}
+
+    def _get(self, name):
+        stats = self._views.get(name)
+        if stats is None:
+            stats = self._views[name] = ViewStats()
+        return stats
+
+    def record(self, name, wall_ms, profile=None):
+        with self._lock:
+            stats = self._get(name)
+            stats.requests += 1
+            stats.wall_ms.observe(wall_ms)
+            if profile is not None:
+                stats.add(profile, settings.PROFILING_SLOW_QUERIES)
+
+    def snapshot(self):
+        with self._lock:
+            return {name: stats.as_dict() for name, stats in sorted(self._views.items())}
+
+    def reset(self):
+        with self._lock:
+            self._views.clear()
+
+
+registry = Registry()
+
+
+class span:
+    __slots__ = ('name', 'profile', 'frame', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.profile = _current.get()
+        if self.profile is None or any(frame[0] == self.name for frame in self.profile.stack):
+            self.profile = None
+            return self
+        self.frame = [self.name, 0]
+        self.profile.stack.append(self.frame)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.profile is None:
+            return
+        elapsed_ms = (time.perf_counter() - self.started) * 1000
+        self.profile.stack.pop()
+        calls, queries, total_ms = self.profile.spans.get(self.name, (0, 0, 0.0))
+        self.profile.spans[self.name] = (calls + 1, queries + self.frame[1], total_ms + elapsed_ms)
+
+
+def profiled(name):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class ProfiledSerializerMixin:
+
+    def to_representation(self, instance):
+        with span('serializer'):
+            return super().to_representation(instance)
+
+
+class ProfilingMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        if random.random() >= settings.PROFILING_SAMPLE_RATE:
+            response = self.get_response(request)
+            registry.record(self.view_name(request), (time.perf_counter() - started) * 1000)
+            return response
+
+        profile = RequestProfile(settings.PROFILING_SLOW_QUERIES)
+        token = _current.set(profile)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(profile.execute))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        registry.record(self.view_name(request), (time.perf_counter() - started) * 1000, profile)
+        return response
+
+    def view_name(self, request):
+        match = getattr(request, 'resolver_match', None)
+        return (match.url_name or match.view_name) if match else 'unresolved'
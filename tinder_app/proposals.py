@@ -0,0 +1,301 @@
+import math
+import threading
+from bisect import bisect_right
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.contrib.gis.db.models.functions import Distance
+from django.contrib.gis.measure import D
+from django.db.models import Exists, F, OuterRef
+from django.db.models.functions import Least
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from tinder_app.geocells import EARTH_RADIUS_KM, Grid, covering_geocells, geocell, region_database
+from tinder_app.models import User, Location, Relationship
+from tinder_app.profiling import profiled
+from tinder_app.seen import get_seen_ids
+
+MAX_SEARCH_RADIUS_KM = math.pi * EARTH_RADIUS_KM
+
+IndexEntry = namedtuple('IndexEntry', (
+    'id', 'sex', 'preferred_sex', 'age', 'preferred_age_min', 'preferred_age_max',
+    'search_radius', 'longitude', 'latitude',
+))
+
+INDEX_FIELDS = (
+    'id', 'sex', 'preferred_sex', 'age', 'preferred_age_min', 'preferred_age_max',
+    'search_radius', 'location__last_location',
+)
+
+
+def haversine(lng1, lat1, lng2, lat2):
+    lng1, lat1, lng2, lat2 = map(math.radians, (lng1, lat1, lng2, lat2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class ExcludedIds:
+    # The user's seen set plus the user, without copying the set.
+    __slots__ = ('seen', 'user_id')
+
+    def __init__(self, seen, user_id):
+        self.seen = seen
+        self.user_id = user_id
+
+    def __contains__(self, user_id):
+        return user_id == self.user_id or user_id in self.seen
+
+
+def get_excluded_ids(user):
+    return ExcludedIds(get_seen_ids(user.id), user.id)
+
+
+def search_radius_km(user):
+    if settings.PROPOSAL_MAX_RADIUS_KM:
+        return min(user.search_radius, settings.PROPOSAL_MAX_RADIUS_KM)
+    return user.search_radius
+
+
+def proposal_queryset(user):
+    # Seen users are excluded with NOT EXISTS against the relationship
+    # indexes, so the query size does not grow with the seen set.
+    current_user_location = user.location.last_location
+    radius_km = search_radius_km(user)
+    proposals = User.objects.using(
+        region_database(geocell(current_user_location))
+    ).filter(
+        ~Exists(Relationship.objects.filter(from_user_id=user.id, to_user_id=OuterRef('id'))),
+        ~Exists(Relationship.objects.filter(
+            from_user_id=OuterRef('id'), to_user_id=user.id, status=Relationship.DISLIKED
+        )),
+        sex=user.sex if user.homo else user.opposite_sex,
+        preferred_sex=user.sex,
+        age__range=(user.preferred_age_min, user.preferred_age_max),
+        preferred_age_min__lte=user.age,
+        preferred_age_max__gte=user.age,
+    ).exclude(id=user.id)
+
+    if radius_km < MAX_SEARCH_RADIUS_KM:
+        cells = covering_geocells(current_user_location, radius_km)
+        if cells is not None:
+            proposals = proposals.filter(location__cell__in=cells)
+        proposals = proposals.filter(
+            location__last_location__dwithin=(current_user_location, D(km=radius_km))
+        )
+
+    return proposals.annotate(
+        radius=Least(radius_km, F('search_radius')),
+        distance=Distance('location__last_location', current_user_location)
+    ).filter(distance__lte=F('radius') * 1000).order_by('distance', 'id')
+
+
+class GeoGridIndex:
+
+    def __init__(self, cell_size=0.1):
+        self.grid = Grid(cell_size)
+        self.loaded = False
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._partitions = defaultdict(lambda: defaultdict(set))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, entry):
+        with self._lock:
+            self._discard(entry.id)
+            if entry.longitude is None or entry.latitude is None:
+                return
+            self._entries[entry.id] = entry
+            cell = self.grid.cell(entry.longitude, entry.latitude)
+            self._partitions[(entry.sex, entry.preferred_sex)][cell].add(entry.id)
+
+    def remove(self, user_id):
+        with self._lock:
+            self._discard(user_id)
+
+    def _discard(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return
+        partition = self._partitions[(entry.sex, entry.preferred_sex)]
+        cell = self.grid.cell(entry.longitude, entry.latitude)
+        partition[cell].discard(user_id)
+        if not partition[cell]:
+            del partition[cell]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._partitions.clear()
+            self.loaded = False
+
+    def query(self, sex, preferred_sex, longitude, latitude, radius_km,
+              age_range, age, exclude=()):
+        age_min, age_max = age_range
+        results = []
+        with self._lock:
+            partition = self._partitions.get((sex, preferred_sex))
+            if not partition:
+                return results
+            cells = self.grid.covering(longitude, latitude, radius_km)
+            if len(cells) > len(partition):
+                buckets = partition.values()
+            else:
+                buckets = (partition[cell] for cell in cells if cell in partition)
+            entries = self._entries
+            for bucket in buckets:
+                for user_id in bucket:
+                    if user_id in exclude:
+                        continue
+                    entry = entries[user_id]
+                    if not (age_min <= entry.age <= age_max):
+                        continue
+                    if not (entry.preferred_age_min <= age <= entry.preferred_age_max):
+                        continue
+                    distance = haversine(longitude, latitude, entry.longitude, entry.latitude)
+                    if distance <= min(radius_km, entry.search_radius):
+                        results.append((distance * 1000, user_id))
+        results.sort()
+        return results
+
+
+def entry_from_row(row):
+    *fields, point = row
+    if point is None:
+        return IndexEntry(*fields, None, None)
+    return IndexEntry(*fields, point.x, point.y)
+
+
+def load_index(geo_index):
+    with geo_index._lock:
+        if geo_index.loaded:
+            return geo_index
+        rows = User.objects.filter(
+            location__isnull=False,
+            sex__isnull=False,
+            age__isnull=False,
+        ).values_list(*INDEX_FIELDS)
+        for row in rows.iterator(chunk_size=5000):
+            geo_index.add(entry_from_row(row))
+        geo_index.loaded = True
+    return geo_index
+
+
+def refresh_user(geo_index, user_id):
+    if not geo_index.loaded:
+        return
+    row = User.objects.filter(
+        id=user_id,
+        location__isnull=False,
+        sex__isnull=False,
+        age__isnull=False,
+    ).values_list(*INDEX_FIELDS).first()
+    if row is None:
+        geo_index.remove(user_id)
+    else:
+        geo_index.add(entry_from_row(row))
+
+
+proposal_index = GeoGridIndex(cell_size=settings.PROPOSAL_INDEX_CELL_SIZE)
+
+
+def fetch_users(queryset, ids):
+    rows = queryset.filter(id__in=ids).order_by() if ids else ()
+    return {row['id'] if isinstance(row, dict) else row.id: row for row in rows}
+
+
+def attach(user, **values):
+    if isinstance(user, dict):
+        user.update(values)
+    else:
+        for name, value in values.items():
+            setattr(user, name, value)
+    return user
+
+
+class CandidateList:
+
+    def __init__(self, candidates, queryset=None, start=0):
+        self.candidates = candidates
+        self.queryset = queryset if queryset is not None else User.objects.all()
+        self.start = start
+
+    def __len__(self):
+        return len(self.candidates) - self.start
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def after(self, position):
+        start = bisect_right(self.candidates, tuple(position), lo=self.start)
+        return CandidateList(self.candidates, self.queryset, start)
+
+    def values(self, *fields):
+        fields = [field for field in fields if field != 'distance']
+        return CandidateList(self.candidates, self.queryset.values(*fields), self.start)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        indexes = range(self.start, len(self.candidates))[key]
+        chunk = self.candidates[indexes.start:indexes.stop:indexes.step]
+        users = fetch_users(self.queryset, [user_id for _, user_id in chunk])
+        page = []
+        for distance, user_id in chunk:
+            user = users.get(user_id)
+            if user is not None:
+                page.append(attach(user, distance=D(m=distance)))
+        return page
+
+
+def indexed_proposals(user, ids_to_exclude):
+    load_index(proposal_index)
+    current_user_location = user.location.last_location
+    candidates = proposal_index.query(
+        sex=user.sex if user.homo else user.opposite_sex,
+        preferred_sex=user.sex,
+        longitude=current_user_location.x,
+        latitude=current_user_location.y,
+        radius_km=search_radius_km(user),
+        age_range=(user.preferred_age_min, user.preferred_age_max),
+        age=user.age,
+        exclude=ids_to_exclude,
+    )
+    return CandidateList(candidates)
+
+
+def build_candidates(user, size):
+    if settings.PROPOSAL_ENGINE == 'index':
+        return indexed_proposals(user, get_excluded_ids(user)).candidates[:size]
+    rows = proposal_queryset(user).values_list('distance', 'id')[:size]
+    return [(getattr(distance, 'm', distance), user_id) for distance, user_id in rows]
+
+
+def get_proposals(user):
+    if settings.PROPOSAL_ENGINE == 'index':
+        return indexed_proposals(user, get_excluded_ids(user))
+    return proposal_queryset(user)
+
+
+@receiver(post_save, sender=User)
+@profiled('index_user')
+def index_user(sender, instance, **kwargs):
+    refresh_user(proposal_index, instance.pk)
+
+
+@receiver(post_save, sender=Location)
+@profiled('index_user_location')
+def index_user_location(sender, instance, **kwargs):
+    if not proposal_index.loaded:
+        return
+    for user_id in User.objects.filter(location=instance).values_list('id', flat=True):
+        refresh_user(proposal_index, user_id)
+
+
+@receiver(post_delete, sender=User)
+@profiled('unindex_user')
+def unindex_user(sender, instance, **kwargs):
+    proposal_index.remove(instance.pk)
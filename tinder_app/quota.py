@@ -0,0 +1,93 @@
+import threading
+
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from tinder_app.models import SwipeCounter, User
+
+LIMIT_FIELDS = {'subscription'}
+
+
+class SwipeQuota:
+
+    def __init__(self, max_exhausted=100000):
+        self.max_exhausted = max_exhausted
+        self._lock = threading.Lock()
+        self._exhausted = {}
+
+    def limit(self, user):
+        return User.SWIPES_PER_DAY.get(user.subscription, User.SWIPES_PER_DAY[User.BASE])
+
+    def is_exhausted(self, user):
+        # The limit is part of the entry, so a worker that has not seen an
+        # upgrade yet stops rejecting once its copy of the user changes.
+        return self._exhausted.get(user.id) == (timezone.localdate(), self.limit(user))
+
+    def used(self, user):
+        used = SwipeCounter.objects.filter(
+            user_id=user.id, day=timezone.localdate()
+        ).values_list('used', flat=True).first()
+        return used or 0
+
+    def remaining(self, user):
+        return max(0, self.limit(user) - self.used(user))
+
+    def consume(self, user, count=1):
+        # The counter row is locked for the rest of the caller's transaction
+        # and rolled back with it, so the limit holds across all workers.
+        day = timezone.localdate()
+        if count < 1 or self.is_exhausted(user):
+            return 0
+        limit = self.limit(user)
+        with transaction.atomic():
+            counter, _ = SwipeCounter.objects.select_for_update().get_or_create(
+                user_id=user.id, defaults={'day': day}
+            )
+            used = counter.used if counter.day == day else 0
+            granted = max(0, min(count, limit - used))
+            if counter.day != day:
+                SwipeCounter.objects.filter(user_id=user.id).update(day=day, used=granted)
+            elif granted:
+                SwipeCounter.objects.filter(user_id=user.id).update(used=F('used') + granted)
+        if used + granted >= limit:
+            self._mark_exhausted(user.id, day, limit)
+        return granted
+
+    def refund(self, user, count=1):
+        if count < 1:
+            return
+        SwipeCounter.objects.filter(user_id=user.id, day=timezone.localdate()).update(
+            used=Greatest(F('used') - count, 0)
+        )
+        self.invalidate(user.id)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._exhausted.pop(user_id, None)
+
+    def _mark_exhausted(self, user_id, day, limit):
+        with self._lock:
+            if len(self._exhausted) >= self.max_exhausted:
+                self._exhausted = {
+                    key: value for key, value in self._exhausted.items() if value[0] == day
+                }
+                if len(self._exhausted) >= self.max_exhausted:
+                    self._exhausted.clear()
+            self._exhausted[user_id] = (day, limit)
+
+    def clear(self):
+        with self._lock:
+            self._exhausted.clear()
+
+
+swipe_quota = SwipeQuota()
+
+
+@receiver(post_save, sender=User)
+def reset_exhausted_quota(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or LIMIT_FIELDS & set(update_fields):
+        swipe_quota.invalidate(instance.id)
@@ -0,0 +1,144 @@
+import math
+
+import numpy as np
+from django.conf import settings
+from django.contrib.gis.measure import D
+from django.db.models import Count
+from django.utils import timezone
+
+from tinder_app.decks import get_deck_candidates
+from tinder_app.models import User, Relationship
+from tinder_app.proposals import attach, build_candidates, fetch_users
+
+FEATURES = ('distance', 'age', 'tier', 'activity', 'popularity')
+ACTIVITY_HALF_LIFE_HOURS = 72
+
+
+def load_features(user, candidates):
+    count = len(candidates)
+    ids = np.fromiter((user_id for _, user_id in candidates), dtype=np.int64, count=count)
+    distances = np.fromiter((distance for distance, _ in candidates), dtype=np.float64, count=count)
+    id_list = ids.tolist()
+
+    rows = {
+        user_id: (age, subscription, last_login)
+        for user_id, age, subscription, last_login in User.objects.filter(
+            id__in=id_list
+        ).values_list('id', 'age', 'subscription', 'last_login')
+    }
+    likes = dict(Relationship.objects.filter(
+        to_user_id__in=id_list, status=Relationship.LIKED
+    ).values_list('to_user_id').annotate(Count('id')).order_by())
+
+    ages = np.full(count, np.nan)
+    tiers = np.full(count, User.BASE, dtype=np.float64)
+    last_seen = np.full(count, np.nan)
+    liked_by = np.zeros(count)
+    for index, user_id in enumerate(id_list):
+        age, subscription, last_login = rows.get(user_id, (None, User.BASE, None))
+        if age is not None:
+            ages[index] = age
+        tiers[index] = subscription
+        if last_login is not None:
+            last_seen[index] = last_login.timestamp()
+        liked_by[index] = likes.get(user_id, 0)
+
+    return ids, distances, {
+        'distance': distances,
+        'age': ages,
+        'tier': tiers,
+        'last_seen': last_seen,
+        'liked_by': liked_by,
+    }
+
+
+def score_candidates(user, features, weights, now):
+    distances = features['distance']
+    scale = min(user.search_radius * 1000.0, distances.max(initial=0.0)) or 1.0
+    target_age = (user.preferred_age_min + user.preferred_age_max) / 2
+    age_span = max(1.0, (user.preferred_age_max - user.preferred_age_min) / 2)
+    hours_idle = (now - features['last_seen']) / 3600
+    max_likes = features['liked_by'].max(initial=0.0)
+    if max_likes:
+        popularity = np.log1p(features['liked_by']) / math.log1p(max_likes)
+    else:
+        popularity = np.zeros_like(distances)
+
+    scores = {
+        'distance': 1 - np.clip(distances / scale, 0, 1),
+        'age': np.nan_to_num(1 - np.clip(np.abs(features['age'] - target_age) / age_span, 0, 1)),
+        'tier': (features['tier'] - User.BASE) / (User.PREMIUM - User.BASE),
+        'activity': np.nan_to_num(np.exp2(-np.clip(hours_idle, 0, None) / ACTIVITY_HALF_LIFE_HOURS)),
+        'popularity': popularity,
+    }
+    total = np.zeros_like(distances)
+    for name in FEATURES:
+        weight = weights.get(name, 0.0)
+        if weight:
+            total += weight * scores[name]
+    return total
+
+
+def top_k(ranks, ids, k):
+    if k <= 0:
+        return np.arange(0)
+    if k >= len(ranks):
+        indexes = np.arange(len(ranks))
+    else:
+        indexes = np.argpartition(ranks, k - 1)[:k]
+    return indexes[np.lexsort((ids[indexes], ranks[indexes]))]
+
+
+class RankedCandidateList:
+
+    def __init__(self, ranks, ids, distances, queryset=None):
+        self.ranks = ranks
+        self.ids = ids
+        self.distances = distances
+        self.queryset = queryset if queryset is not None else User.objects.all()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def after(self, position):
+        rank, pk = position
+        mask = (self.ranks > rank) | ((self.ranks == rank) & (self.ids > pk))
+        return RankedCandidateList(self.ranks[mask], self.ids[mask], self.distances[mask], self.queryset)
+
+    def values(self, *fields):
+        fields = [field for field in fields if field not in ('rank', 'distance')]
+        return RankedCandidateList(self.ranks, self.ids, self.distances, self.queryset.values(*fields))
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        start, stop, step = key.indices(len(self))
+        indexes = top_k(self.ranks, self.ids, stop)[start:stop:step]
+        users = fetch_users(self.queryset, self.ids[indexes].tolist())
+        page = []
+        for index in indexes:
+            user = users.get(int(self.ids[index]))
+            if user is not None:
+                page.append(attach(
+                    user, rank=float(self.ranks[index]), distance=D(m=float(self.distances[index]))
+                ))
+        return page
+
+
+def rank_candidates(user, candidates, weights=None):
+    ids, distances, features = load_features(user, candidates)
+    # Activity decays by the hour, so ranks and the cursors built from them
+    # stay stable while a client pages through the list.
+    now = timezone.now().timestamp() // 3600 * 3600
+    scores = score_candidates(user, features, weights or settings.PROPOSAL_RANKING_WEIGHTS, now)
+    return RankedCandidateList(-scores, ids, distances)
+
+
+def get_ranked_proposals(user):
+    candidates = get_deck_candidates(user) if settings.PROPOSAL_DECKS else None
+    if candidates is None:
+        candidates = build_candidates(user, settings.PROPOSAL_RANKING_POOL)
+    return rank_candidates(user, candidates)
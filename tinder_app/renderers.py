@@ -0,0 +1,33 @@
+import re
+
+from django.conf import settings
+from rest_framework.renderers import JSONRenderer
+
+# orjson formats floats below 1e-4 or from 1e16 differently from json.dumps
+# (0.00005 or 5e16 against 5e-05 and 5e+16). They are rare, so responses
+# containing one are rendered again by JSONRenderer; strings that happen to
+# match only cost the fallback.
+OUT_OF_RANGE_FLOAT = re.compile(rb'[:,\[]-?(?:[0-9]+(?:\.[0-9]+)?e|0\.0000)')
+
+
+class FastJSONRenderer(JSONRenderer):
+    # Produces the same bytes as JSONRenderer for compact output. Dates and
+    # any type orjson does not know are passed to the DRF encoder.
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if not settings.FAST_SERIALIZATION or indent is not None or not self.compact or self.ensure_ascii:
+            return super().render(data, accepted_media_type, renderer_context)
+        # Imported here so that deployments with FAST_SERIALIZATION=0 do not
+        # need orjson installed.
+        import orjson
+
+        ret = orjson.dumps(
+            data, default=self.encoder_class().default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME,
+        )
+        if OUT_OF_RANGE_FLOAT.search(ret):
+            return super().render(data, accepted_media_type, renderer_context)
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
@@ -0,0 +1,34 @@
+from django.conf import settings
+
+from tinder_app.geocells import region_database
+
+
+def region_databases():
+    return {'default'} | {region['database'] for region in settings.GEO_REGIONS}
+
+
+# Region aliases are read-only views of the default database (replicas or
+# per-region partitions). Writes always go to default; proposal queries pick
+# the alias of the searcher's cell with .using().
+class RegionRouter:
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        cell = getattr(instance, 'cell', None)
+        if cell is not None:
+            return region_database(cell)
+        return None
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = region_databases()
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in region_databases() and db != 'default':
+            return False
+        return None
@@ -0,0 +1,133 @@
+import re
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connections, router
+from django.db.models import Count, F, FloatField, Q, Sum, TextField, Value
+from django.db.models.functions import Cast
+from django.db.models.signals import post_migrate, post_save
+from django.dispatch import receiver
+
+from tinder_app.models import ArchiveTerm, ArchiveVector, ChatParticipant, Message, MessageTerm
+from tinder_app.profiling import profiled
+
+TOKEN = re.compile(r'\w+')
+MAX_TERM_LENGTH = MessageTerm._meta.get_field('term').max_length
+SEARCH_INDEX_NAME = 'message_text_search_idx'
+ARCHIVE_INDEX_NAME = 'archive_vector_search_idx'
+
+
+def search_backend(using='default'):
+    backend = settings.MESSAGE_SEARCH_BACKEND
+    if backend == 'auto':
+        return 'postgres' if connections[using].vendor == 'postgresql' else 'terms'
+    return backend
+
+
+def tokenize(text):
+    return [token[:MAX_TERM_LENGTH] for token in TOKEN.findall(text.lower())]
+
+
+def index_messages(messages, batch_size=1000):
+    if search_backend() != 'terms':
+        return 0
+    terms = [
+        MessageTerm(message_id=message.id, chat_id=message.chat_id, term=term, count=count)
+        for message in messages
+        for term, count in Counter(tokenize(message.text)).items()
+    ]
+    MessageTerm.objects.bulk_create(terms, batch_size=batch_size)
+    return len(terms)
+
+
+def search_messages(user, query):
+    messages = Message.objects.filter(
+        chat_id__in=ChatParticipant.objects.filter(user=user.id).values('chat_id')
+    )
+    # Hits are ordered by ascending (rank, id) for keyset pagination, so the
+    # rank is the negated relevance. Cast to double so that cursors round trip.
+    if search_backend() == 'postgres':
+        vector = SearchVector('text', config=settings.MESSAGE_SEARCH_CONFIG)
+        query = SearchQuery(query, config=settings.MESSAGE_SEARCH_CONFIG)
+        return messages.annotate(search=vector).filter(search=query).annotate(
+            rank=Cast(SearchRank(vector, query) * -1, FloatField())
+        ).order_by('rank', 'id')
+
+    terms = set(tokenize(query))
+    return messages.filter(terms__term__in=terms).annotate(
+        matched=Count('terms'),
+        rank=Cast(Sum('terms__count') * -1, FloatField()),
+    ).filter(matched=len(terms)).order_by('rank', 'id')
+
+
+def index_archived_messages(archive_id, chat_id, messages, batch_size=1000):
+    if search_backend() == 'postgres':
+        # The vector is built like the one of search_messages(), so archived
+        # and hot hits are ranked on the same scale.
+        ArchiveVector.objects.bulk_create([
+            ArchiveVector(
+                archive_id=archive_id, chat_id=chat_id, message_id=message.id,
+                vector=SearchVector(Value(message.text, output_field=TextField()), config=settings.MESSAGE_SEARCH_CONFIG),
+            )
+            for message in messages
+        ], batch_size=batch_size)
+        return len(messages)
+    terms = [
+        ArchiveTerm(archive_id=archive_id, chat_id=chat_id, message_id=message.id, term=term, count=count)
+        for message in messages
+        for term, count in Counter(tokenize(message.text)).items()
+    ]
+    ArchiveTerm.objects.bulk_create(terms, batch_size=batch_size)
+    return len(terms)
+
+
+def search_archived_messages(user, query, position=None, limit=20):
+    # (rank, message_id, archive_id) of the first archived hits after
+    # position, in the order of search_messages().
+    chat_ids = ChatParticipant.objects.filter(user=user.id).values('chat_id')
+    if search_backend() == 'postgres':
+        query = SearchQuery(query, config=settings.MESSAGE_SEARCH_CONFIG)
+        hits = ArchiveVector.objects.filter(chat_id__in=chat_ids, vector=query).annotate(
+            rank=Cast(SearchRank(F('vector'), query) * -1, FloatField())
+        )
+    else:
+        terms = set(tokenize(query))
+        hits = ArchiveTerm.objects.filter(chat_id__in=chat_ids, term__in=terms).values(
+            'message_id', 'archive_id'
+        ).annotate(
+            matched=Count('id'),
+            rank=Cast(Sum('count') * -1, FloatField()),
+        ).filter(matched=len(terms))
+    if position is not None:
+        rank, message_id = position
+        hits = hits.filter(Q(rank__gt=rank) | Q(rank=rank, message_id__gt=message_id))
+    return list(hits.order_by('rank', 'message_id').values_list('rank', 'message_id', 'archive_id')[:limit])
+
+
+@receiver(post_save, sender=Message)
+@profiled('index_message')
+def index_message(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        index_messages([instance])
+
+
+# Django 3.1 cannot declare expression indexes, so the GIN index matching
+# the SearchVector in search_messages() is created after migrations, along
+# with the one on archived vectors that only the postgres backend uses.
+@receiver(post_migrate)
+def create_search_index(sender, using='default', **kwargs):
+    if sender.name != 'tinder_app' or not router.allow_migrate_model(using, Message):
+        return
+    if search_backend(using) != 'postgres':
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS %s ON %s USING gin (to_tsvector(%%s::regconfig, COALESCE(%s, '')))" % (
+                SEARCH_INDEX_NAME, Message._meta.db_table, connections[using].ops.quote_name('text'),
+            ),
+            [settings.MESSAGE_SEARCH_CONFIG],
+        )
+        cursor.execute('CREATE INDEX IF NOT EXISTS %s ON %s USING gin (vector)' % (
+            ARCHIVE_INDEX_NAME, ArchiveVector._meta.db_table,
+        ))
@@ -0,0 +1,174 @@
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from itertools import accumulate
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from tinder_app.models import Relationship, SeenSet
+from tinder_app.profiling import profiled
+
+
+def encode_ids(ids):
+    ordered = sorted(ids)
+    deltas = array('I', (b - a for a, b in zip([0] + ordered, ordered)))
+    return zlib.compress(deltas.tobytes())
+
+
+def decode_ids(data):
+    if not data:
+        return set()
+    deltas = array('I')
+    deltas.frombytes(zlib.decompress(bytes(data)))
+    return set(accumulate(deltas))
+
+
+def seen_relations(user_id, after=0):
+    return Relationship.objects.filter(
+        Q(from_user_id=user_id) | Q(to_user_id=user_id, status=Relationship.DISLIKED),
+        id__gt=after,
+    ).values_list('id', 'from_user_id', 'to_user_id')
+
+
+class SeenEntry:
+    __slots__ = ('ids', 'watermark', 'pending', 'checked_at')
+
+    def __init__(self, ids, watermark, pending=0):
+        self.ids = frozenset(ids)
+        self.watermark = watermark
+        self.pending = pending
+        self.checked_at = None
+
+    def add(self, other_ids):
+        added = set(other_ids) - self.ids
+        if added:
+            # Copy on write: readers keep the frozenset they were handed.
+            self.ids = self.ids | added
+            self.pending += len(added)
+
+    def apply(self, user_id, relations):
+        self.add(
+            to_user_id if from_user_id == user_id else from_user_id
+            for _, from_user_id, to_user_id in relations
+        )
+        self.watermark = max([self.watermark] + [relation_id for relation_id, _, _ in relations])
+
+
+class SeenCache:
+    # Entries are mutated under _lock and hand out their current frozenset,
+    # which is replaced rather than changed. The watermark only moves with
+    # rows read back from the database. Relations with a lower id can commit
+    # after a higher one, so every catch-up re-reads rescan_window ids below
+    # it. Catch-ups run at most every catch_up_interval seconds per user.
+
+    def __init__(self, max_users=10000, persist_every=50, rescan_window=10000, catch_up_interval=5):
+        self.max_users = max_users
+        self.persist_every = persist_every
+        self.rescan_window = rescan_window
+        self.catch_up_interval = catch_up_interval
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def catch_up(self, user_id, entry):
+        checked_at = time.monotonic()
+        relations = list(seen_relations(user_id, max(0, entry.watermark - self.rescan_window)))
+        with self._lock:
+            entry.apply(user_id, relations)
+            entry.checked_at = checked_at
+
+    def expire(self, user_id):
+        # The next read catches up with the database.
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                entry.checked_at = None
+
+    def _load(self, user_id):
+        stored = SeenSet.objects.filter(user_id=user_id).values_list('data', 'last_relation_id').first()
+        if stored is None:
+            entry = SeenEntry(set(), 0)
+            self.catch_up(user_id, entry)
+            self.persist(user_id, entry)
+        else:
+            entry = SeenEntry(decode_ids(stored[0]), stored[1])
+            self.catch_up(user_id, entry)
+        return entry
+
+    def _get_entry(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+        if entry is None:
+            entry = self._load(user_id)
+            with self._lock:
+                entry = self._entries.setdefault(user_id, entry)
+                while len(self._entries) > self.max_users:
+                    self._entries.popitem(last=False)
+        elif entry.checked_at is None or time.monotonic() - entry.checked_at >= self.catch_up_interval:
+            self.catch_up(user_id, entry)
+        if entry.pending >= self.persist_every:
+            self.persist(user_id, entry)
+        return entry
+
+    def get(self, user_id):
+        return self._get_entry(user_id).ids
+
+    def record(self, user_id, other_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            entry.add((other_id,))
+            pending = entry.pending
+        if pending >= self.persist_every:
+            self.persist(user_id, entry)
+
+    def persist(self, user_id, entry):
+        with self._lock:
+            ids, watermark = entry.ids, entry.watermark
+            entry.pending = 0
+        data = encode_ids(ids)
+        SeenSet.objects.update_or_create(
+            user_id=user_id,
+            defaults={'data': data, 'last_relation_id': watermark}
+        )
+
+
+seen_cache = SeenCache(
+    max_users=settings.SEEN_CACHE_SIZE,
+    persist_every=settings.SEEN_PERSIST_EVERY,
+    rescan_window=settings.SEEN_RESCAN_WINDOW,
+    catch_up_interval=settings.SEEN_CATCH_UP_INTERVAL,
+)
+
+
+def get_seen_ids(user_id):
+    return seen_cache.get(user_id)
+
+
+def record_relationship(from_user_id, to_user_id, status):
+    seen_cache.record(from_user_id, to_user_id)
+    if status == Relationship.DISLIKED:
+        seen_cache.record(to_user_id, from_user_id)
+
+
+@receiver(post_save, sender=Relationship)
+@profiled('update_seen_sets')
+def update_seen_sets(sender, instance, created, **kwargs):
+    if created:
+        seen_cache.expire(instance.from_user_id)
+        seen_cache.expire(instance.to_user_id)
+        transaction.on_commit(lambda: record_relationship(
+            instance.from_user_id, instance.to_user_id, instance.status
+        ))
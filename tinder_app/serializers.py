@@ -1,7 +1,12 @@
+from django.conf import settings
 from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
 from django.contrib.auth.password_validation import validate_password
+from django.db import transaction
+from django.db.models import Manager
+from tinder_app.images import profile_pic_url, schedule_profile_pic
 from tinder_app.models import User, Chat, Message
+from tinder_app.profiling import ProfiledSerializerMixin
 
 
 class UserRegisterSerializer(serializers.ModelSerializer):
@@ -75,30 +80,54 @@ class UserUpdateSerializer(serializers.ModelSerializer):
         user = self.context['request'].user
         if user.pk != instance.pk:
             raise serializers.ValidationError({"authorize": "You dont have permission for this user."})
+        if 'profile_pic' in validated_data:
+            instance.profile_pic_hash = None
         super().update(instance, validated_data)
+        if 'profile_pic' in validated_data:
+            name = instance.profile_pic.name
+            transaction.on_commit(lambda: schedule_profile_pic(instance.pk, name))
 
         return instance
 
 
-class UserChatSerializer(serializers.ModelSerializer):
+class ProfilePicField(serializers.Field):
 
-    class Meta:
-        model = Chat
-        fields = ('id',)
+    def __init__(self, size, **kwargs):
+        self.size = size
+        kwargs['source'] = '*'
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, instance):
+        url = profile_pic_url(instance.profile_pic.name, instance.profile_pic_hash, self.size)
+        request = self.context.get('request')
+        if url is not None and request is not None:
+            return request.build_absolute_uri(url)
+        return url
+
+
+class UserListSerializer(ProfiledSerializerMixin, serializers.ListSerializer):
+
+    def to_representation(self, data):
+        users = list(data.all() if isinstance(data, Manager) else data)
+        if 'chat_ids' not in self.context:
+            user = self.context['request'].user
+            self.context['chat_ids'] = user.get_chat_ids([instance.id for instance in users])
+        return super().to_representation(users)
 
 
-class UserSerializer(serializers.ModelSerializer):
-    distance = serializers.FloatField(source='distance.km')
+class UserSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
+    profile_pic = ProfilePicField('card')
+    # Matches without a location have no distance; rendered as null.
+    distance = serializers.FloatField(source='distance.km', allow_null=True)
     chat = serializers.SerializerMethodField()
 
     def get_chat(self, instance):
-        user = self.context['request'].user
-        return UserChatSerializer(
-            user.get_chat_id(instance),
-            allow_null=True,
-            read_only=True
-        ).data
-
+        chat_ids = self.context.get('chat_ids')
+        if chat_ids is None:
+            chat_ids = self.context['request'].user.get_chat_ids([instance.id])
+        chat_id = chat_ids.get(instance.id)
+        return {'id': chat_id} if chat_id is not None else {}
 
     class Meta:
         model = User
@@ -106,16 +135,18 @@ class UserSerializer(serializers.ModelSerializer):
             'id', 'username', 'first_name', 'last_name', 'description',
             'profile_pic', 'age', 'sex', 'distance', 'chat'
         )
+        list_serializer_class = UserListSerializer
 
 
 class ChatUserSerializer(serializers.ModelSerializer):
+    profile_pic = ProfilePicField('avatar')
 
     class Meta:
         model = User
         fields = ('id', 'first_name', 'last_name', 'profile_pic')
 
 
-class MessageSerializer(serializers.ModelSerializer):
+class MessageSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
     sender = ChatUserSerializer(read_only=True)
 
     class Meta:
@@ -123,6 +154,29 @@ class MessageSerializer(serializers.ModelSerializer):
         exclude = ('chat',)
 
 
+class MessageSearchSerializer(MessageSerializer):
+
+    class Meta:
+        model = Message
+        fields = ('id', 'chat', 'sender', 'text', 'timestamp')
+
+
+class SwipeSerializer(serializers.Serializer):
+    to_user = serializers.IntegerField()
+    is_liked = serializers.BooleanField()
+
+
+class SwipeBatchSerializer(serializers.Serializer):
+    swipes = SwipeSerializer(many=True, allow_empty=False)
+
+    def validate_swipes(self, value):
+        if len(value) > settings.SWIPE_BATCH_MAX_SIZE:
+            raise serializers.ValidationError(
+                'Cannot apply more than %d swipes at once.' % settings.SWIPE_BATCH_MAX_SIZE
+            )
+        return value
+
+
 class MessagePostSerializer(serializers.ModelSerializer):
     chat = serializers.PrimaryKeyRelatedField(read_only=True)
 
@@ -130,9 +184,10 @@ class MessagePostSerializer(serializers.ModelSerializer):
         model = Message
         fields = ('chat', 'text')
 
-class ChatSerializer(serializers.ModelSerializer):
+class ChatSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
     participants = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
     latest_message = serializers.SerializerMethodField()
+    unread_count = serializers.SerializerMethodField()
 
     def get_latest_message(self, instance):
         return MessageSerializer(
@@ -141,6 +196,9 @@ class ChatSerializer(serializers.ModelSerializer):
             read_only=True
         ).data
 
+    def get_unread_count(self, instance):
+        return getattr(instance, 'unread_count', 0)
+
     class Meta:
         model = Chat
-        fields = '__all__'
\ No newline at end of file
+        fields = ('id', 'participants', 'latest_message', 'unread_count')
\ No newline at end of file
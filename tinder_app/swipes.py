@@ -0,0 +1,116 @@
+from collections import namedtuple
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from tinder_app.models import User, Relationship, Chat, ChatParticipant
+from tinder_app.quota import swipe_quota
+from tinder_app.seen import record_relationship
+
+CREATED, EXISTS, OUT_OF_SWIPES, NOT_FOUND = 'created', 'exists', 'out_of_swipes', 'not_found'
+
+SwipeResult = namedtuple('SwipeResult', ('status', 'relation', 'chat_id'))
+
+# Proposal ranking decays activity by the hour, so last_login is written at
+# most this often.
+ACTIVITY_RESOLUTION = timedelta(hours=1)
+
+
+def create_chats(pairs):
+    chats = Chat.objects.bulk_create([Chat() for _ in pairs])
+    ChatParticipant.objects.bulk_create([
+        ChatParticipant(chat=chat, user_id=user_id)
+        for chat, pair in zip(chats, pairs) for user_id in pair
+    ])
+    return chats
+
+
+def record_relationships(relations):
+    for relation in relations:
+        record_relationship(relation.from_user_id, relation.to_user_id, relation.status)
+
+
+def record_activity(user):
+    now = timezone.now()
+    if user.last_login is None or now - user.last_login >= ACTIVITY_RESOLUTION:
+        User.objects.filter(id=user.id).update(last_login=now)
+        user.last_login = now
+
+
+def swipe(user, to_user_id, status):
+    return swipe_batch(user, [(to_user_id, status)])[0]
+
+
+def swipe_batch(user, swipes):
+    if swipe_quota.is_exhausted(user):
+        return [SwipeResult(OUT_OF_SWIPES, None, None)] * len(swipes)
+    try:
+        with transaction.atomic():
+            return _swipe_batch(user, swipes)
+    except Exception:
+        # The counter update rolled back with the swipes; only the
+        # in-process exhausted mark may be left behind.
+        swipe_quota.invalidate(user.id)
+        raise
+
+
+def _swipe_batch(user, swipes):
+    results = [None] * len(swipes)
+    target_ids = {to_user_id for to_user_id, _ in swipes} - {user.id}
+    # All rows are locked in id order, so concurrent swipes between
+    # the same users are serialized and always see each other's likes.
+    existing_ids = set(
+        User.objects.select_for_update().filter(
+            id__in=target_ids | {user.id}
+        ).order_by('id').values_list('id', flat=True)
+    )
+    existing_ids.discard(user.id)
+    record_activity(user)
+
+    swiped, liked_back = set(), set()
+    for from_user_id, to_user_id, status in Relationship.objects.filter(
+        Q(from_user_id=user.id, to_user_id__in=target_ids) |
+        Q(from_user_id__in=target_ids, to_user_id=user.id)
+    ).values_list('from_user_id', 'to_user_id', 'status'):
+        if from_user_id == user.id:
+            swiped.add(to_user_id)
+        elif status == Relationship.LIKED:
+            liked_back.add(from_user_id)
+
+    new_swipes = []
+    for index, (to_user_id, status) in enumerate(swipes):
+        if to_user_id not in existing_ids:
+            results[index] = SwipeResult(NOT_FOUND, None, None)
+        elif to_user_id in swiped:
+            results[index] = SwipeResult(EXISTS, None, None)
+        else:
+            swiped.add(to_user_id)
+            new_swipes.append((index, to_user_id, status))
+
+    granted = swipe_quota.consume(user, len(new_swipes))
+    created = []
+    for position, (index, to_user_id, status) in enumerate(new_swipes):
+        if position < granted:
+            created.append((index, Relationship(
+                from_user_id=user.id, to_user_id=to_user_id, status=status
+            )))
+        else:
+            results[index] = SwipeResult(OUT_OF_SWIPES, None, None)
+    if not created:
+        return results
+
+    relations = Relationship.objects.bulk_create([relation for _, relation in created])
+
+    matches = [
+        (index, relation) for index, relation in created
+        if relation.status == Relationship.LIKED and relation.to_user_id in liked_back
+    ]
+    chats = create_chats([(user.id, relation.to_user_id) for _, relation in matches])
+    chat_ids = {index: chat.id for (index, _), chat in zip(matches, chats)}
+    for index, relation in created:
+        results[index] = SwipeResult(CREATED, relation, chat_ids.get(index))
+
+    transaction.on_commit(lambda: record_relationships(relations))
+    return results
@@ -1 +1,1361 @@
+import asyncio
+import base64
+import json
+import tempfile
+import threading
+from io import BytesIO, StringIO
+from datetime import timedelta
+from urllib.parse import parse_qs, urlparse
 
+from django.contrib.gis.geos import Point
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from django.db import connection
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from rest_framework.renderers import JSONRenderer
+from asgiref.sync import sync_to_async
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from tinder_app.serializers import ChatUserSerializer
+from tinder_app.archive import archive_chat, restore_chat
+from tinder_app.authentication import build_principal, load_principal
+from tinder_app.broker import LocalBroker, chat_channel, get_broker
+from tinder_app.models import (
+    User, Location, Relationship, SeenSet, Chat, ChatArchive, ChatParticipant, Message, MessageTerm, ProposalDeck,
+    ArchiveTerm, ArchiveVector,
+)
+from tinder_app.exceptions import PrincipalSaveError
+from tinder_app.geocells import Grid, geocell, region_database
+from tinder_app.locations import LocationBuffer
+from tinder_app.images import IMAGE_SIZES, process_profile_pic, render_variants, variant_name
+from tinder_app.history import export_messages, ingest_messages
+from tinder_app.decks import get_deck_proposals, invalidate_deck, refill_decks
+from tinder_app.profiles import ProfileCache, profile_cache
+from tinder_app.profiling import registry
+from tinder_app.quota import swipe_quota
+from tinder_app.search import SEARCH_INDEX_NAME, search_messages
+from tinder_app.renderers import FastJSONRenderer
+from tinder_app.proposals import (
+    GeoGridIndex,
+    IndexEntry,
+    get_excluded_ids,
+    indexed_proposals,
+    load_index,
+    proposal_index,
+    proposal_queryset,
+)
+from tinder_app.ranking import get_ranked_proposals, rank_candidates, top_k
+from tinder_app.seen import decode_ids, encode_ids, get_seen_ids, seen_cache
+from tinder_app.views import poll_chat
+from tinder_app.swipes import swipe, CREATED, EXISTS, OUT_OF_SWIPES
+
+MINSK = (27.56, 53.90)
+
+
+def reset_swipe_quota():
+    swipe_quota.clear()
+
+
+def make_user(username, sex='M', preferred_sex='F', age=25, point=MINSK, **kwargs):
+    location = Location.objects.create(last_location=Point(*point, srid=4326)) if point else None
+    return User.objects.create(
+        username=username,
+        sex=sex,
+        preferred_sex=preferred_sex,
+        age=age,
+        location=location,
+        **kwargs
+    )
+
+
+class ProposalIndexTest(TestCase):
+
+    def setUp(self):
+        proposal_index.clear()
+        self.user = make_user('user', sex='M', preferred_sex='F', age=30)
+        self.near = make_user('near', sex='F', preferred_sex='M', age=28, point=(27.57, 53.91))
+        self.far = make_user('far', sex='F', preferred_sex='M', age=28, point=(30.0, 55.0))
+        self.old = make_user('old', sex='F', preferred_sex='M', age=60, point=(27.56, 53.90))
+        self.picky = make_user(
+            'picky', sex='F', preferred_sex='M', age=28, point=(27.58, 53.90),
+            preferred_age_max=25
+        )
+        self.homo = make_user('homo', sex='F', preferred_sex='F', age=28, point=(27.56, 53.90))
+        self.next_door = make_user('next_door', sex='F', preferred_sex='M', age=31, point=(27.561, 53.901))
+
+    def tearDown(self):
+        proposal_index.clear()
+
+    def assertMatchesReference(self, user):
+        ids_to_exclude = get_excluded_ids(user)
+        reference = list(proposal_queryset(user).values_list('id', flat=True))
+        indexed = [proposal.id for proposal in indexed_proposals(user, ids_to_exclude)]
+        self.assertEqual(indexed, reference)
+        return indexed
+
+    def test_matches_orm_reference(self):
+        ids = self.assertMatchesReference(self.user)
+        self.assertEqual(ids, [self.next_door.id, self.near.id])
+
+    def test_excludes_swiped_users(self):
+        Relationship.objects.create(from_user=self.user, to_user=self.near, status=Relationship.LIKED)
+        Relationship.objects.create(from_user=self.next_door, to_user=self.user, status=Relationship.DISLIKED)
+        self.assertEqual(self.assertMatchesReference(self.user), [])
+
+    def test_location_save_updates_index(self):
+        load_index(proposal_index)
+        self.far.location.last_location = Point(27.562, 53.902, srid=4326)
+        self.far.location.save()
+        self.assertEqual(
+            self.assertMatchesReference(self.user),
+            [self.next_door.id, self.far.id, self.near.id]
+        )
+
+    def test_distance_is_attached(self):
+        proposals = indexed_proposals(self.user, get_excluded_ids(self.user))
+        self.assertLess(proposals[0].distance.km, 1)
+
+    def test_moving_entry_changes_cell(self):
+        index = GeoGridIndex(cell_size=0.1)
+        index.add(IndexEntry(1, 'F', 'M', 28, 25, 35, 50, 27.56, 53.90))
+        index.add(IndexEntry(1, 'F', 'M', 28, 25, 35, 50, 30.0, 55.0))
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.query('F', 'M', 27.56, 53.90, 10, (25, 35), 30), [])
+        self.assertEqual([user_id for _, user_id in index.query('F', 'M', 30.0, 55.0, 10, (25, 35), 30)], [1])
+
+        index.remove(1)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index._partitions[('F', 'M')], {})
+
+    def test_grid_wraps_antimeridian(self):
+        grid = Grid(cell_size=1)
+        cells = grid.covering(179.9, 0, 50)
+        columns = {column for _, column in cells}
+        self.assertIn(0, columns)
+        self.assertIn(grid.columns - 1, columns)
+
+
+class SeenSetTest(TestCase):
+
+    def setUp(self):
+        seen_cache.clear()
+        self.user = make_user('user')
+        self.liked = make_user('liked', sex='F', preferred_sex='M')
+        self.disliker = make_user('disliker', sex='F', preferred_sex='M')
+
+    def tearDown(self):
+        seen_cache.clear()
+
+    def test_encoding_round_trip(self):
+        ids = {1, 2, 3, 70000, 4000000000}
+        self.assertEqual(decode_ids(encode_ids(ids)), ids)
+        self.assertEqual(decode_ids(b''), set())
+
+    def test_tracks_swipes_incrementally(self):
+        self.assertEqual(get_seen_ids(self.user.id), set())
+        Relationship.objects.create(from_user=self.user, to_user=self.liked, status=Relationship.LIKED)
+        Relationship.objects.create(from_user=self.disliker, to_user=self.user, status=Relationship.DISLIKED)
+        Relationship.objects.create(from_user=self.liked, to_user=self.user, status=Relationship.LIKED)
+        self.assertEqual(get_seen_ids(self.user.id), {self.liked.id, self.disliker.id})
+
+    def test_restores_from_persisted_form(self):
+        Relationship.objects.create(from_user=self.user, to_user=self.liked, status=Relationship.LIKED)
+        get_seen_ids(self.user.id)
+        seen_cache.clear()
+        Relationship.objects.create(from_user=self.user, to_user=self.disliker, status=Relationship.DISLIKED)
+        stored = SeenSet.objects.get(user=self.user)
+        self.assertEqual(decode_ids(stored.data), {self.liked.id})
+        self.assertEqual(get_seen_ids(self.user.id), {self.liked.id, self.disliker.id})
+
+    def test_relations_committed_out_of_order(self):
+        other = make_user('other', sex='F', preferred_sex='M')
+        Relationship.objects.create(from_user=self.user, to_user=self.liked, status=Relationship.LIKED)
+        gap = Relationship.objects.create(from_user=self.user, to_user=other, status=Relationship.LIKED)
+        Relationship.objects.create(from_user=self.user, to_user=self.disliker, status=Relationship.LIKED)
+        gap_id = gap.id
+        gap.delete()
+        self.assertEqual(get_seen_ids(self.user.id), {self.liked.id, self.disliker.id})
+        # Another worker's swipe commits with an id below the watermark and
+        # is read once the catch-up interval has passed.
+        Relationship.objects.bulk_create([
+            Relationship(id=gap_id, from_user=other, to_user=self.user, status=Relationship.DISLIKED)
+        ])
+        self.assertNotIn(other.id, get_seen_ids(self.user.id))
+        seen_cache.expire(self.user.id)
+        self.assertIn(other.id, get_seen_ids(self.user.id))
+        seen_cache.persist(self.user.id, seen_cache._get_entry(self.user.id))
+        seen_cache.clear()
+        self.assertIn(other.id, get_seen_ids(self.user.id))
+
+    def test_returns_a_snapshot(self):
+        seen = get_seen_ids(self.user.id)
+        self.assertIs(get_seen_ids(self.user.id), seen)
+        Relationship.objects.create(from_user=self.user, to_user=self.liked, status=Relationship.LIKED)
+        self.assertEqual(seen, set())
+        self.assertEqual(get_seen_ids(self.user.id), {self.liked.id})
+        self.assertIsInstance(get_seen_ids(self.user.id), frozenset)
+
+    def test_reads_within_interval_skip_the_database(self):
+        get_seen_ids(self.user.id)
+        with self.assertNumQueries(0):
+            get_seen_ids(self.user.id)
+
+    def test_proposal_query_does_not_grow_with_seen_set(self):
+        def params():
+            return len(proposal_queryset(self.user).query.sql_with_params()[1])
+
+        before = params()
+        Relationship.objects.create(from_user=self.user, to_user=self.liked, status=Relationship.LIKED)
+        Relationship.objects.create(from_user=self.disliker, to_user=self.user, status=Relationship.DISLIKED)
+        self.assertEqual(params(), before)
+        self.assertEqual(list(proposal_queryset(self.user)), [])
+
+
+class KeysetPaginationTest(TestCase):
+
+    def setUp(self):
+        seen_cache.clear()
+        self.user = make_user('user', age=30)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def collect(self, url, key):
+        ids, next_url = [], None
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(item['id'] for item in response.data[key])
+            next_url = response.data['next']
+            url = next_url if response.data[key] else None
+        return ids, next_url
+
+    def test_proposals_pages_follow_distance_order(self):
+        candidates = [
+            make_user('candidate%d' % i, sex='F', preferred_sex='M', age=30, point=(27.56 + i * 0.001, 53.90))
+            for i in range(7)
+        ]
+        ids, _ = self.collect('/api/proposals/?limit=3', 'results')
+        self.assertEqual(ids, [candidate.id for candidate in candidates])
+
+    @override_settings(PROPOSAL_RANKING=1)
+    def test_ranked_proposals_pages_follow_score_order(self):
+        candidates = [
+            make_user('candidate%d' % i, sex='F', preferred_sex='M', age=30, point=(27.56 + i * 0.001, 53.90))
+            for i in range(7)
+        ]
+        ids, _ = self.collect('/api/proposals/?limit=3', 'results')
+        self.assertEqual(sorted(ids), sorted(candidate.id for candidate in candidates))
+        self.assertEqual(ids, [user.id for user in get_ranked_proposals(self.user)[:7]])
+
+    def test_messages_since_cursor(self):
+        other = make_user('other', sex='F', preferred_sex='M')
+        chat = Chat.objects.create()
+        chat.participants.add(self.user, other)
+        sent = [Message.objects.create(chat=chat, sender=other, text=str(i)).id for i in range(5)]
+        ids, since = self.collect('/api/chat/%d/?limit=2' % chat.id, 'data')
+        self.assertEqual(ids, sent)
+        new_message = Message.objects.create(chat=chat, sender=other, text='new')
+        response = self.client.get(since)
+        self.assertEqual([item['id'] for item in response.data['data']], [new_message.id])
+
+
+class ChatLookupQueryCountTest(TestCase):
+
+    def setUp(self):
+        seen_cache.clear()
+        self.user = make_user('user', age=30)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.count = 0
+
+    def add_matches(self, count):
+        for _ in range(count):
+            self.count += 1
+            other = make_user('other%d' % self.count, sex='F', preferred_sex='M', age=30, point=(27.561, 53.90))
+            Relationship.objects.create(from_user=self.user, to_user=other, status=Relationship.LIKED)
+            Relationship.objects.create(from_user=other, to_user=self.user, status=Relationship.LIKED)
+
+    def add_proposals(self, count):
+        for _ in range(count):
+            self.count += 1
+            make_user('other%d' % self.count, sex='F', preferred_sex='M', age=30, point=(27.561, 53.90))
+
+    def count_queries(self, url, key='results'):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(response.data[key]), len(context.captured_queries)
+
+    def test_matched_page_cost_is_constant(self):
+        self.add_matches(2)
+        small_page, small_queries = self.count_queries('/api/matched/')
+        self.add_matches(8)
+        large_page, large_queries = self.count_queries('/api/matched/')
+        self.assertEqual((small_page, large_page), (2, 10))
+        self.assertEqual(small_queries, large_queries)
+
+    def test_proposals_page_cost_is_constant(self):
+        self.add_proposals(2)
+        self.count_queries('/api/proposals/')
+        small_page, small_queries = self.count_queries('/api/proposals/')
+        self.add_proposals(8)
+        large_page, large_queries = self.count_queries('/api/proposals/')
+        self.assertEqual((small_page, large_page), (2, 10))
+        self.assertEqual(small_queries, large_queries)
+
+    def test_detail_reports_chat(self):
+        self.add_matches(1)
+        other = User.objects.get(username='other1')
+        chat = Chat.objects.get(participants=other)
+        response = self.client.get('/api/user/%d/' % other.id)
+        self.assertEqual(response.data['chat'], {'id': chat.id})
+
+
+class ChatInboxTest(TestCase):
+
+    def setUp(self):
+        self.user = make_user('user')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.count = 0
+
+    def add_chat(self, messages=1):
+        self.count += 1
+        other = make_user('other%d' % self.count, sex='F', preferred_sex='M')
+        chat = Chat.objects.create()
+        chat.participants.add(self.user, other)
+        for i in range(messages):
+            Message.objects.create(chat=chat, sender=other, text=str(i))
+        return chat
+
+    def test_inbox_is_sorted_and_counts_unread(self):
+        first = self.add_chat(messages=3)
+        self.add_chat(messages=0)
+        second = self.add_chat(messages=1)
+        Message.objects.create(chat=second, sender=self.user, text='reply')
+        response = self.client.get('/api/chat/')
+        data = response.data['data']
+        self.assertEqual([chat['id'] for chat in data], [second.id, first.id])
+        self.assertEqual([chat['unread_count'] for chat in data], [1, 3])
+        self.assertEqual(data[0]['latest_message']['text'], 'reply')
+
+        self.client.get('/api/chat/%d/' % first.id)
+        response = self.client.get('/api/chat/')
+        self.assertEqual([chat['unread_count'] for chat in response.data['data']], [1, 0])
+
+    def test_inbox_cost_is_constant(self):
+        self.add_chat(messages=2)
+        with CaptureQueriesContext(connection) as small:
+            self.client.get('/api/chat/')
+        for _ in range(5):
+            self.add_chat(messages=3)
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get('/api/chat/')
+        self.assertEqual(len(response.data['data']), 6)
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+
+
+class ConcurrentSwipeTest(TransactionTestCase):
+
+    def setUp(self):
+        seen_cache.clear()
+        reset_swipe_quota()
+
+    def run_in_pool(self, calls):
+        def run(call):
+            try:
+                return call()
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            return list(pool.map(run, calls))
+
+    def test_swipe_quota_is_not_leaked(self):
+        user = make_user('user')
+        targets = [make_user('target%d' % i, sex='F', preferred_sex='M') for i in range(30)]
+        results = self.run_in_pool([
+            lambda target=target: swipe(user, target.id, Relationship.LIKED).status for target in targets
+        ])
+        self.assertEqual(results.count(CREATED), 20)
+        self.assertEqual(results.count(OUT_OF_SWIPES), 10)
+        self.assertEqual(Relationship.objects.filter(from_user=user).count(), 20)
+        self.assertEqual(swipe_quota.remaining(user), 0)
+
+    def test_duplicate_swipes_create_one_relation(self):
+        user = make_user('user')
+        target = make_user('target', sex='F', preferred_sex='M')
+        results = self.run_in_pool([
+            lambda: swipe(user, target.id, Relationship.LIKED).status for _ in range(10)
+        ])
+        self.assertEqual(results.count(CREATED), 1)
+        self.assertEqual(results.count(EXISTS), 9)
+        self.assertEqual(swipe_quota.remaining(user), 19)
+
+    def test_mutual_likes_create_one_chat(self):
+        pairs = [
+            (make_user('a%d' % i), make_user('b%d' % i, sex='F', preferred_sex='M'))
+            for i in range(10)
+        ]
+        calls = []
+        for a, b in pairs:
+            calls.append(lambda a=a, b=b: swipe(a, b.id, Relationship.LIKED))
+            calls.append(lambda a=a, b=b: swipe(b, a.id, Relationship.LIKED))
+        results = self.run_in_pool(calls)
+        self.assertEqual(sum(1 for result in results if result.chat_id), 10)
+        for a, b in pairs:
+            self.assertEqual(Chat.objects.filter(participants=a).filter(participants=b).count(), 1)
+
+
+class SwipeBatchTest(TestCase):
+
+    def setUp(self):
+        seen_cache.clear()
+        reset_swipe_quota()
+        self.user = make_user('user')
+        swipe_quota.consume(self.user, 17)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_batch_applies_quota_and_reports_matches(self):
+        fan = make_user('fan', sex='F', preferred_sex='M')
+        Relationship.objects.create(from_user=fan, to_user=self.user, status=Relationship.LIKED)
+        others = [make_user('other%d' % i, sex='F', preferred_sex='M') for i in range(3)]
+        response = self.client.post('/api/swipe/batch/', [
+            {'to_user': fan.id, 'is_liked': True},
+            {'to_user': others[0].id, 'is_liked': False},
+            {'to_user': fan.id, 'is_liked': True},
+            {'to_user': 0, 'is_liked': True},
+            {'to_user': others[1].id, 'is_liked': True},
+            {'to_user': others[2].id, 'is_liked': True},
+        ], format='json')
+        self.assertEqual(response.status_code, 200)
+        statuses = [item['status'] for item in response.data['data']]
+        self.assertEqual(statuses, ['created', 'created', 'exists', 'not_found', 'created', 'out_of_swipes'])
+        chat = Chat.objects.get(participants=fan)
+        self.assertEqual(response.data['data'][0]['chat'], chat.id)
+        self.assertIsNone(response.data['data'][1]['chat'])
+        self.assertEqual(swipe_quota.remaining(self.user), 0)
+        self.assertEqual(Relationship.objects.filter(from_user=self.user).count(), 3)
+
+    def test_empty_batch_is_rejected(self):
+        response = self.client.post('/api/swipe/batch/', [], format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class ProposalDeckTest(TestCase):
+
+    def setUp(self):
+        seen_cache.clear()
+        self.user = make_user('user', age=30)
+        self.candidates = [
+            make_user('candidate%d' % i, sex='F', preferred_sex='M', age=30, point=(27.56 + i * 0.001, 53.90))
+            for i in range(4)
+        ]
+
+    def deck_ids(self):
+        return [proposal.id for proposal in get_deck_proposals(self.user)]
+
+    def test_deck_is_built_by_worker_and_served(self):
+        expected = [candidate.id for candidate in self.candidates]
+        self.assertEqual(self.deck_ids(), expected)
+        self.assertTrue(ProposalDeck.objects.get(user=self.user).needs_refill)
+        self.assertEqual(refill_decks(), 1)
+        self.assertFalse(ProposalDeck.objects.get(user=self.user).needs_refill)
+
+        far = self.candidates[-1]
+        Location.objects.filter(id=far.location_id).update(last_location=Point(40, 40, srid=4326))
+        self.assertEqual(self.deck_ids(), expected)
+
+        Relationship.objects.create(from_user=self.user, to_user=self.candidates[0], status=Relationship.LIKED)
+        self.assertEqual(self.deck_ids(), expected[1:])
+
+    def test_invalidated_deck_is_not_served(self):
+        self.deck_ids()
+        refill_decks()
+        invalidate_deck(self.user.id)
+        deck = ProposalDeck.objects.get(user=self.user)
+        self.assertTrue(deck.needs_refill)
+        self.assertEqual(bytes(deck.candidates), b'')
+        self.assertEqual(self.deck_ids(), [candidate.id for candidate in self.candidates])
+
+    def move_candidates(self, point):
+        for location in Location.objects.filter(id__in=[candidate.location_id for candidate in self.candidates]):
+            location.last_location = Point(*point, srid=4326)
+            location.save()
+
+    def test_empty_deck_is_refilled(self):
+        self.move_candidates((40, 40))
+        self.assertEqual(self.deck_ids(), [])
+        refill_decks()
+        self.assertFalse(ProposalDeck.objects.get(user=self.user).needs_refill)
+        self.move_candidates(MINSK)
+        self.deck_ids()
+        self.assertTrue(ProposalDeck.objects.get(user=self.user).needs_refill)
+        refill_decks()
+        self.assertEqual(len(self.deck_ids()), 4)
+
+
+class ProfilingMiddlewareTest(TestCase):
+
+    def setUp(self):
+        registry.reset()
+        self.user = make_user('user')
+        self.other = make_user('other', sex='F', preferred_sex='M')
+        self.chat = Chat.objects.create()
+        self.chat.participants.add(self.user, self.other)
+
+    def tearDown(self):
+        registry.reset()
+
+    @override_settings(
+        MIDDLEWARE=['tinder_app.profiling.ProfilingMiddleware'] + settings.MIDDLEWARE,
+        PROFILING_SAMPLE_RATE=1,
+    )
+    def test_records_views_and_signal_spans(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        client.post('/api/chat/', {'chat': self.chat.id, 'text': 'hi'})
+        client.get('/api/chat/')
+        stats = registry.snapshot()
+        self.assertEqual(stats['chat-list']['requests'], 2)
+        self.assertEqual(stats['chat-list']['sampled'], 2)
+        self.assertEqual(stats['chat-list']['spans']['update_chat_summary']['queries'], 2)
+        self.assertGreater(stats['chat-list']['spans']['serializer']['calls'], 0)
+        self.assertTrue(stats['chat-list']['slowest'])
+
+
+class SwipeQuotaTest(TestCase):
+
+    def setUp(self):
+        reset_swipe_quota()
+        self.user = make_user('user', subscription=User.VIP)
+
+    def test_limit_comes_from_subscription(self):
+        self.assertEqual(swipe_quota.consume(self.user, 150), 100)
+        self.assertEqual(swipe_quota.remaining(self.user), 0)
+        self.assertTrue(swipe_quota.is_exhausted(self.user))
+
+    def test_rejected_swipe_does_not_hit_database(self):
+        swipe_quota.consume(self.user, 100)
+        target = make_user('target', sex='F', preferred_sex='M')
+        with self.assertNumQueries(0):
+            result = swipe(self.user, target.id, Relationship.LIKED)
+        self.assertEqual(result.status, OUT_OF_SWIPES)
+
+    def test_upgrade_reopens_quota(self):
+        swipe_quota.consume(self.user, 100)
+        self.user.subscription = User.PREMIUM
+        self.user.save(update_fields=['subscription'])
+        self.assertFalse(swipe_quota.is_exhausted(self.user))
+        self.assertEqual(swipe_quota.consume(self.user, 5), 5)
+
+    def test_stale_exhausted_mark_ignores_new_limit(self):
+        swipe_quota.consume(self.user, 100)
+        User.objects.filter(id=self.user.id).update(subscription=User.PREMIUM)
+        self.user.refresh_from_db()
+        self.assertFalse(swipe_quota.is_exhausted(self.user))
+
+    def test_counter_is_shared_through_database(self):
+        swipe_quota.consume(self.user, 60)
+        swipe_quota.clear()
+        self.assertEqual(swipe_quota.consume(self.user, 60), 40)
+
+    def test_refund_reopens_quota(self):
+        swipe_quota.consume(self.user, 100)
+        swipe_quota.refund(self.user, 2)
+        self.assertEqual(swipe_quota.remaining(self.user), 2)
+        self.assertFalse(swipe_quota.is_exhausted(self.user))
+
+
+class QueryPlanTest(TestCase):
+
+    def setUp(self):
+        self.user = make_user('user', sex='M', preferred_sex='F', age=30, search_radius=10)
+        for index in range(20):
+            make_user('candidate%d' % index, sex='F', preferred_sex='M', age=28, point=(27.56 + index / 100, 53.90))
+
+    def explain(self, queryset):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        return queryset.explain()
+
+    def test_proposals_use_spatial_index(self):
+        plan = self.explain(proposal_queryset(self.user))
+        self.assertIn('tinder_app_location_last_location_id', plan)
+
+    def test_premium_radius_is_capped(self):
+        self.user.search_radius = User.SEARCH_RADIUS[User.PREMIUM]
+        sql = str(proposal_queryset(self.user).query)
+        self.assertIn('ST_DWithin', sql)
+        with override_settings(PROPOSAL_MAX_RADIUS_KM=0):
+            sql = str(proposal_queryset(self.user).query)
+        self.assertNotIn('ST_DWithin', sql)
+
+    def test_user_filters_use_composite_index(self):
+        plan = self.explain(User.objects.filter(sex='F', preferred_sex='M', age__range=(20, 30)))
+        self.assertIn('user_proposal_idx', plan)
+
+    def test_relationship_status_lookups_use_composite_index(self):
+        plan = self.explain(Relationship.objects.filter(from_user=self.user, status=Relationship.LIKED))
+        self.assertIn('relationship_from_status_idx', plan)
+        plan = self.explain(Relationship.objects.filter(to_user=self.user, status=Relationship.LIKED))
+        self.assertIn('relationship_to_status_idx', plan)
+
+
+class ProfileCacheTest(TestCase):
+
+    def setUp(self):
+        profile_cache.clear()
+        self.user = make_user('user')
+        self.other = make_user('other', sex='F', preferred_sex='M', point=(27.57, 53.91), description='hi')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def tearDown(self):
+        profile_cache.clear()
+
+    def test_matches_serializer_output(self):
+        response = self.client.get('/api/user/%d/' % self.other.id)
+        self.assertEqual(list(response.data), [
+            'id', 'username', 'first_name', 'last_name', 'description',
+            'profile_pic', 'age', 'sex', 'distance', 'chat'
+        ])
+        self.assertEqual(response.data['description'], 'hi')
+        self.assertAlmostEqual(response.data['distance'], 1.3, delta=0.1)
+        self.assertEqual(response.data['chat'], {})
+        self.assertEqual(self.client.get('/api/user/0/').status_code, 404)
+
+    def test_repeated_views_hit_cache(self):
+        self.client.get('/api/user/%d/' % self.other.id)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/user/%d/' % self.other.id)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(profile_cache.stats()['hits'], 2)
+
+    def test_invalidated_by_user_and_location_saves(self):
+        self.client.get('/api/user/%d/' % self.other.id)
+        self.other.description = 'changed'
+        self.other.save()
+        self.assertEqual(self.client.get('/api/user/%d/' % self.other.id).data['description'], 'changed')
+
+        self.other.location.last_location = Point(27.56, 53.90, srid=4326)
+        self.other.location.save()
+        self.assertAlmostEqual(self.client.get('/api/user/%d/' % self.other.id).data['distance'], 0)
+
+    def test_size_is_capped(self):
+        cache = ProfileCache(max_size=1)
+        cache.get(self.user.id)
+        cache.get(self.other.id)
+        self.assertEqual(cache.stats()['size'], 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+class ChatPollTest(TestCase):
+
+    def setUp(self):
+        self.user = make_user('user')
+        self.other = make_user('other', sex='F', preferred_sex='M')
+        self.chat = Chat.objects.create()
+        self.chat.participants.add(self.user, self.other)
+        self.first = Message.objects.create(chat=self.chat, sender=self.other, text='first')
+        self.token = str(AccessToken.for_user(self.user))
+
+    def cursor(self, message):
+        position = [message.timestamp.isoformat(), message.id]
+        return base64.urlsafe_b64encode(json.dumps(position).encode('ascii')).decode('ascii')
+
+    def poll_request(self, timeout, cursor=None, token=None):
+        params = {'timeout': timeout}
+        if cursor is not None:
+            params['cursor'] = cursor
+        return RequestFactory().get(
+            '/api/chat/%d/poll/' % self.chat.id, params,
+            HTTP_AUTHORIZATION='Bearer %s' % (token or self.token),
+        )
+
+    def test_local_broker_delivers_across_threads(self):
+        broker = LocalBroker()
+
+        async def run():
+            async with broker.subscribe('a') as first, broker.subscribe('a') as second, \
+                    broker.subscribe('b') as third:
+                threading.Thread(target=broker.publish, args=('a', 1)).start()
+                return await first.wait(1), await second.wait(1), await third.wait(0.05)
+
+        self.assertEqual(asyncio.run(run()), ([1], [1], []))
+        self.assertEqual(broker.subscribers('a'), 0)
+
+    async def test_returns_pending_messages_immediately(self):
+        before = await sync_to_async(Message.objects.create)(
+            chat=self.chat, sender=self.other, text='zeroth', timestamp=self.first.timestamp - timedelta(minutes=1)
+        )
+        response = await poll_chat(self.poll_request(timeout=5, cursor=self.cursor(before)), self.chat.id)
+        data = json.loads(response.content)
+        self.assertEqual([message['text'] for message in data['data']], ['first'])
+        self.assertTrue(data['next'])
+
+    async def test_poll_without_cursor_waits_after_last_message(self):
+        response = await poll_chat(self.poll_request(timeout=0.05), self.chat.id)
+        data = json.loads(response.content)
+        self.assertEqual(data['data'], [])
+        self.assertEqual(parse_qs(urlparse(data['next']).query)['cursor'], [self.cursor(self.first)])
+
+        poll = asyncio.ensure_future(poll_chat(self.poll_request(timeout=5), self.chat.id))
+        while get_broker().subscribers(chat_channel(self.chat.id)) < 1:
+            await asyncio.sleep(0.01)
+        message = await sync_to_async(Message.objects.create)(chat=self.chat, sender=self.other, text='second')
+        get_broker().publish(chat_channel(self.chat.id), message.id)
+        response = await asyncio.wait_for(poll, 5)
+        self.assertEqual([item['text'] for item in json.loads(response.content)['data']], ['second'])
+
+    async def test_times_out_without_new_messages(self):
+        response = await poll_chat(self.poll_request(timeout=0.05, cursor=self.cursor(self.first)), self.chat.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['data'], [])
+
+    async def test_rejects_non_participants(self):
+        stranger = await sync_to_async(make_user)('stranger')
+        token = str(AccessToken.for_user(stranger))
+        response = await poll_chat(self.poll_request(timeout=0, token=token), self.chat.id)
+        self.assertEqual(response.status_code, 403)
+
+    async def test_wakes_many_concurrent_polls(self):
+        cursor = self.cursor(self.first)
+        polls = [
+            asyncio.ensure_future(poll_chat(self.poll_request(timeout=5, cursor=cursor), self.chat.id))
+            for _ in range(200)
+        ]
+        while get_broker().subscribers(chat_channel(self.chat.id)) < len(polls):
+            await asyncio.sleep(0.01)
+
+        message = await sync_to_async(Message.objects.create)(chat=self.chat, sender=self.other, text='second')
+        get_broker().publish(chat_channel(self.chat.id), message.id)
+        responses = await asyncio.wait_for(asyncio.gather(*polls), 5)
+        for response in responses:
+            self.assertEqual([item['text'] for item in json.loads(response.content)['data']], ['second'])
+
+
+class ChatHistoryTest(TestCase):
+
+    def setUp(self):
+        self.user = make_user('user')
+        self.other = make_user('other', sex='F', preferred_sex='M')
+        self.chat = Chat.objects.create()
+        self.chat.participants.add(self.user, self.other)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_export_streams_ndjson(self):
+        for index in range(5):
+            Message.objects.create(chat=self.chat, sender=self.other, text='message %d' % index)
+        response = self.client.get('/api/chat/%d/export/' % self.chat.id)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['text'] for line in lines], ['message %d' % i for i in range(5)])
+        self.assertEqual(len(list(export_messages(self.chat.id, chunk_size=2))), 3)
+
+    def test_ingest_keeps_chat_summary(self):
+        Message.objects.create(chat=self.chat, sender=self.user, text='live')
+        now = timezone.now()
+        imported = [
+            Message(chat=self.chat, sender=self.other, text='old', timestamp=now - timedelta(days=2)),
+            Message(chat=self.chat, sender=self.user, text='new', timestamp=now + timedelta(minutes=1)),
+            Message(chat=self.chat, sender=self.other, text='newest', timestamp=now + timedelta(minutes=2)),
+        ]
+        self.assertEqual(ingest_messages(imported, batch_size=2), 3)
+
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message.text, 'newest')
+        unread = dict(ChatParticipant.objects.filter(chat=self.chat).values_list('user_id', 'unread_count'))
+        self.assertEqual(unread, {self.user.id: 2, self.other.id: 2})
+        self.assertEqual(Message.objects.get(text='old').timestamp, now - timedelta(days=2))
+
+
+class RankingTest(TestCase):
+
+    def setUp(self):
+        self.user = make_user('user', age=30, preferred_age_min=25, preferred_age_max=35)
+        self.near = make_user('near', sex='F', preferred_sex='M', age=30)
+        self.active = make_user(
+            'active', sex='F', preferred_sex='M', age=30,
+            subscription=User.PREMIUM, last_login=timezone.now(),
+        )
+        self.candidates = [(100.0, self.near.id), (5000.0, self.active.id)]
+
+    def test_top_k_matches_full_sort(self):
+        rng = np.random.default_rng(0)
+        ranks = rng.integers(0, 50, 1000).astype(np.float64)
+        ids = np.arange(1000)
+        expected = np.lexsort((ids, ranks))[:25]
+        self.assertEqual(top_k(ranks, ids, 25).tolist(), expected.tolist())
+        self.assertEqual(top_k(ranks, ids, 5000).tolist(), np.lexsort((ids, ranks)).tolist())
+        self.assertEqual(top_k(ranks, ids, 0).tolist(), [])
+
+    def test_weights_change_order(self):
+        by_distance = rank_candidates(self.user, self.candidates, {'distance': 1.0})
+        self.assertEqual([user.id for user in by_distance], [self.near.id, self.active.id])
+        by_activity = rank_candidates(self.user, self.candidates, {'distance': 0.1, 'activity': 1.0, 'tier': 1.0})
+        self.assertEqual([user.id for user in by_activity], [self.active.id, self.near.id])
+        self.assertEqual(by_activity[0].distance.m, 5000.0)
+
+    def test_after_skips_ranked_prefix(self):
+        ranked = rank_candidates(self.user, self.candidates, {'distance': 1.0})
+        first = ranked[0]
+        self.assertEqual([user.id for user in ranked.after((first.rank, first.id))], [self.active.id])
+
+    def test_swiping_user_outranks_idle_one(self):
+        idle = make_user('idle', sex='F', preferred_sex='M', age=30)
+        busy = make_user('busy', sex='F', preferred_sex='M', age=30)
+        swipe(busy, self.user.id, Relationship.LIKED)
+        ranked = rank_candidates(self.user, [(100.0, idle.id), (100.0, busy.id)], {'activity': 1.0})
+        self.assertEqual([user.id for user in ranked], [busy.id, idle.id])
+
+    def test_login_records_activity(self):
+        self.user.set_password('secret')
+        self.user.save()
+        response = APIClient().post('/api/login/', {'username': 'user', 'password': 'secret'})
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertIsNotNone(self.user.last_login)
+
+
+class MatchRecordTest(TestCase):
+
+    def setUp(self):
+        self.user = make_user('user')
+        self.other = make_user('other', sex='F', preferred_sex='M')
+
+    def test_chat_is_created_once_per_mutual_like(self):
+        Relationship.objects.create(from_user=self.user, to_user=self.other, status=Relationship.LIKED)
+        self.assertFalse(self.user.is_matched(self.other))
+        relation = Relationship.objects.create(from_user=self.other, to_user=self.user, status=Relationship.LIKED)
+        relation.save()
+        self.assertTrue(self.user.is_matched(self.other))
+        self.assertTrue(self.other.is_matched(self.user))
+        self.assertEqual(Chat.objects.filter(participants=self.user).count(), 1)
+        self.assertEqual(list(self.user.get_matched_list()), [self.other])
+
+    def test_matched_list_is_ordered_by_match_time(self):
+        later = make_user('later', sex='F', preferred_sex='M')
+        for other in (self.other, later):
+            Relationship.objects.create(from_user=self.user, to_user=other, status=Relationship.LIKED)
+            Relationship.objects.create(from_user=other, to_user=self.user, status=Relationship.LIKED)
+        self.assertEqual(list(self.user.get_matched_list()), [later, self.other])
+
+    def test_matched_pages_follow_match_time(self):
+        others = [self.other] + [make_user('other%d' % i, sex='F', preferred_sex='M') for i in range(4)]
+        for other in others:
+            Relationship.objects.create(from_user=self.user, to_user=other, status=Relationship.LIKED)
+            Relationship.objects.create(from_user=other, to_user=self.user, status=Relationship.LIKED)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        for fast in (0, 1):
+            with override_settings(FAST_SERIALIZATION=fast):
+                url, ids = '/api/matched/?limit=2', []
+                while url:
+                    response = client.get(url)
+                    ids.extend(user['id'] for user in response.data['results'])
+                    url = response.data['next']
+                self.assertEqual(ids, [other.id for other in reversed(others)])
+
+    def test_backfill_creates_missing_chats(self):
+        Relationship.objects.bulk_create([
+            Relationship(from_user=self.user, to_user=self.other, status=Relationship.LIKED),
+            Relationship(from_user=self.other, to_user=self.user, status=Relationship.LIKED),
+        ])
+        self.assertFalse(self.user.is_matched(self.other))
+        call_command('backfill_matches', stdout=StringIO())
+        call_command('backfill_matches', stdout=StringIO())
+        self.assertTrue(self.user.is_matched(self.other))
+        self.assertEqual(Chat.objects.count(), 1)
+
+
+class CachedAuthenticationTest(TestCase):
+
+    def setUp(self):
+        caches[settings.AUTH_PRINCIPAL_CACHE].clear()
+        self.user = make_user('user', description='x' * 2000)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer %s' % AccessToken.for_user(self.user))
+
+    def tearDown(self):
+        caches[settings.AUTH_PRINCIPAL_CACHE].clear()
+
+    def test_principal_is_cached_with_location(self):
+        with CaptureQueriesContext(connection) as cold:
+            self.client.get('/api/proposals/')
+        with CaptureQueriesContext(connection) as warm:
+            self.assertEqual(self.client.get('/api/proposals/').status_code, 200)
+        self.assertEqual(len(warm), len(cold) - 1)
+        self.assertNotIn('"tinder_app_user"."description"', cold.captured_queries[0]['sql'])
+
+    def test_invalidated_by_user_and_location_saves(self):
+        self.client.get('/api/proposals/')
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/proposals/').status_code, 401)
+
+        self.user.is_active = True
+        self.user.save()
+        self.client.get('/api/proposals/')
+        location = self.user.location
+        location.last_location = Point(30, 50, srid=4326)
+        location.save()
+        response = self.client.post('/api/location/', {'longitude': 1, 'latitude': 1})
+        self.assertEqual(response.status_code, 403)
+        principal = caches[settings.AUTH_PRINCIPAL_CACHE].get('principal:%d' % self.user.id)
+        self.assertEqual(principal[1][:2], (30, 50))
+
+    def test_set_radius_keeps_changes_made_after_caching(self):
+        User.objects.filter(id=self.user.id).update(subscription=User.PREMIUM)
+        self.client.get('/api/proposals/')
+        # Another worker bans the user without this process seeing it.
+        User.objects.filter(id=self.user.id).update(is_active=False, age=40)
+        self.assertEqual(self.client.patch('/api/set_radius/', {'radius': 50}).status_code, 204)
+        user = User.objects.get(id=self.user.id)
+        self.assertEqual((user.search_radius, user.is_active, user.age), (50, False, 40))
+
+    def test_principal_full_save_is_refused(self):
+        principal = build_principal(*load_principal(self.user.id))
+        with self.assertRaises(PrincipalSaveError):
+            principal.save()
+        principal.search_radius = 7
+        principal.save(update_fields=['search_radius'])
+        self.assertEqual(User.objects.get(id=self.user.id).search_radius, 7)
+
+
+class GeocellTest(TestCase):
+
+    def test_cell_is_computed_on_save(self):
+        user = make_user('user')
+        self.assertEqual(user.location.cell, geocell(Point(*MINSK, srid=4326)))
+        user.location.last_location = Point(2.35, 48.85, srid=4326)
+        user.location.save()
+        self.assertEqual(Location.objects.get(id=user.location_id).cell, geocell(Point(2.35, 48.85, srid=4326)))
+
+    def test_proposals_filter_by_covering_cells(self):
+        user = make_user('user', search_radius=10)
+        near = make_user('near', sex='F', preferred_sex='M', point=(27.60, 53.92))
+        make_user('far', sex='F', preferred_sex='M', point=(2.35, 48.85))
+        proposals = proposal_queryset(user)
+        self.assertIn('"cell" IN', str(proposals.query))
+        self.assertEqual(list(proposals), [near])
+
+    @override_settings(GEO_REGIONS=[{'name': 'eu-east', 'database': 'default', 'bbox': [20, 40, 40, 60]}])
+    def test_region_lookup(self):
+        cell = geocell(Point(*MINSK, srid=4326))
+        self.assertEqual(Location(cell=cell).region['name'], 'eu-east')
+        self.assertEqual(region_database(cell), 'default')
+        self.assertIsNone(Location(cell=geocell(Point(2.35, 48.85, srid=4326))).region)
+
+
+class LocationBufferTest(TestCase):
+
+    def setUp(self):
+        self.buffer = LocationBuffer(write_behind=True, flush_size=100)
+        self.buffer._ensure_thread = lambda: True
+        self.user = make_user('user', point=None)
+        self.moved = make_user('moved')
+        Location.objects.filter(id=self.moved.location_id).update(
+            last_modified=timezone.now() - timedelta(hours=3)
+        )
+        self.moved.refresh_from_db()
+        self.moved.location.refresh_from_db()
+
+    def test_coalesces_and_flushes_in_bulk(self):
+        self.assertTrue(self.buffer.submit(self.user, 27.5, 53.9))
+        self.assertTrue(self.buffer.submit(self.moved, 2.35, 48.85))
+        self.assertFalse(self.buffer.submit(self.moved, 3.0, 49.0))
+        self.assertEqual(self.buffer.pending(), 2)
+        self.assertIsNone(User.objects.get(id=self.user.id).location_id)
+
+        self.assertEqual(self.buffer.flush(), 2)
+        user = User.objects.select_related('location').get(id=self.user.id)
+        self.assertEqual(user.location.last_location.coords, (27.5, 53.9))
+        self.assertEqual(user.location.cell, geocell(user.location.last_location))
+        moved = Location.objects.get(id=self.moved.location_id)
+        self.assertEqual(moved.last_location.coords, (2.35, 48.85))
+        self.assertEqual(moved.cell, geocell(moved.last_location))
+
+    def test_last_write_wins_until_flush(self):
+        self.buffer.update_interval = timedelta(0)
+        self.buffer.submit(self.user, 1, 1)
+        self.buffer.submit(self.user, 2, 2)
+        self.assertEqual(self.buffer.pending(), 1)
+        self.buffer.flush()
+        self.assertEqual(User.objects.get(id=self.user.id).location.last_location.coords, (2, 2))
+
+    def test_flush_sends_post_save(self):
+        profile_cache.clear()
+        profile_cache.get(self.moved.id)
+        self.buffer.submit(self.moved, 2.35, 48.85)
+        self.buffer.flush()
+        self.assertEqual(profile_cache.get(self.moved.id)[1], (2.35, 48.85))
+        profile_cache.clear()
+
+    def test_stale_principal_does_not_reset_interval(self):
+        Location.objects.filter(id=self.moved.location_id).update(last_modified=timezone.now())
+        self.assertFalse(self.buffer.submit(self.moved, 2.35, 48.85))
+
+    def test_lost_link_race_updates_existing_location(self):
+        self.buffer.submit(self.user, 27.5, 53.9)
+        location = Location.objects.create(last_location=Point(1, 1, srid=4326))
+        User.objects.filter(id=self.user.id).update(location=location)
+        self.buffer.flush()
+        self.assertEqual(User.objects.get(id=self.user.id).location_id, location.id)
+        location.refresh_from_db()
+        self.assertEqual(location.last_location.coords, (27.5, 53.9))
+        self.assertEqual(Location.objects.count(), 2)
+
+    def test_synchronous_fallback(self):
+        buffer = LocationBuffer(write_behind=False)
+        self.assertTrue(buffer.submit(self.moved, 2.35, 48.85))
+        self.assertEqual(buffer.pending(), 0)
+        self.assertEqual(Location.objects.get(id=self.moved.location_id).last_location.coords, (2.35, 48.85))
+
+
+def make_jpeg(size=(1200, 800)):
+    output = BytesIO()
+    Image.new('RGB', size, (200, 80, 40)).save(output, 'JPEG')
+    return output.getvalue()
+
+
+class ProfilePicVariantTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        self.storage = FileSystemStorage(location=self.media_root.name)
+
+    def test_renders_each_size_once(self):
+        data = make_jpeg()
+        digest = render_variants(data, self.storage)
+        for size, (box, crop) in IMAGE_SIZES.items():
+            with Image.open(self.storage.path(variant_name(digest, size))) as image:
+                if crop:
+                    self.assertEqual(image.size, box)
+                else:
+                    self.assertLessEqual(image.width, box[0])
+                    self.assertLessEqual(image.height, box[1])
+        self.assertEqual(render_variants(data, self.storage), digest)
+        self.assertEqual(len(self.storage.listdir('avatars/card/%s' % digest[:2])[1]), 1)
+
+    def test_serializers_fall_back_to_original(self):
+        user = make_user('user')
+        with override_settings(MEDIA_ROOT=self.media_root.name):
+            user.profile_pic.save('original.jpg', ContentFile(make_jpeg()), save=True)
+            self.assertTrue(ChatUserSerializer(user).data['profile_pic'].endswith('/original.jpg'))
+
+            digest = process_profile_pic(user.id, user.profile_pic.name)
+            user.refresh_from_db()
+            self.assertEqual(user.profile_pic_hash, digest)
+            self.assertEqual(
+                ChatUserSerializer(user).data['profile_pic'], settings.MEDIA_URL + variant_name(digest, 'avatar')
+            )
+
+
+class FastSerializationTest(TestCase):
+
+    def setUp(self):
+        seen_cache.clear()
+        self.user = make_user('user', age=30)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.candidates = [
+            make_user(
+                'candidate%d' % i, sex='F', preferred_sex='M', age=30, point=(27.56 + i * 0.001, 53.90),
+                first_name='Ганна', description='line\u2028break "quoted" %d' % i,
+            )
+            for i in range(5)
+        ]
+        self.candidates[0].profile_pic = 'avatars/original.jpg'
+        self.candidates[0].save()
+        self.candidates[1].profile_pic = 'avatars/original.jpg'
+        self.candidates[1].profile_pic_hash = 'ab' * 32
+        self.candidates[1].save()
+        self.chat = Chat.objects.create()
+        self.chat.participants.add(self.user, self.candidates[0])
+        Message.objects.create(chat=self.chat, sender=self.candidates[0], text='привет')
+        Message.objects.create(chat=self.chat, sender=None, text='deleted sender')
+
+    def assertSameContent(self, url):
+        with override_settings(FAST_SERIALIZATION=0):
+            expected = self.client.get(url)
+        with override_settings(FAST_SERIALIZATION=1):
+            actual = self.client.get(url)
+        self.assertEqual(expected.status_code, 200)
+        self.assertEqual(actual.status_code, 200)
+        self.assertEqual(actual.content, expected.content)
+        return actual
+
+    def test_proposals(self):
+        response = self.assertSameContent('/api/proposals/?limit=3')
+        self.assertSameContent(response.json()['next'])
+
+    @override_settings(PROPOSAL_ENGINE='index')
+    def test_indexed_proposals(self):
+        proposal_index.clear()
+        self.assertSameContent('/api/proposals/?limit=3')
+
+    @override_settings(PROPOSAL_RANKING=1)
+    def test_ranked_proposals(self):
+        response = self.assertSameContent('/api/proposals/?limit=3')
+        self.assertSameContent(response.json()['next'])
+
+    def test_matched(self):
+        self.assertSameContent('/api/matched/')
+
+    def test_matched_without_location(self):
+        nowhere = make_user('nowhere', sex='F', preferred_sex='M', point=None)
+        Chat.objects.create().participants.add(self.user, nowhere)
+        response = self.assertSameContent('/api/matched/')
+        self.assertIsNone(response.json()['results'][0]['distance'])
+
+    def test_chat_history(self):
+        response = self.assertSameContent('/api/chat/%d/?limit=1' % self.chat.id)
+        self.assertSameContent(response.json()['next'])
+
+    def test_planned_queries_skip_unused_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/proposals/')
+        proposals_sql = [query['sql'] for query in queries.captured_queries if '"sex"' in query['sql']]
+        self.assertTrue(proposals_sql)
+        self.assertNotIn('"password"', proposals_sql[-1])
+
+    def test_renderer_matches_json_renderer(self):
+        data = {
+            'floats': [0.0, 1.5, 0.1 + 0.2, 0.00005, 1e-9, 5e16, 1e300],
+            'text': 'é\u2028\u2029 "<>" 12e5, :1e5',
+            'when': timezone.now(),
+            1: None,
+        }
+        for value in [data] + [{'value': value} for value in data['floats']]:
+            self.assertEqual(FastJSONRenderer().render(value), JSONRenderer().render(value))
+
+
+class MessageSearchTest(TestCase):
+
+    def setUp(self):
+        self.user = make_user('user')
+        self.other = make_user('other', sex='F', preferred_sex='M')
+        self.stranger = make_user('stranger', sex='F', preferred_sex='M')
+        self.chat = Chat.objects.create()
+        self.chat.participants.add(self.user, self.other)
+        self.foreign = Chat.objects.create()
+        self.foreign.participants.add(self.other, self.stranger)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def send(self, chat, text):
+        return Message.objects.create(chat=chat, sender=self.other, text=text)
+
+    def check_search(self):
+        once = self.send(self.chat, 'Dinner on Friday?')
+        twice = self.send(self.chat, 'dinner, dinner and more dinner')
+        self.send(self.chat, 'See you on Saturday')
+        self.send(self.foreign, 'dinner with somebody else')
+
+        response = self.client.get('/api/chat/search/?q=DINNER&limit=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['data'][0]['id'], twice.id)
+        self.assertEqual(response.data['data'][0]['chat'], self.chat.id)
+        response = self.client.get(response.data['next'])
+        self.assertEqual([hit['id'] for hit in response.data['data']], [once.id])
+        self.assertIsNone(response.data['next'])
+
+        self.assertEqual(list(search_messages(self.user, 'friday dinner')), [once])
+        self.assertEqual(self.client.get('/api/chat/search/?q=!!').status_code, 400)
+
+    def test_full_text_search(self):
+        self.check_search()
+        self.assertFalse(MessageTerm.objects.exists())
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Message._meta.db_table)
+        self.assertIn(SEARCH_INDEX_NAME, constraints)
+
+    @override_settings(MESSAGE_SEARCH_BACKEND='terms')
+    def test_term_index_search(self):
+        self.check_search()
+        self.assertEqual(
+            set(MessageTerm.objects.filter(chat=self.chat, term='dinner').values_list('count', flat=True)), {1, 3}
+        )
+
+    @override_settings(MESSAGE_SEARCH_BACKEND='terms')
+    def test_ingested_messages_are_indexed(self):
+        ingest_messages([Message(chat=self.chat, sender=self.other, text='picnic tomorrow')])
+        self.assertEqual([message.text for message in search_messages(self.user, 'picnic')], ['picnic tomorrow'])
+
+
+class ChatArchiveTest(TestCase):
+
+    def setUp(self):
+        self.user = make_user('user')
+        self.other = make_user('other', sex='F', preferred_sex='M')
+        self.chat = Chat.objects.create()
+        self.chat.participants.add(self.user, self.other)
+        started = timezone.now() - timedelta(days=60)
+        self.sent = [
+            Message.objects.create(
+                chat=self.chat, sender=[self.user, self.other][i % 2], text='message %d' % i,
+                timestamp=started + timedelta(minutes=i),
+            ).id
+            for i in range(7)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def pages(self, limit=2):
+        url, pages = '/api/chat/%d/?limit=%d' % (self.chat.id, limit), []
+        while True:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.content)
+            if not response.data['data']:
+                return pages
+            url = response.data['next']
+
+    def test_command_archives_idle_chats(self):
+        call_command('archive_messages', segment_size=4, stdout=StringIO())
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.archived_count, 6)
+        self.assertEqual(list(Message.objects.filter(chat=self.chat).values_list('id', flat=True)), self.sent[-1:])
+        self.assertEqual(list(ChatArchive.objects.order_by('id').values_list('message_count', flat=True)), [4, 2])
+        self.assertEqual(self.chat.last_message_id, self.sent[-1])
+
+        call_command('archive_messages', stdout=StringIO())
+        self.assertEqual(ChatArchive.objects.count(), 2)
+
+    def test_retrieve_reads_both_tiers(self):
+        for fast in (0, 1):
+            with override_settings(FAST_SERIALIZATION=fast):
+                before = self.pages()
+                archive_chat(self.chat.id, segment_size=3)
+                self.assertEqual(self.pages(), before)
+                restore_chat(self.chat.id)
+
+    def test_new_messages_follow_archived_ones(self):
+        archive_chat(self.chat.id, segment_size=3)
+        new = Message.objects.create(chat=self.chat, sender=self.other, text='back again')
+        ids = []
+        for page in self.pages(limit=4):
+            ids.extend(message['id'] for message in json.loads(page)['data'])
+        self.assertEqual(ids, self.sent + [new.id])
+        lines = ''.join(export_messages(self.chat.id, chunk_size=3)).splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], self.sent + [new.id])
+
+    def test_restore(self):
+        archive_chat(self.chat.id, segment_size=3)
+        self.other.delete()
+        self.assertEqual(restore_chat(self.chat.id), 6)
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.archived_count, 0)
+        self.assertFalse(ChatArchive.objects.exists())
+        messages = Message.objects.filter(chat=self.chat).order_by('timestamp', 'id')
+        self.assertEqual([message.id for message in messages], self.sent)
+        self.assertEqual({message.sender_id for message in messages}, {self.user.id, None})
+
+    def check_archived_search(self):
+        url, ids = '/api/chat/search/?q=message&limit=4', []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(hit['id'] for hit in response.data['data'])
+            url = response.data['next']
+        self.assertEqual(ids, self.sent)
+        response = self.client.get('/api/chat/search/?q=message+3')
+        self.assertEqual([hit['id'] for hit in response.data['data']], [self.sent[3]])
+        self.assertEqual(response.data['data'][0]['sender']['id'], self.other.id)
+
+    def test_search_finds_archived_messages(self):
+        archive_chat(self.chat.id, segment_size=3)
+        self.assertEqual(ArchiveVector.objects.count(), 6)
+        self.assertFalse(ArchiveTerm.objects.exists())
+        self.check_archived_search()
+
+    def test_search_page_decodes_only_its_segments(self):
+        Message.objects.filter(id=self.sent[4]).update(text='message message')
+        archive_chat(self.chat.id, segment_size=2)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/chat/search/?q=message&limit=1')
+        self.assertEqual([hit['id'] for hit in response.data['data']], [self.sent[4]])
+        segment_reads = [
+            query for query in context.captured_queries if '"data"' in query['sql'] and 'chatarchive' in query['sql']
+        ]
+        self.assertEqual(len(segment_reads), 1)
+
+    @override_settings(MESSAGE_SEARCH_BACKEND='terms')
+    def test_term_search_finds_archived_messages(self):
+        archive_chat(self.chat.id, segment_size=3)
+        ArchiveTerm.objects.all().delete()
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.check_archived_search()
+
+
+class GenerateUsersTest(TestCase):
+
+    def generate(self):
+        call_command(
+            'generate_users', 40, seed='fixed', batch_size=100, min_swipes=10, match_rate=0.5,
+            silent_chat_rate=0, stdout=StringIO(),
+        )
+        return (
+            sorted(User.objects.values_list('username', flat=True)),
+            sorted(Relationship.objects.values_list('from_user__username', 'to_user__username', 'status')),
+        )
+
+    def test_seed_reproduces_data(self):
+        users, relations = self.generate()
+        self.assertEqual(len(set(users)), 40)
+        self.assertTrue(relations)
+        for chat in Chat.objects.filter(last_message__isnull=False):
+            first = Message.objects.filter(chat=chat).order_by('timestamp').first()
+            self.assertLessEqual(chat.created_at, first.timestamp)
+            self.assertEqual(chat.last_message_at, Message.objects.filter(chat=chat).latest('timestamp').timestamp)
+        self.assertTrue(Chat.objects.filter(last_message__isnull=False).exists())
+
+        Chat.objects.all().delete()
+        User.objects.all().delete()
+        Location.objects.all().delete()
+        self.assertEqual(self.generate(), (users, relations))
+
+
+class BackfillChatsTest(TestCase):
+
+    def test_copies_legacy_participants_and_summaries(self):
+        user = make_user('user')
+        other = make_user('other', sex='F', preferred_sex='M')
+        chat = Chat.objects.create()
+        now = timezone.now()
+        for minutes, sender in enumerate([other, user, other, other]):
+            Message.objects.bulk_create([Message(
+                chat=chat, sender=sender, text=str(minutes), timestamp=now + timedelta(minutes=minutes)
+            )])
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE tinder_app_chat_participants (chat_id integer, user_id integer)')
+            cursor.execute(
+                'INSERT INTO tinder_app_chat_participants VALUES (%s, %s), (%s, %s)',
+                [chat.id, user.id, chat.id, other.id],
+            )
+
+        call_command('backfill_chats', stdout=StringIO())
+        chat.refresh_from_db()
+        self.assertEqual(chat.last_message.text, '3')
+        self.assertEqual(chat.last_message_at, now + timedelta(minutes=3))
+        unread = dict(ChatParticipant.objects.filter(chat=chat).values_list('user_id', 'unread_count'))
+        self.assertEqual(unread, {user.id: 2, other.id: 0})
+
+        call_command('backfill_chats', stdout=StringIO())
+        self.assertEqual(ChatParticipant.objects.filter(chat=chat).count(), 2)
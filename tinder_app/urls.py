@@ -14,22 +14,28 @@ from .views import (
     ProposalsListView,
     MatchedListView,
     SwipeView,
-    ChatViewSet
+    SwipeBatchView,
+    ChatViewSet,
+    ProfileStatsView,
+    poll_chat,
 )
 
 router = DefaultRouter()
 router.register('chat', ChatViewSet, basename='chat')
 
 urlpatterns = router.urls + [
-    path('login/', TokenObtainPairView.as_view()),
-    path('login/refresh/', TokenRefreshView.as_view()),
-    path('register/', CreateUserView.as_view()),
-    path('change_password/<int:pk>/', ChangePasswordView.as_view()),
-    path('update_user_info/<int:pk>/', UpdateUserView.as_view()),
-    path('location/', CurrentUserLocationView.as_view()),
-    path('set_radius/', SetRadiusView.as_view()),
-    path('user/<int:pk>/', UserDetailView.as_view()),
-    path('proposals/', ProposalsListView.as_view()),
-    path('matched/', MatchedListView.as_view()),
-    path('swipe/<int:pk>/', SwipeView.as_view())
+    path('login/', TokenObtainPairView.as_view(), name='login'),
+    path('login/refresh/', TokenRefreshView.as_view(), name='login-refresh'),
+    path('register/', CreateUserView.as_view(), name='register'),
+    path('change_password/<int:pk>/', ChangePasswordView.as_view(), name='change-password'),
+    path('update_user_info/<int:pk>/', UpdateUserView.as_view(), name='update-user'),
+    path('location/', CurrentUserLocationView.as_view(), name='location'),
+    path('set_radius/', SetRadiusView.as_view(), name='set-radius'),
+    path('user/<int:pk>/', UserDetailView.as_view(), name='user-detail'),
+    path('proposals/', ProposalsListView.as_view(), name='proposals'),
+    path('matched/', MatchedListView.as_view(), name='matched'),
+    path('swipe/<int:pk>/', SwipeView.as_view(), name='swipe'),
+    path('swipe/batch/', SwipeBatchView.as_view(), name='swipe-batch'),
+    path('chat/<int:pk>/poll/', poll_chat, name='chat-poll'),
+    path('internal/profile/', ProfileStatsView.as_view(), name='profile-stats')
 ]
@@ -1,28 +1,47 @@
-import datetime
-from itertools import chain
+import asyncio
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.gis.db.models.functions import Distance
-from django.contrib.gis.geos import Point
-from django.db.models import F, Max
-from django.db.models.functions import Least
+from django.db.models import F, Prefetch
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from rest_framework.exceptions import APIException, NotAuthenticated, NotFound, PermissionDenied
 from rest_framework.generics import get_object_or_404
+from rest_framework.request import Request
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework import generics
 from rest_framework import views
 from rest_framework import status
 from rest_framework import viewsets
-
-from tinder_app.models import User, Location, Chat, Message
-from tinder_app.exceptions import ParticipantsLimitException
+from rest_framework.decorators import action
+from rest_framework.settings import api_settings
+
+from tinder_app.models import User, Relationship, Chat, ChatParticipant
+from tinder_app.archive import chat_messages, search_history
+from tinder_app.broker import chat_channel, get_broker
+from tinder_app.decks import get_deck_proposals, invalidate_deck
+from tinder_app.history import export_messages
+from tinder_app.locations import location_buffer
+from tinder_app.pagination import (
+    DistancePagination, MatchPagination, MessagePagination, RankPagination, SearchPagination,
+)
+from tinder_app.plans import MESSAGE_PLAN, USER_PLAN, render_messages, render_users
+from tinder_app.profiles import profile_cache, render_profile
+from tinder_app.profiling import registry
+from tinder_app.proposals import get_proposals
+from tinder_app.search import tokenize
+from tinder_app.swipes import swipe, swipe_batch, CREATED, OUT_OF_SWIPES, NOT_FOUND
 from tinder_app.serializers import (
     UserRegisterSerializer,
     UserUpdateSerializer,
     UserChangePasswordSerializer,
     UserSerializer,
     MessageSerializer,
+    MessageSearchSerializer,
     MessagePostSerializer,
     ChatSerializer,
+    SwipeBatchSerializer,
 )
 
 
@@ -43,33 +62,22 @@ class UpdateUserView(generics.UpdateAPIView):
     serializer_class = UserUpdateSerializer
     permission_classes = (IsAuthenticated,)
 
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        invalidate_deck(serializer.instance.id)
+
 
 class CurrentUserLocationView(views.APIView):
     permission_classes = (IsAuthenticated,)
 
     def post(self, request):
-        user = request.user
         longitude = float(request.POST.get('longitude'))
         latitude = float(request.POST.get('latitude'))
-        if user.location:
-            modified = user.location.last_modified
-            delta = datetime.datetime.now(tz=modified.tzinfo) - modified
-            if delta < datetime.timedelta(seconds=7200):
-                return Response(
-                    {'detail': 'Location can be changed every two hours.'},
-                    status=status.HTTP_403_FORBIDDEN
-                )
-            else:
-                user.location.last_location = Point(longitude, latitude, srid=4326)
-                user.location.save()
-        else:
-            location = Location.objects.create(
-                last_location=Point(
-                    longitude, latitude, srid=4326
-                )
+        if not location_buffer.submit(request.user, longitude, latitude):
+            return Response(
+                {'detail': 'Location can be changed every two hours.'},
+                status=status.HTTP_403_FORBIDDEN
             )
-            user.location = location
-            user.save()
         return Response(
             {'detail': 'Location changed'}, status=status.HTTP_204_NO_CONTENT
         )
@@ -83,7 +91,8 @@ class SetRadiusView(views.APIView):
         radius = int(request.data.get('radius'))
         if user.subscription == user.PREMIUM:
             user.search_radius = radius
-            user.save()
+            user.save(update_fields=['search_radius'])
+            invalidate_deck(user.id)
             return Response(status=status.HTTP_204_NO_CONTENT)
         return Response(
             {'detail': "Cannot change user search radius on VIP and Base subscription"},
@@ -91,58 +100,64 @@ class SetRadiusView(views.APIView):
         )
 
 
-class ProposalsListView(generics.ListAPIView):
+class UserPlanListMixin:
+    # With FAST_SERIALIZATION pages are read with .values() and rendered by
+    # USER_PLAN, which produces the same output as UserSerializer.
+
+    # Columns the paginator needs besides the ones the plan renders.
+    cursor_columns = ()
+
+    def list(self, request, *args, **kwargs):
+        if not settings.FAST_SERIALIZATION:
+            return super().list(request, *args, **kwargs)
+        page = self.paginate_queryset(self.get_queryset().values(*USER_PLAN.columns, *self.cursor_columns))
+        return self.get_paginated_response(render_users(page, self.get_serializer_context()))
+
+
+class ProposalsListView(UserPlanListMixin, generics.ListAPIView):
     serializer_class = UserSerializer
     permission_classes = (IsAuthenticated,)
 
+    @property
+    def pagination_class(self):
+        return RankPagination if settings.PROPOSAL_RANKING else DistancePagination
+
     def get_queryset(self):
         user = self.get_serializer_context()['request'].user
-        current_user_location = user.location.last_location
-        user_likes = user.get_user_likes().values_list('id', flat=True)
-        user_dislikes = user.get_user_dislikes().values_list('id', flat=True)
-        related_dislikes = user.get_related_dislikes().values_list('id', flat=True)
-        ids_to_exclude = set(chain(user_likes, user_dislikes, related_dislikes, [user.id]))
-
-        proposals = User.objects.filter(
-            sex=user.sex if user.homo else user.opposite_sex,
-            preferred_sex=user.sex,
-            age__range=(user.preferred_age_min, user.preferred_age_max),
-            preferred_age_min__lte=user.age,
-            preferred_age_max__gte=user.age,
-        ).exclude(id__in=ids_to_exclude)
+        if settings.PROPOSAL_RANKING:
+            # numpy is only loaded by deployments that rank proposals.
+            from tinder_app.ranking import get_ranked_proposals
 
-        proposals = proposals.annotate(
-            radius=Least(user.search_radius, F('search_radius')),
-            distance=Distance('location__last_location', current_user_location)
-        ).filter(distance__lte=F('radius') * 1000).order_by('distance')
+            return get_ranked_proposals(user)
+        if settings.PROPOSAL_DECKS:
+            return get_deck_proposals(user)
+        return get_proposals(user)
 
-        return proposals
 
-
-class MatchedListView(generics.ListAPIView):
+class MatchedListView(UserPlanListMixin, generics.ListAPIView):
     permission_classes = (IsAuthenticated,)
     serializer_class = UserSerializer
+    pagination_class = MatchPagination
+    cursor_columns = ('matched_at',)
 
     def get_queryset(self):
+        # Pages follow the (matched_at, id) order of get_matched_list(), so
+        # distances are only computed for the rows of the page.
         user = self.get_serializer_context()['request'].user
         current_user_location = user.location.last_location
-        matched_list = user.get_matched_list()
-        matched_list = matched_list.annotate(
+        return user.get_matched_list().annotate(
             distance=Distance('location__last_location', current_user_location),
-        ).order_by('distance')
-        return matched_list
+        )
 
 
-class UserDetailView(generics.RetrieveAPIView):
+class UserDetailView(views.APIView):
     permission_classes = (IsAuthenticated,)
-    serializer_class = UserSerializer
 
-    def get_queryset(self):
-        user = self.get_serializer_context()['request'].user
-        current_user_location = user.location.last_location
-        return User.objects.annotate(
-            distance=Distance('location__last_location', current_user_location),
-        ).order_by('distance')
+    def get(self, request, pk):
+        data = render_profile(pk, request.user, request)
+        if data is None:
+            raise Http404
+        return Response(data)
 
 
 class SwipeView(views.APIView):
@@ -150,35 +165,52 @@ class SwipeView(views.APIView):
 
     def post(self, request, pk):
         user = request.user
-        if user.swipes_per_day < 1:
-            return Response({'detail': 'Out of swipes.'}, status=status.HTTP_403_FORBIDDEN)
-        to_user = get_object_or_404(User.objects.all(), id=pk)
         is_liked = request.POST.get('is_liked')
-        try:
-            relation, created = user.add_relation(to_user=to_user, status=int(is_liked))
-        except ParticipantsLimitException:
-            return Response(
-                {'detail': 'Cannot add more than 2 users to private chat.'},
-                status=status.HTTP_403_FORBIDDEN
-            )
-        user.swipes_per_day = F('swipes_per_day') - 1
-        user.save()
-        return Response({'detail': 'Relation created'}, status=status.HTTP_201_CREATED) if created \
+        if is_liked not in ('0', '1'):
+            return Response({'detail': 'is_liked must be 0 or 1.'}, status=status.HTTP_400_BAD_REQUEST)
+        result = swipe(user, pk, int(is_liked))
+        if result.status == OUT_OF_SWIPES:
+            return Response({'detail': 'Out of swipes.'}, status=status.HTTP_403_FORBIDDEN)
+        if result.status == NOT_FOUND:
+            raise Http404
+        return Response({'detail': 'Relation created'}, status=status.HTTP_201_CREATED) if result.status == CREATED \
             else Response({'detail': 'Relation already exists'}, status=status.HTTP_204_NO_CONTENT)
 
 
+class SwipeBatchView(views.APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request):
+        user = request.user
+        data = {'swipes': request.data} if isinstance(request.data, list) else request.data
+        serializer = SwipeBatchSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        swipes = [
+            (item['to_user'], Relationship.LIKED if item['is_liked'] else Relationship.DISLIKED)
+            for item in serializer.validated_data['swipes']
+        ]
+        results = swipe_batch(user, swipes)
+        return Response({'data': [
+            {'to_user': to_user, 'status': result.status, 'chat': result.chat_id}
+            for (to_user, _), result in zip(swipes, results)
+        ]})
+
+
 class ChatViewSet(viewsets.ViewSet):
     permission_classes = (IsAuthenticated,)
 
     def list(self, request):
         user = request.user
         chats = Chat.objects.filter(
-            participants=user.id,
-        ).exclude(
-            message__isnull=True
+            chatparticipant__user=user.id,
+            last_message__isnull=False,
         ).annotate(
-            latest_msg_ts=Max('message__timestamp')
-        ).order_by('-latest_msg_ts')
+            unread_count=F('chatparticipant__unread_count')
+        ).select_related(
+            'last_message__sender'
+        ).prefetch_related(
+            Prefetch('participants', queryset=User.objects.only('id'))
+        ).order_by('-last_message_at')
         serializer = ChatSerializer(chats, many=True)
         return Response({'data': serializer.data})
 
@@ -190,9 +222,37 @@ class ChatViewSet(viewsets.ViewSet):
                 {'detail': 'You dont have permissions for this chat.'},
                 status=status.HTTP_403_FORBIDDEN
             )
-        messages = Message.objects.filter(chat_id=chat.id)
-        serializer = MessageSerializer(messages, many=True)
-        return Response({'data': serializer.data})
+        ChatParticipant.objects.filter(
+            chat=chat, user=user, unread_count__gt=0
+        ).update(unread_count=0)
+        messages = chat_messages(chat.id, archived=chat.archived_count > 0)
+        paginator, data = paginate_messages(messages, request, view=self)
+        return paginator.get_paginated_response(data)
+
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk):
+        user = request.user
+        chat = get_object_or_404(Chat.objects.all(), id=pk)
+        if user not in chat.participants.all():
+            return Response(
+                {'detail': 'You dont have permissions for this chat.'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        return StreamingHttpResponse(
+            export_messages(chat.id, settings.CHAT_EXPORT_CHUNK_SIZE),
+            content_type='application/x-ndjson'
+        )
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        query = request.query_params.get('q', '')
+        if not tokenize(query):
+            return Response({'detail': 'q must contain at least one word.'}, status=status.HTTP_400_BAD_REQUEST)
+        messages = search_history(request.user, query)
+        paginator = SearchPagination()
+        page = paginator.paginate_queryset(messages, request, view=self)
+        serializer = MessageSearchSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
     def create(self, request):
         user = request.user
@@ -209,3 +269,92 @@ class ChatViewSet(viewsets.ViewSet):
             return Response(status=status.HTTP_201_CREATED)
         else:
             return Response(status=status.HTTP_400_BAD_REQUEST)
+
+
+def paginate_messages(messages, request, view=None):
+    paginator = MessagePagination()
+    if settings.FAST_SERIALIZATION:
+        page = paginator.paginate_queryset(messages.values(*MESSAGE_PLAN.columns), request, view=view)
+        return paginator, render_messages(page, {})
+    page = paginator.paginate_queryset(messages, request, view=view)
+    return paginator, MessageSerializer(page, many=True).data
+
+
+def authorize_chat_poll(request, pk):
+    request = Request(request, authenticators=[
+        authentication() for authentication in api_settings.DEFAULT_AUTHENTICATION_CLASSES
+    ])
+    if not request.user.is_authenticated:
+        raise NotAuthenticated()
+    participants = ChatParticipant.objects.filter(chat_id=pk).values_list('user_id', flat=True)
+    if not participants:
+        raise NotFound()
+    if request.user.id not in participants:
+        raise PermissionDenied('You dont have permissions for this chat.')
+    return request
+
+
+def chat_tail(request, pk):
+    # A poll without a cursor waits for messages after the current last one.
+    if MessagePagination.cursor_query_param in request.query_params:
+        return None
+    return Chat.objects.filter(id=pk, last_message__isnull=False).values_list(
+        'last_message_at', 'last_message_id'
+    ).first()
+
+
+def fetch_new_messages(request, pk, tail=None):
+    messages = chat_messages(pk)
+    if tail is not None:
+        messages = messages.after(tail)
+    paginator, data = paginate_messages(messages, request)
+    if data:
+        ChatParticipant.objects.filter(
+            chat_id=pk, user=request.user, unread_count__gt=0
+        ).update(unread_count=0)
+    if data or tail is None:
+        next_link = paginator.get_next_link()
+    else:
+        # Hand back the tail so the next poll resumes from it.
+        next_link = paginator.encode_cursor([paginator.encode_value(value) for value in tail])
+    return {
+        'next': next_link,
+        'data': data,
+    }
+
+
+async def poll_chat(request, pk):
+    try:
+        request = await sync_to_async(authorize_chat_poll)(request, pk)
+        timeout = float(request.query_params.get('timeout', settings.CHAT_POLL_TIMEOUT))
+        tail = await sync_to_async(chat_tail)(request, pk)
+    except APIException as exc:
+        return JsonResponse({'detail': exc.detail}, status=exc.status_code)
+    except ValueError:
+        return JsonResponse({'detail': 'Invalid timeout.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max(0.0, min(timeout, settings.CHAT_POLL_TIMEOUT))
+    async with get_broker().subscribe(chat_channel(pk)) as subscription:
+        while True:
+            try:
+                result = await sync_to_async(fetch_new_messages)(request, pk, tail)
+            except APIException as exc:
+                return JsonResponse({'detail': exc.detail}, status=exc.status_code)
+            remaining = deadline - loop.time()
+            if result['data'] or remaining <= 0 or not await subscription.wait(remaining):
+                return JsonResponse(result)
+
+
+class ProfileStatsView(views.APIView):
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return Response({
+            'data': registry.snapshot(),
+            'caches': {'profiles': profile_cache.stats()},
+        })
+
+    def delete(self, request):
+        registry.reset()
+        return Response(status=status.HTTP_204_NO_CONTENT)